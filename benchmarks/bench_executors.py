@@ -0,0 +1,172 @@
+"""
+Benchmark the executors of fsdproc process-images on a set of scenes.
+
+Runs `fsdproc process-images --force` on the same scenes with each executor,
+--repeat times, into a fresh save_direc, and reports the median wall time of
+the run, its throughput in scenes per second, and the mean duration and peak
+memory of the scenes from its metrics.jsonl. The wall time includes starting
+the workers, which is where the thread executor saves the most on short runs.
+Results are written as JSON so runs of different commits or machines can be
+compared with --compare.
+
+Examples:
+    python benchmarks/bench_executors.py --data-direc tests/input \\
+        --land tests/input/reproj_land.tiff --max-workers 4
+    python benchmarks/bench_executors.py --synthetic 8 1500 --output executors.json
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from datetime import datetime
+from pathlib import Path
+from shutil import rmtree
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from bench_pipeline import get_environment, write_land, write_scene
+
+EXECUTORS = ["process", "thread", "hybrid"]
+
+
+def write_synthetic_archive(direc: Path, count: int, size: int) -> Path:
+    """Write `count` synthetic scenes of `size` pixels square; return the land file."""
+    for n in range(count):
+        doy = 152 + n
+        date = datetime.strptime(f"2012-{doy}", "%Y-%j").strftime("%Y-%m-%d")
+        ftci, _ = write_scene(direc, str(doy), date, (size, size), seed=n)
+    return write_land(direc, ftci, (size, size))
+
+
+def run_executor(
+    executor: str,
+    data_direc: Path,
+    land: Path,
+    save_direc: Path,
+    options: dict,
+) -> dict:
+    """Process the scenes once with `executor` into `save_direc`."""
+    rmtree(save_direc, ignore_errors=True)
+    config_file = save_direc.with_suffix(".toml")
+    config_file.write_text(f"""
+        data_direc = "{data_direc}"
+        save_figs = {str(options["save_figs"]).lower()}
+        save_direc = "{save_direc}"
+        land = "{land}"
+        [erosion]
+        itmax = 8
+        itmin = 3
+        step = -1
+        kernel_type = "diamond"
+        kernel_size = 1
+        """)
+    command = ["fsdproc", "process-images", "-c", str(config_file), "--force"]
+    command += ["--executor", executor]
+    command += ["--threads-per-process", str(options["threads_per_process"])]
+    if options["max_workers"]:
+        command += ["--max-workers", str(options["max_workers"])]
+    start = perf_counter()
+    result = subprocess.run(command, capture_output=True, text=True)
+    seconds = perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"fsdproc failed with {executor}:\n{result.stderr}")
+
+    lines = (save_direc / "metrics.jsonl").read_text().splitlines()
+    records = [json.loads(line) for line in lines]
+    return {
+        "seconds": seconds,
+        "scene_seconds": statistics.mean(r["seconds"] for r in records),
+        # the scenes on threads record the peak of their process
+        "peak_rss_mb": max(
+            r.get("peak_rss_mb", r.get("process_peak_rss_mb")) for r in records
+        ),
+        "scenes": len(records),
+    }
+
+
+def print_result(result: dict, baseline: dict | None = None) -> None:
+    change = ""
+    if baseline is not None:
+        change = f" ({result['seconds'] / baseline['seconds']:5.2f}x)"
+    print(
+        f"{result['executor']:8s} {result['seconds']:8.2f} s{change}, "
+        f"{result['scenes_per_second']:.2f} scenes/s, "
+        f"{result['scene_seconds']:.2f} s per scene, "
+        f"peak RSS {result['peak_rss_mb']:.0f} MB per process"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--data-direc", type=Path, help="directory with tci/, cloud/")
+    parser.add_argument(
+        "--land", type=Path, help="land mask of the --data-direc scenes"
+    )
+    parser.add_argument(
+        "--synthetic",
+        type=int,
+        nargs=2,
+        metavar=("COUNT", "SIZE"),
+        help="benchmark COUNT square synthetic scenes of SIZE pixels instead",
+    )
+    parser.add_argument("--executors", nargs="+", choices=EXECUTORS, default=EXECUTORS)
+    parser.add_argument("--max-workers", type=int, default=None)
+    parser.add_argument("--threads-per-process", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save-figs", action="store_true")
+    parser.add_argument("--output", type=Path, help="write the results as JSON")
+    parser.add_argument("--compare", type=Path, help="results of a previous run")
+    args = parser.parse_args(argv)
+
+    options = {
+        "max_workers": args.max_workers,
+        "threads_per_process": args.threads_per_process,
+        "save_figs": args.save_figs,
+    }
+
+    baselines = {}
+    if args.compare:
+        baselines = {
+            r["executor"]: r for r in json.loads(args.compare.read_text())["results"]
+        }
+
+    results = []
+    with TemporaryDirectory() as tmp:
+        data_direc, land = args.data_direc, args.land
+        if args.synthetic:
+            data_direc = Path(tmp) / "input"
+            land = write_synthetic_archive(data_direc, *args.synthetic)
+        elif data_direc is None or not any((data_direc / "tci").glob("*.tif*")):
+            sys.exit(f"no TCI images in {data_direc}/tci, use --synthetic")
+        data_direc, land = data_direc.resolve(), land.resolve()
+
+        for executor in args.executors:
+            runs = [
+                run_executor(executor, data_direc, land, Path(tmp) / executor, options)
+                for _ in range(args.repeat)
+            ]
+            # the run of median wall time
+            run = sorted(runs, key=lambda r: r["seconds"])[len(runs) // 2]
+            result = {
+                "executor": executor,
+                **run,
+                "scenes_per_second": run["scenes"] / run["seconds"],
+            }
+            print_result(result, baselines.get(executor))
+            results.append(result)
+
+    if args.output:
+        report = {
+            "environment": get_environment(),
+            "options": options,
+            "results": results,
+        }
+        args.output.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Benchmark the startup time of the package and the fsdproc CLI.
+
+Each target runs in a fresh interpreter, --repeat times, and the median wall
+time is reported with the heavy libraries the target loaded. Startup is paid
+by every short task of a batch job and by every spawned worker, so modules
+that only need the standard library, numpy and typer should stay that way.
+With --max-seconds the benchmark fails if a target is slower, so it can guard
+against an import that makes startup slow again.
+
+Examples:
+    python benchmarks/bench_imports.py --output imports.json
+    python benchmarks/bench_imports.py --compare imports.json --max-seconds 1
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from time import perf_counter
+
+# libraries taking a large share of the import time of the processing modules
+HEAVY_MODULES = ("cv2", "matplotlib", "pandas", "pyarrow", "rasterio", "scipy")
+
+TARGETS = {
+    "import ebfloeseg.app": "import ebfloeseg.app",
+    "fsdproc --help": "from ebfloeseg.app import app; app(['--help'])",
+    "import ebfloeseg.preprocess": "import ebfloeseg.preprocess",
+}
+
+# prints the heavy modules loaded when the interpreter exits, also when the
+# code calls sys.exit
+_REPORT = """import atexit, sys
+atexit.register(
+    lambda: print(*[m for m in {modules!r} if m in sys.modules], file=sys.stderr)
+)
+"""
+
+
+def run_target(name: str, code: str, repeat: int) -> dict:
+    """Time `code` in `repeat` new interpreters."""
+    code = _REPORT.format(modules=HEAVY_MODULES) + code
+    seconds = []
+    for _ in range(repeat):
+        start = perf_counter()
+        process = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True
+        )
+        seconds.append(perf_counter() - start)
+        if process.returncode:
+            raise RuntimeError(f"{name} failed:\n{process.stderr}")
+    lines = process.stderr.splitlines()
+    loaded = lines[-1].split() if lines else []
+    return {
+        "target": name,
+        "seconds": statistics.median(seconds),
+        "heavy_modules": loaded,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        help="fail if the CLI targets take longer than this",
+    )
+    parser.add_argument("--output", type=Path, help="write the results as JSON")
+    parser.add_argument("--compare", type=Path, help="results of a previous run")
+    args = parser.parse_args(argv)
+
+    baselines = {}
+    if args.compare:
+        baselines = {
+            r["target"]: r for r in json.loads(args.compare.read_text())["results"]
+        }
+
+    results = []
+    slow = []
+    for name, code in TARGETS.items():
+        result = run_target(name, code, args.repeat)
+        reference = baselines.get(name)
+        change = (
+            f" ({result['seconds'] / reference['seconds']:5.2f}x)" if reference else ""
+        )
+        print(
+            f"{name:30s} {result['seconds']:6.3f} s{change}  "
+            f"loads: {', '.join(result['heavy_modules']) or '-'}"
+        )
+        results.append(result)
+        if (
+            args.max_seconds is not None
+            and name != "import ebfloeseg.preprocess"
+            and result["seconds"] > args.max_seconds
+        ):
+            slow.append(name)
+
+    if args.output:
+        report = {
+            "environment": {
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+            },
+            "results": results,
+        }
+        args.output.write_text(json.dumps(report, indent=2))
+
+    if slow:
+        sys.exit(f"slower than {args.max_seconds} s: {', '.join(slow)}")
+
+
+if __name__ == "__main__":
+    main()
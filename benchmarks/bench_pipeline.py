@@ -0,0 +1,261 @@
+"""
+Benchmark the segmentation pipeline stage by stage.
+
+Runs every scene in a fresh process and reports the duration of each stage of
+`_preprocess` (or `_preprocess_tiled`), the throughput in megapixels per
+second and the peak resident memory. Results are written as JSON together
+with the commit and library versions, so runs of different commits can be
+compared with --compare.
+
+With --compare-thresholds, the adaptive threshold methods are timed side by
+side on the red channel of each scene instead, with the fraction of pixels
+each classifies differently than the reference "gaussian" method.
+
+Examples:
+    python benchmarks/bench_pipeline.py --data-direc tests/input \\
+        --land tests/input/reproj_land.tiff --output bench.json
+    python benchmarks/bench_pipeline.py --synthetic 2000 4000 --compare bench.json
+    python benchmarks/bench_pipeline.py --synthetic 4000 --compare-thresholds
+"""
+
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import subprocess
+import sys
+import traceback
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import cv2
+import numpy as np
+import rasterio
+import skimage
+
+from ebfloeseg.masking import create_land_mask
+from ebfloeseg.metrics import record_stages
+from ebfloeseg.outputs import THRESHOLD_METHODS
+from ebfloeseg.preprocess import THRESHOLD_BLOCK_SIZE, _preprocess, _preprocess_tiled
+from ebfloeseg.threshold import get_local_threshold
+from ebfloeseg.utils import pair_scenes
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "tests"))
+from synthetic import write_land, write_scene  # noqa: E402
+
+
+def _run_scene(ftci, fcloud, fland, options, queue):
+    # runs in a fresh process, so the peak memory is the scene's own
+    try:
+        queue.put(_benchmark_scene(ftci, fcloud, fland, options))
+    except BaseException:
+        queue.put({"error": traceback.format_exc()})
+        raise
+
+
+def _benchmark_scene(ftci, fcloud, fland, options):
+    land_mask = create_land_mask(fland)
+    with TemporaryDirectory() as tmp, record_stages() as recorder:
+        args = (ftci, fcloud, land_mask, *options["erosion"], options["save_figs"])
+        start = perf_counter()
+        if options["tile_size"]:
+            _preprocess_tiled(
+                *args,
+                Path(tmp),
+                options["tile_size"],
+                threshold_method=options["threshold_method"],
+            )
+        else:
+            _preprocess(*args, Path(tmp), threshold_method=options["threshold_method"])
+        seconds = perf_counter() - start
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        maxrss *= 1024  # kilobytes on Linux
+    return {"seconds": seconds, "peak_rss": maxrss, "stages": recorder.as_records()}
+
+
+def run_scene(name, ftci, fcloud, fland, options) -> dict:
+    """Benchmark one scene in a new process."""
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(
+        target=_run_scene, args=(ftci, fcloud, fland, options, queue)
+    )
+    process.start()
+    result = queue.get()
+    process.join()
+    if "error" in result:
+        raise RuntimeError(f"benchmarking {ftci} failed:\n{result['error']}")
+
+    with rasterio.open(ftci) as src:
+        pixels = src.width * src.height
+    return {
+        "scene": name,
+        "pixels": pixels,
+        "seconds": result["seconds"],
+        "megapixels_per_second": pixels / 1e6 / result["seconds"],
+        "peak_rss_mb": result["peak_rss"] / 2**20,
+        "stages": result["stages"],
+    }
+
+
+def compare_thresholds(name, ftci, repeat=3) -> dict:
+    """
+    Time each threshold method on the red channel of a scene, best of `repeat`.
+    """
+    with rasterio.open(ftci) as src:
+        red = src.read(1)
+    reference = red > get_local_threshold(red, THRESHOLD_BLOCK_SIZE)
+    methods = []
+    for method in THRESHOLD_METHODS:
+        times = []
+        for _ in range(repeat):
+            start = perf_counter()
+            threshold = get_local_threshold(red, THRESHOLD_BLOCK_SIZE, method)
+            times.append(perf_counter() - start)
+        methods.append(
+            {
+                "method": method,
+                "seconds": min(times),
+                "disagreement": float(np.mean((red > threshold) != reference)),
+            }
+        )
+    return {"scene": name, "pixels": red.size, "methods": methods}
+
+
+def print_thresholds(result: dict) -> None:
+    reference = result["methods"][0]["seconds"]
+    print(f"{result['scene']}: {result['pixels'] / 1e6:.1f} MP")
+    for m in result["methods"]:
+        print(
+            f"    {m['method']:12s} {m['seconds']:8.3f} s "
+            f"({reference / m['seconds']:6.1f}x faster), "
+            f"{m['disagreement']:.4%} of pixels differ"
+        )
+
+
+def get_environment() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "scikit-image": skimage.__version__,
+        "rasterio": rasterio.__version__,
+    }
+
+
+def print_result(result: dict, baseline: dict | None = None) -> None:
+    def ratio(value, key):
+        if baseline is None:
+            return ""
+        reference = baseline.get(key)
+        return f" ({value / reference:5.2f}x)" if reference else ""
+
+    base_stages = {}
+    if baseline is not None:
+        base_stages = {s["stage"]: s["seconds"] for s in baseline["stages"]}
+    print(
+        f"{result['scene']}: {result['pixels'] / 1e6:.1f} MP, "
+        f"{result['seconds']:.2f} s{ratio(result['seconds'], 'seconds')}, "
+        f"{result['megapixels_per_second']:.2f} MP/s, "
+        f"peak RSS {result['peak_rss_mb']:.0f} MB"
+        f"{ratio(result['peak_rss_mb'], 'peak_rss_mb')}"
+    )
+    for s in result["stages"]:
+        reference = base_stages.get(s["stage"])
+        change = f" ({s['seconds'] / reference:5.2f}x)" if reference else ""
+        print(f"    {s['stage']:40s} {s['seconds']:8.3f} s{change}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--data-direc", type=Path, help="directory with tci/, cloud/")
+    parser.add_argument(
+        "--land", type=Path, help="land mask of the --data-direc scenes"
+    )
+    parser.add_argument(
+        "--synthetic",
+        type=int,
+        nargs="*",
+        default=[],
+        help="sizes of square synthetic scenes to benchmark",
+    )
+    parser.add_argument("--tile-size", type=int, default=None)
+    parser.add_argument("--threshold-method", default="gaussian")
+    parser.add_argument("--save-figs", action="store_true")
+    parser.add_argument(
+        "--compare-thresholds",
+        action="store_true",
+        help="time the threshold methods instead of the pipeline",
+    )
+    parser.add_argument("--output", type=Path, help="write the results as JSON")
+    parser.add_argument("--compare", type=Path, help="results of a previous run")
+    args = parser.parse_args(argv)
+
+    options = {
+        "erosion": (8, 3, -1, "diamond", 1),
+        "save_figs": args.save_figs,
+        "tile_size": args.tile_size,
+        "threshold_method": args.threshold_method,
+    }
+
+    baselines = {}
+    if args.compare:
+        baselines = {
+            r["scene"]: r for r in json.loads(args.compare.read_text())["results"]
+        }
+
+    results = []
+    with TemporaryDirectory() as tmp:
+        scenes = []
+        if args.data_direc:
+            tcis = sorted((args.data_direc / "tci").glob("*.tif*"))
+            clouds = sorted((args.data_direc / "cloud").glob("*.tif*"))
+            if not tcis:
+                print(f"no TCI images in {args.data_direc / 'tci'}, skipping")
+            pairs, unpaired = pair_scenes(tcis, clouds)
+            for f in unpaired:
+                print(f"no partner for {f.name}, skipping")
+            scenes += [(t.name, t, c, args.land) for t, c in pairs]
+        for size in args.synthetic:
+            direc = Path(tmp) / f"synthetic_{size}"
+            ftci, fcloud = write_scene(direc, "214", "2012-08-01", (size, size))
+            fland = write_land(direc, ftci, (size, size))
+            scenes.append((f"synthetic_{size}", ftci, fcloud, fland))
+
+        for name, ftci, fcloud, fland in scenes:
+            if args.compare_thresholds:
+                result = compare_thresholds(name, ftci)
+                print_thresholds(result)
+            else:
+                result = run_scene(name, ftci, fcloud, fland, options)
+                print_result(result, baselines.get(result["scene"]))
+            results.append(result)
+
+    if args.output:
+        report = {
+            "environment": get_environment(),
+            "options": options,
+            "results": results,
+        }
+        args.output.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,67 @@
 #!/usr/bin/env python
 
+from collections import deque
 from dataclasses import dataclass
+from datetime import date, datetime, timezone
 from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from itertools import product
+from logging import getLogger
+from shutil import rmtree
+from tempfile import TemporaryDirectory
+import signal
+import threading
+import time
 import tomllib
 import typer
 from typing import Optional
 
 
-import pandas as pd
+import numpy as np
 
-from ebfloeseg.masking import create_land_mask
-from ebfloeseg.preprocess import preprocess
+from ebfloeseg.cache import SceneCache, get_input_digests
+from ebfloeseg.index import INDEX_FILE, SceneIndex
+from ebfloeseg.metrics import (
+    METRICS_FILE,
+    PROFILE_DIREC,
+    SKIP_CACHED,
+    append_metrics,
+    scene_metrics,
+    stage,
+)
+from ebfloeseg.outputs import (
+    MASK_VALUES_FILE,
+    collect_dataset,
+    validate_label_compress,
+    validate_output_format,
+    validate_threshold_method,
+)
+from ebfloeseg.pipeline import prefetch
+from ebfloeseg.scheduler import (
+    HybridPoolExecutor,
+    get_default_workers,
+    submit_bounded,
+)
+from ebfloeseg.sharding import (
+    ShardManifest,
+    get_shard,
+    get_shard_fname,
+    merge_manifests,
+    merge_shard_files,
+)
+
+# the modules processing the scenes import cv2, scipy, skimage, rasterio,
+# pandas and matplotlib, which take seconds to load, so they are imported by
+# the functions running them: `fsdproc --help` and reading a config do not
+# load them
+
+logger = getLogger(__name__)
 
 
 @dataclass
@@ -25,6 +75,22 @@ class ConfigParams:
     step: int
     kernel_type: str
     kernel_size: int
+    tile_size: Optional[int] = None
+    threshold_method: str = "gaussian"
+    output_format: str = "csv"
+    min_usable_fraction: float = 0.0
+    label_compress: str = "deflate"
+    start_date: Optional[date] = None
+    end_date: Optional[date] = None
+    satellites: Optional[list[str]] = None
+    doy_range: Optional[tuple[int, int]] = None
+
+
+# erosion settings that can be swept
+SWEEP_KEYS = ["itmax", "itmin", "step", "kernel_type", "kernel_size"]
+
+# how the scenes are spread over the workers, see `get_scene_executor`
+EXECUTORS = ["process", "thread", "hybrid"]
 
 
 def validate_kernel_type(ctx: typer.Context, value: str) -> str:
@@ -33,6 +99,12 @@ def validate_kernel_type(ctx: typer.Context, value: str) -> str:
     return value
 
 
+def validate_executor(ctx: typer.Context, value: str) -> str:
+    if value not in EXECUTORS:
+        raise typer.BadParameter(f"Executor must be one of {', '.join(EXECUTORS)}")
+    return value
+
+
 help = "TODO: add description"
 name = "fsdproc"
 epilog = f"Example: {name} --data-direc /path/to/data --save_figs --save-direc /path/to/save --land /path/to/landfile"
@@ -57,6 +129,15 @@ def parse_config_file(config_file: Path) -> ConfigParams:
         "step": -1,
         "kernel_type": "diamond",  # type of kernel (either diamond or ellipse)
         "kernel_size": 1,
+        "tile_size": None,  # process scenes in tiles of this many pixels (even)
+        "threshold_method": "gaussian",  # adaptive threshold: gaussian, mean, downsample
+        "output_format": "csv",  # props and mask values: csv or parquet
+        "min_usable_fraction": 0.0,  # skip scenes with less unmasked area
+        "label_compress": "deflate",  # codec of the label images
+        "start_date": None,  # only process the scenes of these dates, included
+        "end_date": None,
+        "satellites": None,  # only process the scenes of these satellites
+        "doy_range": None,  # only process the scenes of these days of year
     }
 
     erosion = config["erosion"]
@@ -70,9 +151,381 @@ def parse_config_file(config_file: Path) -> ConfigParams:
                 value = Path(value)
             defaults[key] = value
 
+    validate_threshold_method(defaults["threshold_method"])
+    validate_output_format(defaults["output_format"])
+    validate_label_compress(defaults["label_compress"])
+    if not 0 <= defaults["min_usable_fraction"] <= 1:
+        raise ValueError("min_usable_fraction must be between 0 and 1")
+    validate_scene_filters(defaults)
     return ConfigParams(**defaults)
 
 
+def validate_scene_filters(config: dict) -> None:
+    """Parse the scene filters of a configuration file inplace."""
+    for key in ["start_date", "end_date"]:
+        if isinstance(config[key], str):
+            config[key] = date.fromisoformat(config[key])
+    if config["start_date"] and config["end_date"]:
+        if config["start_date"] > config["end_date"]:
+            raise ValueError("start_date must not be after end_date")
+    if isinstance(config["satellites"], str):
+        config["satellites"] = [config["satellites"]]
+    if config["doy_range"] is not None:
+        first, last = config["doy_range"]
+        if not 1 <= first <= last <= 366:
+            raise ValueError(
+                "doy_range must be [first, last] with 1 <= first <= last <= 366"
+            )
+        config["doy_range"] = (first, last)
+
+
+# static inputs of a run, attached once per worker process
+_static_inputs: dict[str, np.ndarray] = {}
+# whether the workers of the run share their process, i.e. run on threads
+_shared_process = False
+
+
+def save_static_inputs(direc: Path, **arrays: np.ndarray) -> dict[str, Path]:
+    """
+    Save the inputs shared by all scenes of a run as .npy files.
+
+    Workers memory-map the files in `init_worker`, so the arrays are read
+    once into the page cache and shared, instead of being pickled into every
+    task.
+
+    Args:
+        direc (Path): The directory to save the files in.
+        **arrays (np.ndarray): The arrays by name.
+
+    Returns:
+        dict[str, Path]: The file of each array.
+    """
+    files = {}
+    for name, array in arrays.items():
+        files[name] = direc / f"{name}.npy"
+        np.save(files[name], array)
+    return files
+
+
+def attach_arrays(files: dict[str, Path]) -> dict[str, np.ndarray]:
+    """Memory-map arrays saved by `save_static_inputs`, read-only."""
+    return {name: np.load(path, mmap_mode="r") for name, path in files.items()}
+
+
+def get_land_masks(land: Path) -> dict[str, np.ndarray]:
+    """
+    The land mask of a run and its dilation, computed once for all scenes:
+    the static inputs of the workers.
+    """
+    from ebfloeseg.masking import create_land_mask
+    from ebfloeseg.preprocess import get_land_mask_dilated
+
+    land_mask = create_land_mask(land)
+    return {
+        "land_mask": land_mask,
+        "land_mask_dilated": get_land_mask_dilated(land_mask),
+    }
+
+
+def init_worker(static_files: dict[str, Path], shared_process: bool = False) -> None:
+    """
+    Attach the static inputs saved by `save_static_inputs`, and note whether
+    the worker shares its process with others.
+    """
+    global _shared_process
+    _static_inputs.update(attach_arrays(static_files))
+    _shared_process = shared_process
+
+
+def init_warm_worker(
+    static_files: dict[str, Path], shared_process: bool = False
+) -> None:
+    """
+    Run `init_worker` and import the processing libraries, so the first scene
+    of a worker does not wait for them.
+    """
+    init_worker(static_files, shared_process)
+    import ebfloeseg.preprocess  # noqa: F401
+
+
+def worker_ready() -> None:
+    """A task that does nothing, submitted to start the workers of a pool."""
+
+
+def get_scene_executor(
+    executor: str,
+    max_workers: int,
+    static_files: dict[str, Path],
+    threads_per_process: int = 2,
+    warm: bool = False,
+) -> Executor:
+    """
+    The pool running the scenes of a run, with the static inputs attached.
+
+    "process" runs each worker in its own process. "thread" runs the workers
+    on threads of this process: the heavy kernels of OpenCV, rasterio and
+    NumPy release the GIL, and the workers share the imports and static
+    inputs instead of loading them each, but the Python parts of the scenes
+    take turns. "hybrid" runs them on processes of `threads_per_process`
+    threads each. With threads, the peak memory of a scene cannot be told
+    apart from that of the others in its process, so the metrics record the
+    peak of the process instead, see `scene_metrics`.
+
+    Args:
+        executor (str): One of `EXECUTORS`.
+        max_workers (int): The number of scenes processed at once.
+        static_files (dict[str, Path]): The files from `save_static_inputs`.
+        threads_per_process (int, optional): The threads of each process of
+            "hybrid". Defaults to 2.
+        warm (bool, optional): Import the processing libraries as the workers
+            start, with `init_warm_worker`. Defaults to False.
+
+    Returns:
+        Executor: The pool, to be shut down by the caller.
+    """
+    initializer = init_warm_worker if warm else init_worker
+    if executor == "thread":
+        return ThreadPoolExecutor(
+            max_workers, initializer=initializer, initargs=(static_files, True)
+        )
+    if executor == "hybrid":
+        # the last process runs fewer threads if they do not divide the workers
+        threads = min(threads_per_process, max_workers)
+        return HybridPoolExecutor(
+            -(-max_workers // threads),
+            threads,
+            initializer,
+            (static_files, threads > 1),
+            max_workers=max_workers,
+        )
+    return ProcessPoolExecutor(
+        max_workers=max_workers, initializer=initializer, initargs=(static_files,)
+    )
+
+
+def preprocess_scene(
+    ftci: Path, fcloud: Path, profile_prefix: Optional[Path], hash_inputs: bool, *args
+) -> dict:
+    """
+    Run `preprocess` on a scene with the land mask attached by `init_worker`.
+
+    With `hash_inputs`, the inputs are hashed for the `SceneCache` first, on
+    the worker and while they are in the page cache, and their digests are
+    returned in the "inputs" item of the record.
+
+    Returns:
+        dict: The metrics of the scene, from `scene_metrics`. An error is
+        logged and reported in the metrics rather than raised, so the run can
+        record it before stopping; `preprocess` has logged its traceback.
+    """
+    import rasterio
+
+    from ebfloeseg.preprocess import preprocess
+
+    # replaced by the record of scene_metrics, unless it fails to start
+    record = {"scene": Path(ftci).name, "fcloud": Path(fcloud).name}
+    try:
+        with scene_metrics(ftci, fcloud, profile_prefix, _shared_process) as record:
+            if hash_inputs:
+                with stage("hash"):
+                    record["inputs"] = get_input_digests(ftci, fcloud)
+            with rasterio.open(ftci) as tci:
+                record["megapixels"] = tci.width * tci.height / 1e6
+            preprocess(
+                ftci,
+                fcloud,
+                _static_inputs["land_mask"],
+                *args,
+                land_mask_dilated=_static_inputs.get("land_mask_dilated"),
+            )
+    except Exception as e:
+        record["status"] = "error"
+        record.setdefault("error", repr(e))
+        record.setdefault("failed_stage", None)
+        logger.error(f"Error processing {fcloud} and {ftci}: {e!r}")
+    return record
+
+
+def prepare_sweep_scene(
+    ftci: Path,
+    fcloud: Path,
+    save_figs: bool,
+    save_direc: Path,
+    prepared_direc: Path,
+    threshold_method: str,
+    output_format: str = "csv",
+) -> dict[str, Path]:
+    """Run `prepare_scene` and save its outputs for the `segment_sweep_scene` jobs."""
+    from ebfloeseg.preprocess import prepare_scene
+
+    prepared = prepare_scene(
+        ftci,
+        fcloud,
+        _static_inputs["land_mask"],
+        save_figs,
+        save_direc,
+        threshold_method,
+        output_format,
+        _static_inputs.get("land_mask_dilated"),
+    )
+    prepared_direc.mkdir()
+    return save_static_inputs(prepared_direc, **prepared)
+
+
+def segment_sweep_scene(
+    ftci: Path,
+    fcloud: Path,
+    prepared_files: dict[str, Path],
+    settings: dict,
+    save_figs: bool,
+    save_direc: Path,
+    output_format: str = "csv",
+    label_compress: str = "deflate",
+) -> None:
+    """Run `segment_scene` on a prepared scene with one combination of settings."""
+    from ebfloeseg.preprocess import segment_scene
+
+    segment_scene(
+        ftci,
+        fcloud,
+        **attach_arrays(prepared_files),
+        itmax=settings["itmax"],
+        itmin=settings["itmin"],
+        step=settings["step"],
+        erosion_kernel_type=settings["kernel_type"],
+        erosion_kernel_size=settings["kernel_size"],
+        save_figs=save_figs,
+        save_direc=save_direc,
+        output_format=output_format,
+        label_compress=label_compress,
+    )
+
+
+def parse_sweep(config_file: Path, args: ConfigParams) -> list[dict]:
+    """
+    Read the grid of erosion settings of a sweep.
+
+    The `[sweep]` table of the configuration file lists the values of each
+    erosion setting to try; settings it omits keep their `[erosion]` value.
+
+    Args:
+        config_file (Path): The configuration file.
+        args (ConfigParams): The parsed configuration file.
+
+    Returns:
+        list[dict]: The settings of each combination.
+    """
+    with open(config_file, "rb") as f:
+        sweep = tomllib.load(f).get("sweep", {})
+
+    grid = {}
+    for key in SWEEP_KEYS:
+        values = sweep.get(key, [getattr(args, key)])
+        grid[key] = values if isinstance(values, list) else [values]
+    return [dict(zip(grid, values)) for values in product(*grid.values())]
+
+
+def validate_sweep_config(args: ConfigParams) -> None:
+    """
+    Reject the settings of a configuration file that a sweep does not support.
+
+    A sweep segments whole scenes, without skipping any, so `tile_size` and
+    `min_usable_fraction` would be silently ignored.
+    """
+    if args.tile_size is not None:
+        raise ValueError("sweep does not support tile_size")
+    if args.min_usable_fraction:
+        raise ValueError("sweep does not support min_usable_fraction")
+
+
+def get_sweep_direc(save_direc: Path, settings: dict) -> Path:
+    """The output directory of a combination of settings."""
+    return save_direc / (
+        f"itmax{settings['itmax']}_itmin{settings['itmin']}_step{settings['step']}"
+        f"_{settings['kernel_type']}{settings['kernel_size']}"
+    )
+
+
+def get_cache_settings(args: ConfigParams) -> dict:
+    """The settings that change the outputs of a scene."""
+    return {
+        "save_figs": args.save_figs,
+        "threshold_method": args.threshold_method,
+        "output_format": args.output_format,
+        "min_usable_fraction": args.min_usable_fraction,
+        "label_compress": args.label_compress,
+        "itmax": args.itmax,
+        "itmin": args.itmin,
+        "step": args.step,
+        "kernel_type": args.kernel_type,
+        "kernel_size": args.kernel_size,
+    }
+
+
+def get_scene_filters(args: ConfigParams) -> dict:
+    """The filters of `SceneIndex.select` selecting the scenes of a run."""
+    doys = None
+    if args.doy_range is not None:
+        doys = range(args.doy_range[0], args.doy_range[1] + 1)
+    return {
+        "start": args.start_date,
+        "end": args.end_date,
+        "satellites": args.satellites,
+        "doys": doys,
+    }
+
+
+def get_scene_pairs(
+    args: ConfigParams, rescan: bool = False
+) -> list[tuple[Path, Path]]:
+    """
+    List the (ftci, fcloud) pairs of the scenes a run selects, reporting
+    unpaired files.
+
+    The inputs are listed with the `SceneIndex` saved in save_direc, which is
+    updated incrementally unless `rescan`.
+    """
+    index = SceneIndex(args.data_direc, args.save_direc / INDEX_FILE).scan(rescan)
+    pairs, unpaired = index.pairs(**get_scene_filters(args))
+    for path in unpaired:
+        typer.echo(f"no scene pair for {path}", err=True)
+    return pairs
+
+
+def get_scene_job(
+    args: ConfigParams,
+    ftci: Path,
+    fcloud: Path,
+    profile_prefix: Optional[Path] = None,
+    background_writes: bool = True,
+    scene_threads: int = 1,
+    hash_inputs: bool = True,
+    mask_values_file: str = MASK_VALUES_FILE,
+) -> tuple:
+    """The arguments of `preprocess_scene` for a scene of a run."""
+    return (
+        ftci,
+        fcloud,
+        profile_prefix,
+        hash_inputs,
+        args.itmax,
+        args.itmin,
+        args.step,
+        args.kernel_type,
+        args.kernel_size,
+        args.save_figs,
+        args.save_direc,
+        args.tile_size,
+        args.threshold_method,
+        args.output_format,
+        background_writes,
+        args.min_usable_fraction,
+        scene_threads,
+        args.label_compress,
+        mask_values_file,
+    )
+
+
 @app.command(name="process-images", help=help, epilog=epilog)
 def process_images(
     config_file: Path = typer.Option(
@@ -83,7 +536,53 @@ def process_images(
     ),
     max_workers: Optional[int] = typer.Option(
         None,
-        help="The maximum number of workers. If None, uses all available processors.",
+        min=1,
+        help="The maximum number of workers. If None, uses as many as fit in memory.",
+    ),
+    shard_index: int = typer.Option(
+        0, help="The shard of the scenes to process, from 0 to shard-count - 1."
+    ),
+    shard_count: int = typer.Option(
+        1,
+        help="Split the scenes into this many shards, e.g. one per job of an array.",
+    ),
+    force: bool = typer.Option(
+        False, help="Reprocess scenes whose outputs are valid for their inputs."
+    ),
+    profile_scene: Optional[str] = typer.Option(
+        None,
+        help="Profile the scene with this TCI file name with cProfile and "
+        "tracemalloc, writing the results to save_direc/profiles.",
+    ),
+    read_ahead: int = typer.Option(
+        2,
+        help="Queue this many scenes for the workers and read their files in "
+        "the background, so the workers open them from the page cache. 0 "
+        "disables the reads.",
+    ),
+    background_writes: bool = typer.Option(
+        True, help="Write the outputs of a scene in a background thread."
+    ),
+    scene_threads: int = typer.Option(
+        1,
+        min=1,
+        help="Segment the separate clusters of ice of a scene on this many "
+        "threads, so a large scene uses more than one core. Not used with "
+        "tile_size.",
+    ),
+    rescan: bool = typer.Option(
+        False,
+        help="List and stat all input files again instead of updating the "
+        "index in save_direc.",
+    ),
+    executor: str = typer.Option(
+        "process",
+        callback=validate_executor,
+        help="Run the workers as processes, as threads of one process, or as "
+        "hybrid processes of several threads.",
+    ),
+    threads_per_process: int = typer.Option(
+        2, min=1, help="The threads of each process of the hybrid executor."
     ),
 ):
 
@@ -93,43 +592,422 @@ def process_images(
 
     # create output directory
     save_direc.mkdir(exist_ok=True, parents=True)
+    # status, duration, peak memory, stages and floe counts of each scene;
+    # shards append to files of their own, merged by merge-shards
+    metrics_path = save_direc / get_shard_fname(METRICS_FILE, shard_index, shard_count)
+    mask_values_file = get_shard_fname(MASK_VALUES_FILE, shard_index, shard_count)
 
     # ## land mask
     # this is the same landmask as the original IFT- can be downloaded w SOIT
-    land_mask = create_land_mask(args.land)
+    land_masks = get_land_masks(args.land)
 
     # ## load files
-    data_direc = args.data_direc
-    ftci_direc = data_direc / "tci/"
-    fcloud_direc = data_direc / "cloud/"
+    pairs = get_shard(get_scene_pairs(args, rescan), shard_index, shard_count)
+    manifest = None
+    if shard_count > 1:
+        manifest = ShardManifest(save_direc, shard_index, shard_count, pairs)
 
-    # option to save figs after each step
-    save_figs = args.save_figs
+    # skip scenes already processed with the same inputs and settings
+    cache = SceneCache(
+        save_direc, args.land, get_cache_settings(args), mask_values_file
+    )
+    if not force:
+        cached, uncached = [], []
+        for pair in pairs:
+            (cached if cache.is_valid(*pair) else uncached).append(pair)
+        if manifest is not None and cached:
+            manifest.add(*cached)
+        for pair in cached:
+            append_metrics(
+                metrics_path,
+                {
+                    "scene": pair[0].name,
+                    "fcloud": pair[1].name,
+                    "status": "skipped",
+                    "skip_reason": SKIP_CACHED,
+                },
+            )
+            typer.echo(f"skipped {pair[0].name}: outputs up to date")
+        pairs = uncached
 
-    ftcis = sorted(Path(ftci_direc).iterdir())
-    fclouds = sorted(Path(fcloud_direc).iterdir())
+    if max_workers is None:
+        max_workers = get_default_workers([ftci for ftci, _ in pairs], args.tile_size)
 
-    with ProcessPoolExecutor() as executor:
-        futures = []
-        for ftci, fcloud in zip(ftcis, fclouds):
-            future = executor.submit(
-                preprocess,
-                ftci,
-                fcloud,
-                land_mask,
-                args.itmax,
-                args.itmin,
-                args.step,
-                args.kernel_type,
-                args.kernel_size,
-                save_figs,
-                save_direc,
+    def get_profile_prefix(ftci):
+        if profile_scene in (ftci.name, ftci.stem):
+            return save_direc / PROFILE_DIREC / ftci.stem
+        return None
+
+    jobs = [
+        get_scene_job(
+            args,
+            ftci,
+            fcloud,
+            get_profile_prefix(ftci),
+            background_writes,
+            scene_threads,
+            not cache.has_digests(ftci, fcloud),
+            mask_values_file,
+        )
+        for ftci, fcloud in pairs
+    ]
+
+    with TemporaryDirectory(dir=save_direc) as tmp:
+        static_files = save_static_inputs(Path(tmp), **land_masks)
+        del land_masks
+
+        with (
+            get_scene_executor(
+                executor, max_workers, static_files, threads_per_process
+            ) as pool,
+            ThreadPoolExecutor(max_workers=2) as io_executor,
+        ):
+            submitted = jobs
+            if read_ahead:
+                submitted = prefetch(io_executor, jobs, skip=max_workers)
+            # a job submitted now waits behind read_ahead others, and at least
+            # one job waits for each worker that finishes
+            completed = submit_bounded(
+                pool,
+                preprocess_scene,
+                submitted,
+                max_in_flight=max_workers + max(read_ahead, 1),
             )
-            futures.append(future)
+            for n, (job, future) in enumerate(completed, start=1):
+                record = future.result()
+                digests = record.pop("inputs", None)
+                append_metrics(metrics_path, record)
+                if record["status"] == "error":
+                    raise RuntimeError(
+                        f"Error processing {job[0].name} in stage "
+                        f"{record['failed_stage']}: {record['error']}"
+                    )
+                cache.add(*job[:2], digests)
+                if manifest is not None:
+                    manifest.add(job[:2])
+                typer.echo(f"[{n}/{len(jobs)}] processed {job[0].name}")
+
+    # a sharded run is collected by merge-shards once all shards are done
+    if args.output_format == "parquet" and shard_count == 1:
+        collect_dataset(save_direc)
+
+
+@app.command(name="watch")
+def watch(
+    config_file: Path = typer.Option(
+        ...,
+        "--config-file",
+        "-c",
+        help="Path to configuration file",
+    ),
+    max_workers: Optional[int] = typer.Option(
+        None,
+        min=1,
+        help="The number of workers. If None, uses as many as fit the scenes "
+        "already delivered in memory.",
+    ),
+    max_queued: Optional[int] = typer.Option(
+        None,
+        min=1,
+        help="The number of scenes given to the workers at a time; later "
+        "scenes wait on disk. Defaults to twice the workers.",
+    ),
+    poll_interval: float = typer.Option(
+        5.0, min=0, help="Seconds between scans of the data directory."
+    ),
+    settle_seconds: float = typer.Option(
+        5.0,
+        min=0,
+        help="Process a file once it has not been modified for this long, so "
+        "files being copied are not read.",
+    ),
+    max_scenes: Optional[int] = typer.Option(
+        None, min=1, help="Stop after processing this many scenes."
+    ),
+    force: bool = typer.Option(
+        False, help="Reprocess scenes whose outputs are valid for their inputs."
+    ),
+    background_writes: bool = typer.Option(
+        True, help="Write the outputs of a scene in a background thread."
+    ),
+    scene_threads: int = typer.Option(
+        1,
+        min=1,
+        help="Segment the separate clusters of ice of a scene on this many "
+        "threads. Not used with tile_size.",
+    ),
+    executor: str = typer.Option(
+        "process",
+        callback=validate_executor,
+        help="Run the workers as processes, as threads of one process, or as "
+        "hybrid processes of several threads.",
+    ),
+    threads_per_process: int = typer.Option(
+        2, min=1, help="The threads of each process of the hybrid executor."
+    ),
+):
+    """
+    Process the scenes delivered to data_direc as they arrive, until stopped.
+
+    TCI and cloud files are paired by the date and satellite in their names,
+    and only the scenes selected by the filters of the configuration file are
+    processed. The workers are started with the land mask loaded before the first scene
+    arrives. The latency of each scene, from the arrival of its last file to
+    the end of its processing, is recorded in save_direc/metrics.jsonl.
+    SIGTERM stops the watch once the scenes being processed are done.
+    """
+    from ebfloeseg.watch import SceneWatcher
+
+    args = parse_config_file(config_file)
+    save_direc = args.save_direc
+    save_direc.mkdir(exist_ok=True, parents=True)
+    metrics_path = save_direc / METRICS_FILE
+    land_masks = get_land_masks(args.land)
+    cache = SceneCache(save_direc, args.land, get_cache_settings(args))
+    watcher = SceneWatcher(
+        args.data_direc,
+        settle_seconds,
+        filters=get_scene_filters(args),
+        index_path=save_direc / INDEX_FILE,
+    )
+
+    if max_workers is None:
+        delivered = [ftci for ftci, _ in get_scene_pairs(args)]
+        max_workers = get_default_workers(delivered, args.tile_size)
+    if max_queued is None:
+        max_queued = 2 * max_workers
+
+    def record_scene(arrival, record):
+        digests = record.pop("inputs", None)
+        record["arrived"] = datetime.fromtimestamp(
+            arrival.arrived, timezone.utc
+        ).isoformat()
+        record["latency_seconds"] = time.time() - arrival.arrived
+        append_metrics(metrics_path, record)
+        if record["status"] == "error":
+            typer.echo(
+                f"error processing {arrival.ftci.name} in stage "
+                f"{record['failed_stage']}: {record['error']}",
+                err=True,
+            )
+            return
+        cache.add(arrival.ftci, arrival.fcloud, digests)
+        typer.echo(
+            f"processed {arrival.ftci.name} "
+            f"{record['latency_seconds']:.1f} s after arrival"
+        )
+
+    stopping = threading.Event()
+    submitted = 0
+
+    def accepting():
+        return not stopping.is_set() and (max_scenes is None or submitted < max_scenes)
+
+    previous_handler = signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    try:
+        with (
+            TemporaryDirectory(dir=save_direc) as tmp,
+            get_scene_executor(
+                executor,
+                max_workers,
+                save_static_inputs(Path(tmp), **land_masks),
+                threads_per_process,
+                warm=True,
+            ) as pool,
+        ):
+            del land_masks
+            wait([pool.submit(worker_ready) for _ in range(max_workers)])
+            typer.echo(f"watching {args.data_direc} with {max_workers} workers")
+
+            ready = deque()  # scenes found, waiting for a worker
+            pending = {}
+            while accepting() or pending:
+                if accepting():
+                    # scenes beyond the queue are left on disk for later polls
+                    for arrival in watcher.poll(max_queued - len(ready)):
+                        if not force and cache.is_valid(arrival.ftci, arrival.fcloud):
+                            typer.echo(
+                                f"skipped {arrival.ftci.name}: outputs up to date"
+                            )
+                        else:
+                            ready.append(arrival)
+                while ready and len(pending) < max_queued and accepting():
+                    arrival = ready.popleft()
+                    job = get_scene_job(
+                        args,
+                        arrival.ftci,
+                        arrival.fcloud,
+                        background_writes=background_writes,
+                        scene_threads=scene_threads,
+                        hash_inputs=not cache.has_digests(arrival.ftci, arrival.fcloud),
+                    )
+                    pending[pool.submit(preprocess_scene, *job)] = arrival
+                    submitted += 1
+
+                if not pending:
+                    stopping.wait(poll_interval)
+                    continue
+                done, _ = wait(
+                    pending, timeout=poll_interval, return_when=FIRST_COMPLETED
+                )
+                for future in done:
+                    record_scene(pending.pop(future), future.result())
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+
+    if args.output_format == "parquet":
+        collect_dataset(save_direc)
+
+
+@app.command(name="merge-shards")
+def merge_shards(
+    config_file: Path = typer.Option(
+        ...,
+        "--config-file",
+        "-c",
+        help="Path to configuration file",
+    ),
+    shard_count: int = typer.Option(..., help="The number of shards of the run."),
+):
+    """
+    Combine the manifests of a sharded run and report missing scenes.
+
+    The metrics and mask values files of the shards are concatenated into
+    those of the run. With the parquet output format, also collect the
+    dataset written by the shards.
+    """
+    args = parse_config_file(config_file)
+    manifest = merge_manifests(args.save_direc, shard_count, get_scene_pairs(args))
+    merge_shard_files(args.save_direc, shard_count)
+    if args.output_format == "parquet":
+        collect_dataset(args.save_direc)
+
+    if manifest["missing_shards"]:
+        typer.echo(f"no manifest for shards {manifest['missing_shards']}")
+    for scene in manifest["missing"]:
+        typer.echo(f"missing {Path(scene['ftci']).name}")
+    typer.echo(
+        f"{len(manifest['completed'])} of "
+        f"{len(manifest['completed']) + len(manifest['missing'])} scenes completed"
+    )
+    if manifest["missing"]:
+        raise typer.Exit(code=1)
+
+
+@app.command(name="sweep")
+def sweep(
+    config_file: Path = typer.Option(
+        ...,
+        "--config-file",
+        "-c",
+        help="Path to configuration file, with the grid in its [sweep] table",
+    ),
+    max_workers: Optional[int] = typer.Option(
+        None,
+        min=1,
+        help="The maximum number of workers. If None, uses as many as fit in memory.",
+    ),
+    executor: str = typer.Option(
+        "process",
+        callback=validate_executor,
+        help="Run the workers as processes, as threads of one process, or as "
+        "hybrid processes of several threads.",
+    ),
+    threads_per_process: int = typer.Option(
+        2, min=1, help="The threads of each process of the hybrid executor."
+    ),
+):
+    """
+    Segment every scene with each combination of erosion settings.
+
+    The masks and mask values do not depend on the erosion settings, so they
+    are computed once per scene and written to save_direc/<doy>. Each
+    combination writes its outputs to its own save_direc/<settings>/<doy>.
+
+    Every scene is segmented again with each combination: a sweep neither
+    reads nor updates the cache of process-images, and writes no metrics.
+    """
+
+    args = parse_config_file(config_file)
+    validate_sweep_config(args)
+    grid = parse_sweep(config_file, args)
+    save_direc = args.save_direc
+    save_direc.mkdir(exist_ok=True, parents=True)
+    land_masks = get_land_masks(args.land)
+    pairs = get_scene_pairs(args)
+
+    if max_workers is None:
+        max_workers = get_default_workers([ftci for ftci, _ in pairs])
+
+    with TemporaryDirectory(dir=save_direc) as tmp:
+        static_files = save_static_inputs(Path(tmp), **land_masks)
+        del land_masks
+
+        with get_scene_executor(
+            executor, max_workers, static_files, threads_per_process
+        ) as pool:
+            pending = {}
+            remaining = {}  # number of combinations left for each prepared scene
+            scenes = iter(enumerate(pairs))
+
+            def submit_prepare():
+                for n, (ftci, fcloud) in scenes:
+                    prepared_direc = Path(tmp) / str(n)
+                    future = pool.submit(
+                        prepare_sweep_scene,
+                        ftci,
+                        fcloud,
+                        args.save_figs,
+                        save_direc,
+                        prepared_direc,
+                        args.threshold_method,
+                        args.output_format,
+                    )
+                    pending[future] = (ftci, fcloud, prepared_direc, None)
+                    return
+
+            # prepare at most max_workers scenes ahead, to bound the scratch space
+            for _ in range(max_workers):
+                submit_prepare()
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    ftci, fcloud, prepared_direc, settings = pending.pop(future)
+                    result = future.result()
+                    if settings is None:
+                        remaining[prepared_direc] = len(grid)
+                        for combination in grid:
+                            future = pool.submit(
+                                segment_sweep_scene,
+                                ftci,
+                                fcloud,
+                                result,
+                                combination,
+                                args.save_figs,
+                                get_sweep_direc(save_direc, combination),
+                                args.output_format,
+                                args.label_compress,
+                            )
+                            pending[future] = (
+                                ftci,
+                                fcloud,
+                                prepared_direc,
+                                combination,
+                            )
+                        continue
+
+                    sweep_direc = get_sweep_direc(save_direc, settings)
+                    typer.echo(f"processed {ftci.name} in {sweep_direc.name}")
+                    remaining[prepared_direc] -= 1
+                    if remaining[prepared_direc] == 0:
+                        rmtree(prepared_direc)
+                        submit_prepare()
 
-        # Wait for all threads to complete
-        for future in futures:
-            future.result()
+    if args.output_format == "parquet":
+        collect_dataset(save_direc)  # the mask values
+        for combination in grid:
+            collect_dataset(get_sweep_direc(save_direc, combination))
 
 
 if __name__ == "__main__":
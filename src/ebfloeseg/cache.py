@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Optional
+
+from ebfloeseg.outputs import MASK_VALUES_FILE, get_partition_path
+from ebfloeseg.utils import getmeta, getres
+
+CACHE_DIREC = "cache"
+
+
+def hash_file(path: Path) -> str:
+    """Return the BLAKE2b digest of a file's contents."""
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "blake2b").hexdigest()
+
+
+def get_stat(path: Path) -> list[int]:
+    """Return the size and modification time of a file, to detect changes."""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def get_input_digests(*paths: Path) -> dict[str, dict]:
+    """
+    Hash input files, e.g. in the worker processing them, for `SceneCache.add`.
+
+    Returns:
+        dict[str, dict]: The size, mtime and digest of each file by path.
+    """
+    return {str(p): {"stat": get_stat(p), "digest": hash_file(p)} for p in paths}
+
+
+def get_scene_outputs(
+    save_direc: Path,
+    fcloud: Path,
+    output_format: str = "csv",
+    mask_values_file: str = MASK_VALUES_FILE,
+) -> dict[str, list[Path]]:
+    """
+    List the outputs that make a processed scene valid.
+
+    Args:
+        save_direc (Path): The output directory of the run.
+        fcloud (Path): The cloud file of the scene.
+        output_format (str, optional): The format of the props and mask
+            values. Defaults to "csv".
+        mask_values_file (str, optional): The mask values file the scene
+            appends to, e.g. that of its shard. Defaults to MASK_VALUES_FILE.
+
+    Returns:
+        dict[str, list[Path]]: The outputs owned by the scene, which must be
+        unchanged, and the ones shared with other scenes of the same day,
+        which must exist.
+    """
+    doy, year, sat = getmeta(fcloud)
+    res = getres(doy, year)
+    direc = Path(save_direc) / doy
+    if output_format == "parquet":
+        return {
+            "owned": [
+                direc / f"{res}_{sat}_final.tif",
+                get_partition_path(save_direc, "props", year, doy, sat),
+                get_partition_path(save_direc, "mask_values", year, doy, sat),
+            ],
+            "shared": [],
+        }
+    return {
+        "owned": [direc / f"{res}_{sat}_final.tif", direc / f"{res}_{sat}_props.csv"],
+        "shared": [direc / mask_values_file],
+    }
+
+
+class SceneCache:
+    """
+    Records of the scenes a run has processed, keyed by the hash of their
+    inputs and settings.
+
+    A scene is skipped when its key is unchanged and its outputs are intact.
+    Input digests are reused while the size and mtime of a file are unchanged,
+    so checking a large archive does not rehash it. The mask values of the
+    scenes are appended to `mask_values_file`, e.g. that of a shard.
+    """
+
+    def __init__(
+        self,
+        save_direc: Path,
+        land: Path,
+        settings: dict,
+        mask_values_file: str = MASK_VALUES_FILE,
+    ):
+        self.save_direc = Path(save_direc)
+        self.direc = self.save_direc / CACHE_DIREC
+        self.direc.mkdir(exist_ok=True, parents=True)
+        self.land_digest = hash_file(land)
+        self.settings = settings
+        self.output_format = settings.get("output_format", "csv")
+        self.mask_values_file = mask_values_file
+        self._digests = {}  # digests computed by this run, with the stat they match
+
+    def _record_path(self, fcloud: Path) -> Path:
+        doy, year, sat = getmeta(fcloud)
+        return self.direc / f"{year}-{doy}-{sat}.json"
+
+    def _load(self, fcloud: Path) -> Optional[dict]:
+        try:
+            return json.loads(self._record_path(fcloud).read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _digest(self, path: Path, record: Optional[dict]) -> dict:
+        stat = get_stat(path)
+        inputs = dict((record or {}).get("inputs", {}), **self._digests)
+        cached = inputs.get(str(path))
+        if cached is None or cached["stat"] != stat:
+            cached = {"stat": stat, "digest": hash_file(path)}
+        self._digests[str(path)] = cached
+        return cached
+
+    def get_key(self, ftci: Path, fcloud: Path, record: Optional[dict] = None) -> str:
+        """
+        Return the key of a scene: its inputs, the land mask and settings.
+
+        The digests of the scene's `record`, loaded if not given, are reused.
+        """
+        if record is None:
+            record = self._load(fcloud)
+        key = {
+            "tci": self._digest(ftci, record)["digest"],
+            "cloud": self._digest(fcloud, record)["digest"],
+            "land": self.land_digest,
+            "settings": self.settings,
+        }
+        return hashlib.blake2b(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def has_digests(self, ftci: Path, fcloud: Path) -> bool:
+        """Whether the digests of a scene's inputs are known, e.g. from `is_valid`."""
+        return all(
+            str(p) in self._digests and self._digests[str(p)]["stat"] == get_stat(p)
+            for p in (ftci, fcloud)
+        )
+
+    def is_valid(self, ftci: Path, fcloud: Path) -> bool:
+        """Whether a scene was processed with the same key and its outputs are intact."""
+        record = self._load(fcloud)
+        if record is None or record["key"] != self.get_key(ftci, fcloud, record):
+            return False
+        outputs = get_scene_outputs(
+            self.save_direc, fcloud, self.output_format, self.mask_values_file
+        )
+        try:
+            owned = {str(p): get_stat(p) for p in outputs["owned"]}
+        except FileNotFoundError:
+            return False
+        return owned == record["outputs"] and all(p.exists() for p in outputs["shared"])
+
+    def add(self, ftci: Path, fcloud: Path, digests: Optional[dict] = None) -> None:
+        """
+        Record a scene processed successfully.
+
+        Args:
+            ftci (Path): The TCI file of the scene.
+            fcloud (Path): The cloud file of the scene.
+            digests (dict, optional): The digests of its inputs from
+                `get_input_digests`, so they are not hashed again here.
+                Defaults to None, those known from `is_valid`, or hashed now.
+        """
+        self._digests.update(digests or {})
+        record = self._load(fcloud)
+        outputs = get_scene_outputs(
+            self.save_direc, fcloud, self.output_format, self.mask_values_file
+        )
+        record = {
+            "key": self.get_key(ftci, fcloud, record),
+            "inputs": {str(p): self._digest(p, record) for p in (ftci, fcloud)},
+            "outputs": {str(p): get_stat(p) for p in outputs["owned"]},
+        }
+        path = self._record_path(fcloud)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(record, indent=2))
+        os.replace(tmp, path)
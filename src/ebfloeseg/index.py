@@ -0,0 +1,240 @@
+import json
+import os
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from datetime import date
+from pathlib import Path
+from typing import Container, Iterable, Optional
+
+from ebfloeseg.utils import getmeta, getres, pair_scenes
+
+# the index of the inputs of a run, in its save_direc
+INDEX_FILE = "scene_index.json"
+INDEX_VERSION = 1
+
+# the subdirectories of data_direc holding each kind of input
+KINDS = ("tci", "cloud")
+
+# directories modified this recently are listed again by the next scan, as
+# files added within the resolution of their mtime would not change it
+MTIME_SLACK_NS = 2 * 10**9
+
+
+@dataclass(frozen=True)
+class IndexedFile:
+    """An input file of a scene, with the metadata in its name and its stat."""
+
+    path: Path
+    kind: str  # one of KINDS
+    sat: str
+    date: str  # YYYY-MM-DD
+    doy: str
+    size: int
+    mtime_ns: int
+    inode: int
+
+    @property
+    def key(self) -> tuple[str, str, str]:
+        """The (doy, year, sat) of the scene, as from `getmeta`."""
+        return self.doy, self.date[:4], self.sat
+
+
+def _index_file(entry: os.DirEntry, kind: str) -> Optional[IndexedFile]:
+    # None for files whose names hold no scene metadata
+    try:
+        doy, year, sat = getmeta(entry.name)
+        res = getres(doy, year)
+    except (IndexError, ValueError):
+        return None
+    stat = entry.stat()
+    return IndexedFile(
+        Path(entry.path),
+        kind,
+        sat,
+        res,
+        doy,
+        stat.st_size,
+        stat.st_mtime_ns,
+        stat.st_ino,
+    )
+
+
+class SceneIndex:
+    """
+    The input files of an archive: the TCI and cloud files under
+    `data_direc/tci` and `data_direc/cloud`, subdirectories included.
+
+    The index is saved to `path` by each scan. A later scan, by this index or
+    by a new one loading the saved index, only lists the directories whose
+    mtime changed, i.e. where files were added, removed or renamed, and only
+    stats their new entries, so rescanning a large archive on a slow
+    filesystem costs little more than a stat per directory. Files rewritten in
+    place keep their old size and mtime until a `full` scan.
+    """
+
+    def __init__(self, data_direc: Path, path: Optional[Path] = None):
+        self.data_direc = Path(data_direc)
+        self.path = None if path is None else Path(path)
+        self.files: list[IndexedFile] = []
+        self.ignored: list[Path] = []  # files whose names hold no scene metadata
+        self._directories: dict[str, dict] = {}
+
+    def _load(self) -> dict:
+        try:
+            saved = json.loads(self.path.read_text())
+        except (AttributeError, FileNotFoundError, json.JSONDecodeError):
+            return {}
+        if (saved.get("version"), saved.get("data_direc")) != (
+            INDEX_VERSION,
+            str(self.data_direc.resolve()),
+        ):
+            return {}
+        return saved["directories"]
+
+    def _save(self) -> None:
+        saved = {
+            "version": INDEX_VERSION,
+            "data_direc": str(self.data_direc.resolve()),
+            "directories": self._directories,
+        }
+        # shards of a run may scan at once, on several hosts, each replacing
+        # the index whole from a temporary file of its own
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        fd, tmp = tempfile.mkstemp(
+            suffix=".tmp", prefix=f"{self.path.name}.", dir=self.path.parent
+        )
+        with os.fdopen(fd, "w") as f:
+            f.write(json.dumps(saved))
+        os.replace(tmp, self.path)
+
+    def scan(self, full: bool = False, save: bool = True) -> "SceneIndex":
+        """
+        List the input files, reusing the index of the previous scan, or else
+        the saved index, where it is current. `files` is only replaced if
+        files were added, removed or renamed.
+
+        Args:
+            full (bool, optional): List every directory and stat every file
+                again. Defaults to False.
+            save (bool, optional): Save the index to `path` if it changed.
+                Defaults to True.
+
+        Returns:
+            SceneIndex: The index itself.
+        """
+        reuse = not full and bool(self._directories)
+        if reuse:
+            saved = self._directories
+        else:
+            saved = {} if full else self._load()
+        self._directories = {}
+        for kind in KINDS:
+            direc = self.data_direc / kind
+            if direc.is_dir():
+                self._scan_directory(direc, kind, saved)
+
+        # directories listed again or gone
+        changed = self._directories.keys() != saved.keys() or any(
+            directory is not saved[direc]
+            for direc, directory in self._directories.items()
+        )
+        if changed or not reuse:
+            records, ignored = [], []
+            for directory in self._directories.values():
+                records += directory["files"].values()
+                ignored += directory["ignored"]
+            records.sort(key=lambda record: record["path"])
+            self.files = [
+                IndexedFile(**dict(record, path=Path(record["path"])))
+                for record in records
+            ]
+            self.ignored = [Path(path) for path in sorted(ignored)]
+
+        if self.path is not None and save and changed:
+            self._save()
+        return self
+
+    def _scan_directory(self, direc: Path, kind: str, saved: dict) -> None:
+        mtime_ns = os.stat(direc).st_mtime_ns
+        previous = saved.get(str(direc))
+        if previous is not None and previous["mtime_ns"] == mtime_ns:
+            directory = previous
+        else:
+            old_files = {} if previous is None else previous["files"]
+            directory = {
+                "mtime_ns": (
+                    None if time.time_ns() - mtime_ns < MTIME_SLACK_NS else mtime_ns
+                ),
+                "subdirs": [],
+                "files": {},
+                "ignored": [],
+            }
+            with os.scandir(direc) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir():
+                        directory["subdirs"].append(entry.path)
+                        continue
+                    old = old_files.get(entry.name)
+                    if old is not None and old["inode"] == entry.inode():
+                        directory["files"][entry.name] = old
+                    elif (indexed := _index_file(entry, kind)) is None:
+                        directory["ignored"].append(entry.path)
+                    else:
+                        directory["files"][entry.name] = dict(
+                            asdict(indexed), path=entry.path
+                        )
+        self._directories[str(direc)] = directory
+        for subdir in directory["subdirs"]:
+            self._scan_directory(Path(subdir), kind, saved)
+
+    def select(
+        self,
+        start: Optional[date] = None,
+        end: Optional[date] = None,
+        satellites: Optional[Iterable[str]] = None,
+        doys: Optional[Container[int]] = None,
+    ) -> list[IndexedFile]:
+        """
+        Filter the files by their scenes.
+
+        Args:
+            start (date, optional): The first date. Defaults to None.
+            end (date, optional): The last date, included. Defaults to None.
+            satellites (Iterable[str], optional): The satellites. Defaults to
+                None, all of them.
+            doys (Container[int], optional): The days of year, e.g. a range.
+                Defaults to None, all of them.
+
+        Returns:
+            list[IndexedFile]: The files of the selected scenes.
+        """
+        satellites = None if satellites is None else set(satellites)
+        return [
+            f
+            for f in self.files
+            if (start is None or f.date >= start.isoformat())
+            and (end is None or f.date <= end.isoformat())
+            and (satellites is None or f.sat in satellites)
+            and (doys is None or int(f.doy) in doys)
+        ]
+
+    def pairs(self, **filters) -> tuple[list[tuple[Path, Path]], list[Path]]:
+        """
+        Pair the TCI and cloud files of the selected scenes by their keys.
+
+        Args:
+            **filters: The filters of `select`.
+
+        Returns:
+            tuple[list[tuple[Path, Path]], list[Path]]: The (ftci, fcloud) pairs
+            in the order of the TCI paths, and the selected files without a
+            partner.
+        """
+        selected = self.select(**filters)
+        return pair_scenes(
+            [f.path for f in selected if f.kind == "tci"],
+            [f.path for f in selected if f.kind == "cloud"],
+        )
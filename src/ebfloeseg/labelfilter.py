@@ -0,0 +1,96 @@
+import numpy as np
+from numpy.typing import NDArray
+
+# lookup tables are indexed by label + LUT_OFFSET, so the watershed
+# boundary label -1 has an entry
+LUT_OFFSET = 1
+
+
+def get_label_areas(labels: NDArray, max_label: int) -> NDArray[np.int64]:
+    """
+    Count the pixels of each label.
+
+    Args:
+        labels (NDArray): The labelled image, with labels >= -1.
+        max_label (int): The largest label that may occur, e.g. over all tiles
+            of a scene.
+
+    Returns:
+        NDArray[np.int64]: The area of each label, indexed by label + LUT_OFFSET.
+    """
+    return np.bincount(
+        labels.ravel() + LUT_OFFSET, minlength=max_label + 1 + LUT_OFFSET
+    )
+
+
+def get_labels_in_mask(
+    labels: NDArray, mask: NDArray[np.bool_], max_label: int
+) -> NDArray[np.bool_]:
+    """
+    Find the labels having at least one pixel in a mask.
+
+    Args:
+        labels (NDArray): The labelled image, with labels >= -1.
+        mask (NDArray[np.bool_]): The pixels to look at.
+        max_label (int): The largest label that may occur.
+
+    Returns:
+        NDArray[np.bool_]: Lookup table of the labels found, indexed by
+        label + LUT_OFFSET.
+    """
+    lut = np.zeros(max_label + 1 + LUT_OFFSET, dtype=bool)
+    lut[labels[mask] + LUT_OFFSET] = True
+    return lut
+
+
+def get_small_labels(areas: NDArray[np.int64], area_lim: int) -> NDArray[np.bool_]:
+    """
+    Find the regions smaller than an area limit.
+
+    Only positive labels are regions, as with `skimage.measure.regionprops`.
+
+    Args:
+        areas (NDArray[np.int64]): The areas from `get_label_areas`.
+        area_lim (int): The smallest area kept.
+
+    Returns:
+        NDArray[np.bool_]: Lookup table of the small labels, indexed by
+        label + LUT_OFFSET.
+    """
+    small = areas < area_lim
+    small[: LUT_OFFSET + 1] = False
+    return small
+
+
+def filter_labels(labels: NDArray, reject: NDArray[np.bool_], val: int = 1) -> NDArray:
+    """
+    Replace the rejected labels of an image inplace.
+
+    Args:
+        labels (NDArray): The labelled image, with labels >= -1.
+        reject (NDArray[np.bool_]): Lookup table of the labels to replace,
+            indexed by label + LUT_OFFSET.
+        val (int, optional): The replacement label. Defaults to 1.
+
+    Returns:
+        NDArray: The filtered image.
+    """
+    labels[reject[labels + LUT_OFFSET]] = val
+    return labels
+
+
+def get_max_label(areas: NDArray[np.int64], reject: NDArray[np.bool_]) -> int:
+    """
+    Find the largest label left by `filter_labels` with the default value.
+
+    Args:
+        areas (NDArray[np.int64]): The areas from `get_label_areas`.
+        reject (NDArray[np.bool_]): Lookup table of the labels to replace,
+            indexed by label + LUT_OFFSET.
+
+    Returns:
+        int: The largest label, or -1 for an empty image.
+    """
+    kept = (areas > 0) & ~reject
+    kept[1 + LUT_OFFSET] |= np.any((areas > 0) & reject)
+    return int(np.flatnonzero(kept)[-1]) - LUT_OFFSET if kept.any() else -1
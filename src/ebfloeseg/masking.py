@@ -3,6 +3,10 @@ from pathlib import Path
 import numpy as np
 from numpy.typing import NDArray
 import rasterio
+from rasterio import DatasetReader
+from rasterio.windows import Window
+
+from ebfloeseg.metrics import timed
 
 
 def mask_image(img: NDArray, mask: NDArray, val=0) -> NDArray:
@@ -21,6 +25,7 @@ def mask_image(img: NDArray, mask: NDArray, val=0) -> NDArray:
     return img
 
 
+@timed("read_mask")
 def create_land_mask(lmfile: Path, val: int = 75) -> NDArray[np.bool_]:
     """
     Create a land mask from a raster file.
@@ -53,6 +58,23 @@ def create_cloud_mask(cloud_file: Path, val: int = 255) -> NDArray[np.bool_]:
     return cloud_mask
 
 
+@timed("read_mask")
+def read_mask_window(src: DatasetReader, window: Window, val: int) -> NDArray[np.bool_]:
+    """
+    Read a mask from a window of the first band of an open raster.
+
+    Args:
+        src (DatasetReader): The open land or cloud raster.
+        window (Window): The window to read.
+        val (int): The pixel value marking masked pixels.
+
+    Returns:
+        NDArray[np.bool_]: The mask of the window.
+    """
+    return src.read(1, window=window) == val
+
+
+@timed("mask")
 def maskrgb(rgb: NDArray, mask: NDArray) -> None:
     """
     Apply (inplace) a mask to each channel of an RGB image.
@@ -0,0 +1,327 @@
+import cProfile
+import json
+import resource
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from functools import wraps
+from pathlib import Path
+from time import perf_counter
+from typing import Callable, Iterator, Optional
+
+import numpy as np
+
+METRICS_FILE = "metrics.jsonl"
+
+# the "skip_reason" of a skipped scene: its outputs were up to date, or it
+# had too few unmasked pixels to segment, with the details in "skip_detail"
+SKIP_CACHED = "cached"
+SKIP_FOOTPRINT = "footprint"
+PROFILE_DIREC = "profiles"
+
+
+class StageRecorder:
+    """
+    Total duration and number of calls of each stage of a run.
+
+    Stages nest: a stage entered inside another is recorded as
+    "outer/inner", e.g. "round_0/watershed". Besides durations, the recorder
+    keeps the bytes of the arrays allocated by each stage, counts added under
+    the current stage (e.g. "round_0/filter/small_floes"), the stage an
+    exception was raised in and why a scene was skipped, if it was.
+
+    Several threads can record stages at once, see `bind_stages`: each has
+    its own current stage.
+    """
+
+    def __init__(self):
+        self.seconds: dict[str, float] = {}
+        self.calls: dict[str, int] = {}
+        self.allocated: dict[str, int] = {}
+        self.counts: dict[str, int] = {}
+        self.failed_stage: Optional[str] = None
+        self.skip_reason: Optional[str] = None
+        self.skip_detail: Optional[str] = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def _stack(self) -> list[str]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def enter(self, name: str) -> str:
+        self._stack.append(name)
+        return "/".join(self._stack)
+
+    def exit(self, path: str, seconds: float) -> None:
+        self._stack.pop()
+        with self._lock:
+            self.seconds[path] = self.seconds.get(path, 0.0) + seconds
+            self.calls[path] = self.calls.get(path, 0) + 1
+
+    def fail(self, path: str) -> None:
+        with self._lock:
+            if self.failed_stage is None:
+                self.failed_stage = path
+
+    def allocate(self, nbytes: int) -> None:
+        path = "/".join(self._stack)
+        with self._lock:
+            self.allocated[path] = self.allocated.get(path, 0) + nbytes
+
+    def count(self, name: str, value: int) -> None:
+        path = "/".join(self._stack + [name])
+        with self._lock:
+            self.counts[path] = self.counts.get(path, 0) + int(value)
+
+    def as_records(self) -> list[dict]:
+        """The stages in the order they were first entered."""
+        return [
+            {
+                "stage": path,
+                "seconds": seconds,
+                "calls": self.calls[path],
+                "bytes": self.allocated.get(path, 0),
+            }
+            for path, seconds in self.seconds.items()
+        ]
+
+
+_recorder: ContextVar[Optional[StageRecorder]] = ContextVar("recorder", default=None)
+
+
+@contextmanager
+def record_stages() -> Iterator[StageRecorder]:
+    """Record the stages run inside the block."""
+    recorder = StageRecorder()
+    token = _recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorder.reset(token)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time the block as a stage, if stages are being recorded."""
+    recorder = _recorder.get()
+    if recorder is None:
+        yield
+        return
+    path = recorder.enter(name)
+    start = perf_counter()
+    try:
+        yield
+    except BaseException:
+        recorder.fail(path)
+        raise
+    finally:
+        recorder.exit(path, perf_counter() - start)
+
+
+def bind_stages(func: Callable) -> Callable:
+    """
+    Bind a function to the recorder and current stage of the caller, so its
+    stages are recorded when it is called in another thread, e.g. by an
+    executor or a `BackgroundWriter`. Threads do not inherit the context of
+    the thread starting them.
+
+    The stages of the function are nested in the stage current when
+    `bind_stages` is called, as if it were called there.
+    """
+    recorder = _recorder.get()
+    if recorder is None:
+        return func
+    outer = list(recorder._stack)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _recorder.set(recorder)
+        stack = getattr(recorder._local, "stack", None)
+        recorder._local.stack = list(outer)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if stack is None:
+                del recorder._local.stack
+            else:
+                recorder._local.stack = stack
+            _recorder.reset(token)
+
+    return wrapper
+
+
+def get_nbytes(obj) -> int:
+    """The bytes of an array, or of the arrays in a tuple or list."""
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (tuple, list)):
+        return sum(x.nbytes for x in obj if isinstance(x, np.ndarray))
+    return 0
+
+
+def add_allocation(nbytes: int) -> None:
+    """Add bytes allocated to the current stage, if stages are being recorded."""
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.allocate(nbytes)
+
+
+def add_count(name: str, value: int) -> None:
+    """Add to a count of the current stage, if stages are being recorded."""
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.count(name, value)
+
+
+def set_skip_reason(reason: str, detail: Optional[str] = None) -> None:
+    """
+    Record why the scene is skipped, e.g. SKIP_FOOTPRINT, with details, if
+    stages are being recorded.
+    """
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.skip_reason = reason
+        recorder.skip_detail = detail
+
+
+def timed(name: str) -> Callable:
+    """
+    Decorator timing each call of a function as a stage.
+
+    The arrays returned by the function are counted as allocated by the stage.
+    """
+
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                result = func(*args, **kwargs)
+                add_allocation(get_nbytes(result))
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+def reset_peak_rss() -> None:
+    """Reset the peak resident memory of the process, where Linux allows it."""
+    try:
+        Path("/proc/self/clear_refs").write_text("5")
+    except OSError:
+        pass
+
+
+def get_peak_rss() -> int:
+    """
+    The peak resident memory of the process in bytes, since the last
+    `reset_peak_rss` on Linux.
+    """
+    try:
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextmanager
+def profile(prefix: Path, limit: int = 25) -> Iterator[None]:
+    """
+    Profile the block with cProfile and tracemalloc.
+
+    Writes the cProfile stats to `{prefix}.prof`, for `pstats` or snakeviz,
+    and the `limit` lines that allocated the most memory still held at the
+    end of the block, with the traced peak, to `{prefix}.tracemalloc.txt`.
+    """
+    prefix = Path(prefix)
+    prefix.parent.mkdir(exist_ok=True, parents=True)
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        profiler.dump_stats(f"{prefix}.prof")
+        lines = [f"peak traced memory: {peak / 2**20:.1f} MiB"]
+        lines += [str(s) for s in snapshot.statistics("lineno")[:limit]]
+        Path(f"{prefix}.tracemalloc.txt").write_text("\n".join(lines) + "\n")
+
+
+@contextmanager
+def scene_metrics(
+    ftci: Path,
+    fcloud: Path,
+    profile_prefix: Optional[Path] = None,
+    shared_process: bool = False,
+) -> Iterator[dict]:
+    """
+    Record the metrics of processing a scene in the block.
+
+    Yields the record of the scene, filled in when the block exits: its
+    status ("ok", "skipped" with the reason and details given to
+    `set_skip_reason`, or "error"), duration, peak resident memory, stages and
+    counts. On error, the record also holds the exception and the stage it
+    was raised in, and the exception is re-raised.
+
+    Args:
+        ftci (Path): The TCI file of the scene.
+        fcloud (Path): The cloud file of the scene.
+        profile_prefix (Path, optional): Profile the scene with `profile`,
+            writing the results with this prefix. Defaults to None.
+        shared_process (bool, optional): Other scenes run in this process at
+            the same time, e.g. on threads. The peak memory is then not reset,
+            as the reset applies to the whole process, and is recorded as
+            "process_peak_rss_mb", the peak of the process so far, instead of
+            "peak_rss_mb". Defaults to False.
+    """
+    record = {"scene": Path(ftci).name, "fcloud": Path(fcloud).name}
+    if not shared_process:
+        reset_peak_rss()
+    start = perf_counter()
+    with record_stages() as recorder:
+        try:
+            if profile_prefix is None:
+                yield record
+            else:
+                with profile(profile_prefix):
+                    yield record
+            record["status"] = "ok"
+            if recorder.skip_reason is not None:
+                record["status"] = "skipped"
+                record["skip_reason"] = recorder.skip_reason
+                if recorder.skip_detail is not None:
+                    record["skip_detail"] = recorder.skip_detail
+        except Exception as e:
+            record["status"] = "error"
+            record["error"] = repr(e)
+            record["failed_stage"] = recorder.failed_stage
+            raise
+        finally:
+            record["finished"] = datetime.now(timezone.utc).isoformat()
+            record["seconds"] = perf_counter() - start
+            peak_rss_key = "process_peak_rss_mb" if shared_process else "peak_rss_mb"
+            record[peak_rss_key] = get_peak_rss() / 2**20
+            record["stages"] = recorder.as_records()
+            record["counts"] = recorder.counts
+
+
+def append_metrics(path: Path, record: dict) -> None:
+    """
+    Append a record to a JSON-lines metrics file.
+
+    The line is written with a single append, so shards of a run can share
+    the file.
+    """
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
@@ -0,0 +1,177 @@
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# "csv" writes a props CSV per scene and appends to a mask_values.txt per day;
+# "parquet" writes a partitioned dataset that `collect_dataset` merges
+OUTPUT_FORMATS = ("csv", "parquet")
+
+# "gaussian" is skimage's threshold_local, the reference; "mean" is a box
+# filter mean, whose cost does not depend on the block size; "downsample"
+# computes the gaussian threshold on a coarser grid and interpolates it back.
+# They are listed here, with the other settings, so that validating a
+# configuration does not import the processing libraries
+THRESHOLD_METHODS = ("gaussian", "mean", "downsample")
+
+# codecs of the label images, all with the horizontal predictor
+LABEL_CODECS = ("deflate", "zstd", "lzw")
+
+DATASET_DIREC = "dataset"
+
+# the mask values of the scenes of a day, with the "csv" format
+MASK_VALUES_FILE = "mask_values.txt"
+
+# the partition keys of the dataset, from the scene file names
+PARTITIONS = ("year", "doy", "sat")
+
+
+def validate_threshold_method(method: str) -> str:
+    if method not in THRESHOLD_METHODS:
+        raise ValueError(
+            f"Unknown threshold method {method!r}, use one of {THRESHOLD_METHODS}"
+        )
+    return method
+
+
+def validate_output_format(output_format: str) -> str:
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(
+            f"Unknown output format {output_format!r}, use one of {OUTPUT_FORMATS}"
+        )
+    if output_format == "parquet":
+        _import_pyarrow()
+    return output_format
+
+
+def validate_label_compress(compress: str) -> str:
+    if compress not in LABEL_CODECS:
+        raise ValueError(
+            f"Unknown label compression {compress!r}, use one of {LABEL_CODECS}"
+        )
+    return compress
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError(
+            "The parquet output format needs pyarrow: pip install 'ebfloeseg[parquet]'"
+        ) from e
+    return pyarrow
+
+
+def get_partition_path(
+    save_direc: Path, table: str, year: str, doy: str, sat: str
+) -> Path:
+    """
+    Return the file of a scene in a table of the dataset.
+
+    Each scene has one file, `year=<year>/doy=<doy>/sat=<sat>/part-0.parquet`,
+    so processing a scene again replaces its rows.
+    """
+    return (
+        Path(save_direc)
+        / DATASET_DIREC
+        / table
+        / f"year={int(year)}"
+        / f"doy={int(doy)}"
+        / f"sat={sat}"
+        / "part-0.parquet"
+    )
+
+
+def _write_parquet(table, path: Path) -> None:
+    # write then rename, so readers never see a partial file; the dot prefix
+    # keeps the temporary file out of datasets read meanwhile
+    pa = _import_pyarrow()
+    path.parent.mkdir(exist_ok=True, parents=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    pa.parquet.write_table(table, tmp)
+    os.replace(tmp, path)
+
+
+def write_scene_table(
+    df: "pd.DataFrame", save_direc: Path, table: str, year: str, doy: str, sat: str
+) -> Path:
+    """
+    Write the rows of a scene to a table of the dataset, atomically.
+
+    Args:
+        df (pd.DataFrame): The rows, without the partition keys.
+        save_direc (Path): The output directory of the run.
+        table (str): The name of the table, e.g. "props".
+        year (str): The year of the scene.
+        doy (str): The day of year of the scene.
+        sat (str): The satellite of the scene.
+
+    Returns:
+        Path: The file written.
+    """
+    pa = _import_pyarrow()
+    path = get_partition_path(save_direc, table, year, doy, sat)
+    _write_parquet(pa.Table.from_pandas(df, preserve_index=False), path)
+    return path
+
+
+def write_mask_values_table(
+    ice_mask_sum: int,
+    land_cloud_mask_sum: int,
+    save_direc: Path,
+    year: str,
+    doy: str,
+    sat: str,
+    sic: Optional[float] = None,
+) -> Path:
+    """
+    Write the mask pixel counts of a scene to the "mask_values" table.
+
+    The row has the columns of mask_values.txt: the ice area, the unmasked
+    area and their ratio, the sea ice concentration, unless `sic` is given.
+    """
+    import pandas as pd
+
+    df = pd.DataFrame(
+        {
+            "ice_area": [int(ice_mask_sum)],
+            "unmasked": [int(land_cloud_mask_sum)],
+            "sic": [ice_mask_sum / land_cloud_mask_sum if sic is None else sic],
+        }
+    )
+    return write_scene_table(df, save_direc, "mask_values", year, doy, sat)
+
+
+def collect_dataset(save_direc: Path) -> dict[str, Path]:
+    """
+    Merge each table of the dataset of a run into a single Parquet file.
+
+    The scene files of `save_direc / "dataset" / <table>` are read with their
+    partition keys as columns, sorted by year, day of year and satellite,
+    and written to `save_direc / <table>.parquet`.
+
+    Args:
+        save_direc (Path): The output directory of the run.
+
+    Returns:
+        dict[str, Path]: The file written for each table.
+    """
+    pa = _import_pyarrow()
+    partitioning = pa.dataset.partitioning(
+        pa.schema([("year", pa.int16()), ("doy", pa.int16()), ("sat", pa.string())]),
+        flavor="hive",
+    )
+    direc = Path(save_direc) / DATASET_DIREC
+    collected = {}
+    for table_direc in sorted(direc.iterdir()) if direc.exists() else []:
+        dataset = pa.dataset.dataset(
+            table_direc, format="parquet", partitioning=partitioning
+        )
+        table = dataset.to_table().sort_by([(key, "ascending") for key in PARTITIONS])
+        collected[table_direc.name] = Path(save_direc) / f"{table_direc.name}.parquet"
+        _write_parquet(table, collected[table_direc.name])
+    return collected
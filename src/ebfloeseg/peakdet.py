@@ -53,3 +53,58 @@ def peakdet(v: ArrayLike, delta: float) -> tuple[np.ndarray, np.ndarray]:
                 lookformax = True
 
     return np.array(maxtab), np.array(mintab)
+
+
+def peakdet_vectorized(v: ArrayLike, delta: float) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Detects peaks and valleys in a given input vector, like `peakdet`.
+
+    Instead of stepping through each element, the running maximum (or
+    minimum) from the last valley (or peak) is computed at once, and the
+    first element more than `delta` below (or above) it ends the peak (or
+    valley). The loop runs once per peak and valley found.
+
+    Parameters:
+    v (array-like): The input vector.
+    delta (float): The minimum difference between a peak (or valley) and its surrounding points.
+
+    Returns:
+    tuple: A tuple containing two arrays, the same as those of `peakdet`.
+
+    Raises:
+    ValueError: If the input argument `delta` is not a scalar.
+    ValueError: If the input argument `delta` is not positive.
+
+    """
+
+    if not np.isscalar(delta):
+        raise ValueError("Input argument delta must be a scalar")
+
+    if delta <= 0:
+        raise ValueError("Input argument delta must be positive")
+
+    v = np.asarray(v)
+    tabs = {True: [], False: []}
+
+    start = 0
+    lookformax = True
+    while start < len(v):
+        seg = v[start:]
+        if lookformax:
+            extreme = np.maximum.accumulate(seg)
+            ends = seg < np.subtract(extreme, delta, dtype=np.float64)
+        else:
+            extreme = np.minimum.accumulate(seg)
+            ends = seg > np.add(extreme, delta, dtype=np.float64)
+        if not ends.any():
+            break
+
+        end = int(np.argmax(ends))
+        # the first element reaching the extreme, as later equal ones do not
+        # replace it
+        pos = int(np.argmax(seg[:end] == extreme[end]))
+        tabs[lookformax].append((start + pos, seg[pos]))
+        start += end
+        lookformax = not lookformax
+
+    return np.array(tabs[True]), np.array(tabs[False])
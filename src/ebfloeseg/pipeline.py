@@ -0,0 +1,114 @@
+import queue
+import threading
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional
+
+from ebfloeseg.metrics import bind_stages
+
+# bytes read at a time when warming files
+READ_CHUNK_BYTES = 8 * 2**20
+
+
+def warm_files(paths: Iterable[Path]) -> int:
+    """
+    Read files through, so later reads are served from the page cache.
+
+    Args:
+        paths (Iterable[Path]): The files.
+
+    Returns:
+        int: The number of bytes read.
+    """
+    nbytes = 0
+    for path in paths:
+        with open(path, "rb", buffering=0) as f:
+            while chunk := f.read(READ_CHUNK_BYTES):
+                nbytes += len(chunk)
+    return nbytes
+
+
+def prefetch(
+    executor: Executor, jobs: Iterable[tuple], skip: int = 0, nfiles: int = 2
+) -> Iterator[tuple]:
+    """
+    Pass jobs through, warming the files of each in the background as it is taken.
+
+    Meant for the jobs of `submit_bounded`, which takes a job as it submits it.
+    With `max_in_flight` set to the number of workers plus a depth, a job
+    submitted after the first `skip` (the number of workers, whose jobs start
+    at once and are not warmed) waits behind `depth` others, so its files are
+    read while those run, in the order the workers open them, and only
+    `depth` scenes are held in the page cache ahead of the workers. This saves
+    waiting on the disk only: the worker still decodes the files. Warming is
+    best effort: a file that cannot be read is reported by the worker opening
+    it.
+
+    Args:
+        executor (Executor): The I/O thread pool.
+        jobs (Iterable[tuple]): The jobs, whose first `nfiles` items are paths.
+        skip (int, optional): The number of first jobs not warmed. Defaults to
+            0.
+        nfiles (int, optional): The number of paths of each job. Defaults to 2.
+
+    Yields:
+        tuple: The jobs, in order.
+    """
+    for n, job in enumerate(jobs):
+        if n >= skip:
+            executor.submit(warm_files, job[:nfiles])
+        yield job
+
+
+class BackgroundWriter:
+    """
+    Run writes in a background thread, so encoding and writing outputs
+    overlaps with computing the next ones.
+
+    At most `max_pending` writes wait in the queue; `submit` blocks when it is
+    full, which bounds the memory held by arrays waiting to be written. The
+    first error raised by a write is raised again by the next `submit` or by
+    `close`. The stages of a write are recorded as if it ran where it was
+    submitted.
+    """
+
+    def __init__(self, max_pending: int = 2):
+        self._queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while (item := self._queue.get()) is not None:
+            fn, args, kwargs = item
+            if self._error is None:
+                try:
+                    fn(*args, **kwargs)
+                except BaseException as e:
+                    self._error = e
+
+    def _raise(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, fn: Callable, *args, **kwargs) -> None:
+        """Queue a call of `fn`; the arguments must not be modified afterwards."""
+        self._raise()
+        self._queue.put((bind_stages(fn), args, kwargs))
+
+    def close(self) -> None:
+        """Wait for the queued writes to finish."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise()
+
+    def __enter__(self) -> "BackgroundWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        try:
+            self.close()
+        except BaseException:
+            if exc_type is None:
+                raise  # else the error of the block is raised
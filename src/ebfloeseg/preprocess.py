@@ -1,41 +1,130 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass
 from logging import getLogger
+from tempfile import TemporaryDirectory
+from typing import TYPE_CHECKING, Optional
 
 import numpy as np
-import pandas as pd
 import cv2
-from scipy import ndimage
-import skimage
-from skimage.filters import threshold_local
 from skimage.morphology import diamond, opening
 import rasterio
+from numpy.typing import NDArray
 
-from ebfloeseg.masking import maskrgb, mask_image, create_cloud_mask
-from ebfloeseg.savefigs import imsave, save_ice_mask_hist
+from ebfloeseg.labelfilter import (
+    LUT_OFFSET,
+    filter_labels,
+    get_label_areas,
+    get_labels_in_mask,
+    get_max_label,
+    get_small_labels,
+)
+from ebfloeseg.metrics import (
+    SKIP_FOOTPRINT,
+    add_count,
+    bind_stages,
+    set_skip_reason,
+    stage,
+    timed,
+)
+from ebfloeseg.pipeline import BackgroundWriter
+from ebfloeseg.outputs import (
+    MASK_VALUES_FILE,
+    validate_label_compress,
+    validate_output_format,
+    validate_threshold_method,
+    write_mask_values_table,
+    write_scene_table,
+)
+from ebfloeseg.masking import (
+    maskrgb,
+    mask_image,
+    create_cloud_mask,
+    read_mask_window,
+)
+from ebfloeseg.savefigs import (
+    imsave,
+    imopen_write,
+    imsave_labels,
+    open_label_writer,
+    save_ice_mask_hist_counts,
+)
+from ebfloeseg.tiling import (
+    ScratchArrays,
+    get_anchor_keys,
+    get_kernel_radius,
+    get_region_windows,
+    iter_bands,
+    iter_tiles,
+    label_tiled,
+    pad_window,
+)
+from ebfloeseg.threshold import (
+    DOWNSAMPLE_FACTOR,
+    accumulate_block_sums,
+    get_grid_shape,
+    get_local_threshold,
+    get_threshold_halo,
+    get_window_threshold,
+    threshold_coarse,
+    upsample,
+)
 from ebfloeseg.utils import (
-    write_mask_values,
-    get_wcuts,
+    WCUT_BINS,
+    write_mask_sums,
+    get_histogram,
+    get_wcuts_from_hist,
     getmeta,
     getres,
     get_region_properties,
 )
 
+if TYPE_CHECKING:
+    import pandas as pd
+
+# block size of the adaptive threshold for the ice mask
+THRESHOLD_BLOCK_SIZE = 399
+
+# erosion rounds after the first run on the windows around the remaining ice,
+# unless they cover more than this fraction of the image
+MAX_ROUND_WINDOW_FRACTION = 0.5
+
+# radius of the diamond the land and cloud mask is dilated with
+LAND_CLOUD_DILATION = 10
+
 
+@timed("features")
 def extract_features(
-    output, red_c, target_dir, res, sat, doy
+    output, red_c, target_dir, res, sat, doy, output_format="csv"
 ):  # adding doy temporarily for testing. TODO: use doy for subdir
+    write_features(
+        get_props_table(output, red_c), target_dir, res, sat, doy, output_format
+    )
+
+
+def get_props_table(output, red_c, release=None):
+    """The region properties of the floes of a label image, as a table."""
+    import pandas as pd
+
+    return pd.DataFrame.from_dict(get_region_properties(output, red_c, release))
+
+
+@timed("write")
+def write_features(df, target_dir, res, sat, doy, output_format="csv"):
     # fname = target_dir / f"{res}_{sat}_props.csv"
     fname = target_dir / f"{res}_{sat}_props.csv"
-    props = get_region_properties(output, red_c)
-    df = pd.DataFrame.from_dict(props)
+    if output_format == "parquet":
+        # target_dir is the directory of the day, res the date of the scene
+        write_scene_table(df, target_dir.parent, "props", res[:4], doy, sat)
+        return
     df.to_csv(fname)
 
 
 def get_remove_small_mask(watershed, it):
     area_lim = (it) ** 4
-    props = skimage.measure.regionprops_table(watershed, properties=["label", "area"])
-    df = pd.DataFrame.from_dict(props)
-    mask = np.isin(watershed, df[df.area < area_lim].label.values)
-    return mask
+    areas = get_label_areas(watershed, watershed.max())
+    small = get_small_labels(areas, area_lim)
+    return small[watershed + LUT_OFFSET]
 
 
 def get_erosion_kernel(erosion_kernel_type="diamond", erosion_kernel_size=1):
@@ -48,128 +137,281 @@ def get_erosion_kernel(erosion_kernel_type="diamond", erosion_kernel_size=1):
     return erosion_kernel
 
 
-logger = getLogger(__name__)
+@timed("ice_mask")
+def get_ice_mask(
+    red_c, red_masked, ow_cut_min, ow_cut_max, threshold_method="gaussian", window=None
+):
+    ## adaptive threshold for ice mask
+    # with a window, red_c is the whole red channel and red_masked the window
+    if window is None:
+        thresh_adaptive = get_local_threshold(
+            red_c, THRESHOLD_BLOCK_SIZE, threshold_method
+        )
+    else:
+        thresh_adaptive = get_window_threshold(
+            red_c, THRESHOLD_BLOCK_SIZE, window, threshold_method
+        )
+    return threshold_ice_mask(thresh_adaptive, red_masked, ow_cut_min, ow_cut_max)
 
 
-def _preprocess(
-    ftci,
-    fcloud,
-    land_mask,
-    itmax,
-    itmin,
-    step,
-    erosion_kernel_type,
-    erosion_kernel_size,
-    save_figs,
-    save_direc,
+def threshold_ice_mask(thresh_adaptive, red_masked, ow_cut_min, ow_cut_max):
+    # clips the threshold inplace
+    thresh_adaptive = np.clip(
+        thresh_adaptive, ow_cut_min, ow_cut_max, out=thresh_adaptive
+    )
+    return red_masked > thresh_adaptive
+
+
+def as_uint8(mask):
+    """A 0/1 uint8 image of a mask, without a copy if the mask is boolean."""
+    if mask.dtype == bool:
+        return mask.view(np.uint8)
+    return mask.astype(np.uint8, copy=False)
+
+
+def _dilate_mask(mask):
+    return cv2.dilate(as_uint8(mask), diamond(LAND_CLOUD_DILATION)).view(bool)
+
+
+def get_land_mask_dilated(land_mask):
+    """
+    Dilate the land mask as `get_land_cloud_mask_dilated` does, once for the
+    scenes of a run.
+    """
+    return _dilate_mask(land_mask)
+
+
+@timed("dilate_land_cloud")
+def get_land_cloud_mask_dilated(
+    land_cloud_mask, land_mask=None, land_mask_dilated=None
 ):
-    tci = rasterio.open(ftci)
-    doy, year, sat = getmeta(fcloud)
-    res = getres(doy, year)
-    save_direc = save_direc / doy
-    save_direc.mkdir(exist_ok=True, parents=True)
+    # here dilating the land and cloud mask so any floes that are adjacent to the mask can be removed later
+    # same as skimage's binary_dilation: the diamond is symmetric and pixels
+    # beyond the border are not masked
+    if land_mask_dilated is None:
+        return _dilate_mask(land_cloud_mask)
 
-    cloud_mask = create_cloud_mask(fcloud)
+    # dilation distributes over union: with the land mask dilated once for the
+    # run, only the window around the clouds off land is dilated here
+    dilated = np.array(land_mask_dilated)
+    _, window = get_footprint(land_mask | ~land_cloud_mask, LAND_CLOUD_DILATION)
+    if window is not None:
+        clouds = land_cloud_mask[window] & ~land_mask[window]
+        dilated[window] |= _dilate_mask(clouds)
+    return dilated
 
-    red_c, green_c, blue_c = tci.read()  # these are different than the layers in rgb
-    rgb_masked = np.dstack([red_c, green_c, blue_c])  # masked below
 
-    maskrgb(rgb_masked, cloud_mask)
-    if save_figs:
-        fname = "cloud_mask_on_rgb.tif"
-        imsave(tci, rgb_masked, save_direc, doy, fname)
+@timed("erode")
+def erode_ice_mask(inp, erosion_kernel, it):
+    # erode a lot at first, decrease number of iterations each time
+    return cv2.erode(as_uint8(inp), erosion_kernel, iterations=it)
 
-    maskrgb(rgb_masked, land_mask)
-    if save_figs:
-        fname = "land_cloud_mask_on_rgb.tif"
-        imsave(tci, rgb_masked, save_direc, doy, fname)
 
-    ## adaptive threshold for ice mask
-    red_masked = rgb_masked[:, :, 0]
-    thresh_adaptive = threshold_local(red_c, block_size=399)
+@timed("fill_holes")
+def fill_holes(mask):
+    """
+    Fill the background not 4-connected to the image border, as
+    `ndimage.binary_fill_holes` does, with OpenCV, which releases the GIL.
+    """
+    _, labels = cv2.connectedComponents(as_uint8(mask == 0), connectivity=4)
+    border = np.zeros(labels.max(initial=0) + 1, dtype=bool)
+    for edge in (labels[0], labels[-1], labels[:, 0], labels[:, -1]):
+        border[edge] = True
+    border[0] = False  # the mask itself
+    return ~border[labels]
 
-    # here just determining the min and max values for the adaptive threshold
-    ow_cut_min, ow_cut_max, bins = get_wcuts(red_masked)
 
-    if save_figs:
-        save_ice_mask_hist(red_masked, bins, ow_cut_min, ow_cut_max, doy, save_direc)
+@timed("markers")
+def get_markers(inp, eroded_ice_mask, labels, erosion_kernel, it):
+    dilated_ice_mask = cv2.dilate(as_uint8(inp), erosion_kernel, iterations=it)
 
-    thresh_adaptive = np.clip(thresh_adaptive, ow_cut_min, ow_cut_max)
+    # Add one to all labels so that sure background is not 0, but 1
+    markers = labels + 1
 
-    ice_mask = red_masked > thresh_adaptive
+    unknown = cv2.subtract(dilated_ice_mask, as_uint8(eroded_ice_mask))
 
-    # a simple text file with columns: 'doy','ice_area','unmasked','sic'
-    write_mask_values(
-        land_mask, land_mask + cloud_mask, ice_mask, doy, year, save_direc
-    )
+    # Now, mark the region of unknown with zero
+    # markers[unknown == 255] = 0
+    mask_image(markers, unknown == 255, 0)
 
-    # saving ice mask
-    if save_figs:
-        imsave(
-            tci,
-            ice_mask,
-            save_direc,
-            doy,
-            "ice_mask_bw.tif",
-            count=1,
-            rollaxis=False,
-            as_uint8=True,
-            res=res,
-        )
+    # dilate each marker
+    return dilate_markers(markers, erosion_kernel, it + 1)
 
-    # here dilating the land and cloud mask so any floes that are adjacent to the mask can be removed later
-    land_cloud_mask = (land_mask + cloud_mask).astype(int)
-    land_cloud_mask_dilated = skimage.morphology.binary_dilation(
-        land_cloud_mask, diamond(10)
+
+@timed("dilate")
+def dilate_markers(markers, erosion_kernel, iterations):
+    """
+    Grey-dilate a marker image repeatedly in one call.
+
+    Same result as `iterations` calls of `skimage.morphology.dilation`: the
+    kernel anchor and the reflected border follow skimage. OpenCV has no int32
+    dilation, so labels go through the smallest type that holds them exactly.
+    """
+    max_marker = markers.max(initial=0)
+    if max_marker < 2**16:
+        dtype = np.uint16
+    else:
+        dtype = np.float32 if max_marker < 2**24 else np.float64
+    height, width = np.shape(erosion_kernel)
+    dilated = cv2.dilate(
+        markers.astype(dtype),
+        np.asarray(erosion_kernel, dtype=np.uint8),
+        anchor=((width - 1) // 2, (height - 1) // 2),
+        iterations=iterations,
+        borderType=cv2.BORDER_REFLECT,
     )
+    return dilated.astype(markers.dtype)
 
-    # setting up different kernel for erosion-expansion algo
-    erosion_kernel = get_erosion_kernel(erosion_kernel_type, erosion_kernel_size)
 
-    # TODO: clarify this block
-    inp = ice_mask
-    input_no = ice_mask
-    output = np.zeros((np.shape(ice_mask)))
-    itmax = itmax
-    itmin = itmin
-    step = step
-    for r, it in enumerate(range(itmax, itmin - 1, step)):
-        # erode a lot at first, decrease number of iterations each time
-        eroded_ice_mask = cv2.erode(inp.astype(np.uint8), erosion_kernel, iterations=it)
-        eroded_ice_mask = ndimage.binary_fill_holes(eroded_ice_mask.astype(np.uint8))
+def add_round_counts(nlabels, land_floes, areas, small_floes, area_lim):
+    """
+    Count the floes labelled after erosion, the ones removed for touching
+    land or clouds or for being small, and the area of the small ones.
+    """
+    add_count("labels", nlabels - 1)
+    add_count("land_floes", np.count_nonzero(land_floes))
+    add_count("small_floes", np.count_nonzero(small_floes & (areas > 0)))
+    add_count("small_floe_area", areas[small_floes].sum())
+    add_count("floes", np.count_nonzero(areas[LUT_OFFSET + 2 :] >= area_lim))
 
-        dilated_ice_mask = cv2.dilate(
-            inp.astype(np.uint8), erosion_kernel, iterations=it
-        )
 
-        # label floes remaining after erosion
-        ret, markers = cv2.connectedComponents(eroded_ice_mask.astype(np.uint8))
+def get_round_halo(erosion_kernel, it):
+    """
+    The margin around the remaining ice that an erosion round needs to give
+    the same watershed on a window as on the whole image.
 
-        # Add one to all labels so that sure background is not 0, but 1
-        markers = markers + 1
+    It covers the erosion, the dilation of the ice and of the markers, and the
+    frame `cv2.watershed` draws around its input.
+    """
+    return get_kernel_radius(erosion_kernel) * (2 * it + 1) + 2
 
-        unknown = cv2.subtract(
-            dilated_ice_mask.astype(np.uint8), eroded_ice_mask.astype(np.uint8)
-        )
 
-        # Now, mark the region of unknown with zero
-        # markers[unknown == 255] = 0
-        mask_image(markers, unknown == 255, 0)
+def get_round_windows(inp, halo, split=False):
+    """
+    Find the windows holding the remaining ice of an erosion round, or None if
+    they cover too much of the image to be worth it.
+
+    With `split`, several windows are always worth it, as they can be
+    segmented in parallel.
+    """
+    windows = get_region_windows(inp, halo)
+    area = sum(window.width * window.height for window in windows)
+    if area <= MAX_ROUND_WINDOW_FRACTION * inp.size or (split and len(windows) > 1):
+        return windows
+    return None
+
+
+def get_watershed(inp, rgb_masked, erosion_kernel, it):
+    """
+    Label the floes left after eroding the ice and grow them back over the
+    ice with the watershed.
+
+    Returns:
+        tuple[int, NDArray, NDArray]: The number of labels after erosion
+        (background included), the labels and the watershed.
+    """
+    eroded_ice_mask = fill_holes(erode_ice_mask(inp, erosion_kernel, it))
 
-        # dilate each marker
-        for a in np.arange(0, it + 1, 1):
-            markers = skimage.morphology.dilation(markers, erosion_kernel)
+    # label floes remaining after erosion
+    with stage("label"):
+        ret, labels = cv2.connectedComponents(as_uint8(eroded_ice_mask))
 
-        # rewatershed
+    markers = get_markers(inp, eroded_ice_mask, labels, erosion_kernel, it)
+
+    # rewatershed
+    with stage("watershed"):
         watershed = cv2.watershed(rgb_masked, markers)
 
+    return ret, labels, watershed
+
+
+def get_windowed_watershed(inp, rgb_masked, erosion_kernel, it, windows, executor=None):
+    """
+    `get_watershed` on the windows from `get_round_windows` only, on the
+    threads of `executor` if given; OpenCV releases the GIL.
+
+    Outside the windows there is no ice, so the watershed is the background
+    label 1 there and -1 on the image border. The labels of the windows are
+    renumbered in the raster order of the whole image, which gives the same
+    result as `get_watershed` on the whole image.
+
+    Returns:
+        tuple[int, NDArray]: The number of labels after erosion (background
+        included) and the watershed.
+    """
+    height, width = inp.shape
+    watershed = np.ones((height, width), dtype=np.int32)
+    watershed[[0, -1], :] = -1
+    watershed[:, [0, -1]] = -1
+
+    def segment_window(window):
+        core = window.toslices()
+        nlabels, labels, tile = get_watershed(
+            inp[core],
+            np.ascontiguousarray(rgb_masked[core]),
+            erosion_kernel,
+            it,
+        )
+        return get_anchor_keys(labels, window, width)[1:nlabels], tile
+
+    # the largest windows first, so they do not finish last
+    windows = sorted(windows, key=lambda w: w.width * w.height, reverse=True)
+    if executor is None:
+        results = list(map(segment_window, windows))
+    else:
+        results = list(executor.map(bind_stages(segment_window), windows))
+    tile_keys = [keys for keys, _ in results]
+    tiles = [tile for _, tile in results]
+    del results
+
+    with stage("relabel"):
+        keys = np.concatenate(tile_keys) if tiles else np.zeros(0, dtype=np.int64)
+        order = np.argsort(keys, kind="stable")
+        new_labels = np.empty(len(keys) + 1, dtype=np.int32)
+        new_labels[0] = 0
+        new_labels[1 + order] = np.arange(1, len(keys) + 1, dtype=np.int32)
+        start = 1
+        for window, tile, nlabels in zip(windows, tiles, map(len, tile_keys)):
+            # watershed values are -1, the background 1 and the labels + 1;
+            # the frame cv2.watershed draws around a window is not an edge
+            # unless it is on the image border, where it is already -1
+            lut = np.empty(nlabels + 3, dtype=np.int32)
+            lut[:3] = (-1, 0, 1)
+            lut[3:] = new_labels[start : start + nlabels] + 1
+            start += nlabels
+            inner = lut[tile[1:-1, 1:-1] + 1]
+            core = window.toslices()
+            rows = slice(core[0].start + 1, core[0].stop - 1)
+            cols = slice(core[1].start + 1, core[1].stop - 1)
+            np.copyto(watershed[rows, cols], inner, where=inner != 1)
+
+    return len(keys) + 1, watershed
+
+
+def erosion_round(
+    inp,
+    input_no,
+    rgb_masked,
+    land_cloud_mask_dilated,
+    erosion_kernel,
+    it,
+    windows=None,
+    executor=None,
+):
+    if windows is None:
+        ret, _, watershed = get_watershed(inp, rgb_masked, erosion_kernel, it)
+    else:
+        ret, watershed = get_windowed_watershed(
+            inp, rgb_masked, erosion_kernel, it, windows, executor
+        )
+
+    with stage("filter"):
         # get rid of floes that intersect the dilated land mask
-        watershed[
-            np.isin(
-                watershed,
-                np.unique(watershed[land_cloud_mask_dilated & (watershed > 1)]),
-            )
-        ] = 1
+        max_label = watershed.max()
+        land_floes = get_labels_in_mask(
+            watershed, land_cloud_mask_dilated & (watershed > 1), max_label
+        )
+        filter_labels(watershed, land_floes, 1)
 
         # pdb.set_trace()
         # set the open water and already identified floes to no
@@ -178,17 +420,409 @@ def _preprocess(
 
         # get rid of ones that are too small
         area_lim = (it) ** 4
-        props = skimage.measure.regionprops_table(
-            watershed, properties=["label", "area"]
+        areas = get_label_areas(watershed, max_label)
+        small_floes = get_small_labels(areas, area_lim)
+        filter_labels(watershed, small_floes, 1)
+        add_round_counts(ret, land_floes, areas, small_floes, area_lim)
+
+    return watershed
+
+
+@dataclass
+class Segmentation:
+    """The in-memory outputs of `segment_arrays`."""
+
+    labels: NDArray  # the floe labels after the opening; 0 is no floe
+    ice_mask: NDArray[np.bool_]
+    # ice_area, unmasked and sic as in mask_values.txt, the open water cuts
+    # and the histogram they were found from
+    mask_stats: dict
+    props: "pd.DataFrame"  # the region properties of the floes
+    # why the floes were not segmented, e.g. too few unmasked pixels
+    skip_reason: Optional[str] = None
+
+
+def get_crop_halo(itmax, itmin, erosion_kernel):
+    """
+    The margin around the unmasked pixels of a scene that `segment_masks`
+    needs to give the same labels on a crop as on the whole scene.
+
+    It covers the erosion and dilation of the first round plus the frame
+    `cv2.watershed` draws around its input, and the dilation of the land and
+    cloud mask.
+    """
+    reach = max(itmax, itmin) * get_kernel_radius(erosion_kernel)
+    return max(reach + 2, LAND_CLOUD_DILATION)
+
+
+@timed("footprint")
+def get_footprint(land_cloud_mask, halo=0):
+    """
+    Count the unmasked pixels of a scene and find the window around them.
+
+    Args:
+        land_cloud_mask (NDArray[np.bool_]): The land and cloud mask.
+        halo (int, optional): The margin added around the unmasked pixels,
+            clipped to the scene. Defaults to 0.
+
+    Returns:
+        tuple[int, tuple[slice, slice] | None]: The number of unmasked pixels,
+        and the rows and columns of the window, or None if there are none.
+    """
+    unmasked = ~land_cloud_mask
+    count = int(np.count_nonzero(unmasked))
+    if count == 0:
+        return 0, None
+
+    window = []
+    for axis, n in enumerate(land_cloud_mask.shape):
+        index = np.flatnonzero(unmasked.any(axis=1 - axis))
+        window.append(slice(max(index[0] - halo, 0), min(index[-1] + 1 + halo, n)))
+    return count, tuple(window)
+
+
+def get_skip_reason(unmasked, size, min_usable_fraction=0.0):
+    """Why a scene with `unmasked` of its `size` pixels is skipped, or None."""
+    if unmasked == 0:
+        return "no unmasked pixels"
+    if unmasked / size < min_usable_fraction:
+        return (
+            f"unmasked fraction {unmasked / size:.3g} is below "
+            f"min_usable_fraction {min_usable_fraction}"
         )
-        df = pd.DataFrame.from_dict(props)
-        watershed[np.isin(watershed, df[df.area < area_lim].label.values)] = 1
+    return None
 
-        if save_figs:
-            fname = f"identification_round_{r}.tif"
-            imsave(
+
+def get_skipped_mask_stats(unmasked):
+    """The mask statistics of a skipped scene, whose ice is not measured."""
+    return {
+        "ice_area": 0,
+        "unmasked": unmasked,
+        "sic": float("nan"),
+        "ow_cut_min": None,
+        "ow_cut_max": None,
+        "histogram": None,
+    }
+
+
+def uncrop(image, shape, window):
+    """Paste the image of a window into a zero image of the scene."""
+    full = np.zeros(shape, dtype=image.dtype)
+    full[window] = image
+    return full
+
+
+def mask_scene(
+    rgb,
+    cloud_mask,
+    land_mask,
+    threshold_method="gaussian",
+    save_image=None,
+    window=None,
+    land_mask_dilated=None,
+):
+    """
+    Run the stages of `segment_arrays` that do not depend on the erosion settings.
+
+    Args:
+        rgb (NDArray): The (height, width, 3) true color image; not modified.
+        cloud_mask (NDArray[np.bool_]): The cloud mask.
+        land_mask (NDArray[np.bool_]): The land mask.
+        threshold_method (str, optional): The adaptive threshold method.
+            Defaults to "gaussian".
+        save_image (Callable, optional): Called with the file name and image of
+            each intermediate figure, e.g. to save it. Defaults to None.
+        window (tuple[slice, slice], optional): Only mask this window of the
+            scene, which must hold all its unmasked pixels, e.g. from
+            `get_footprint`. The arrays returned are the size of the window.
+            Defaults to None, the whole scene.
+        land_mask_dilated (NDArray[np.bool_], optional): The land mask dilated
+            by `get_land_mask_dilated`, shared by the scenes of a run. Defaults
+            to None, dilated with the clouds.
+
+    Returns:
+        tuple[dict[str, NDArray], dict]: The inputs of `segment_masks`: the red
+        channel, the masked image, the ice mask and the dilated land/cloud
+        mask; and the mask statistics.
+    """
+    red = rgb[:, :, 0]  # the threshold of a window depends on the pixels around it
+    if window is not None:
+        rgb, cloud_mask, land_mask = rgb[window], cloud_mask[window], land_mask[window]
+        if land_mask_dilated is not None:
+            land_mask_dilated = land_mask_dilated[window]
+    red_c = np.ascontiguousarray(rgb[:, :, 0])
+    rgb_masked = np.array(rgb)  # masked below
+
+    maskrgb(rgb_masked, cloud_mask)
+    if save_image:
+        save_image("cloud_mask_on_rgb.tif", rgb_masked)
+
+    maskrgb(rgb_masked, land_mask)
+    if save_image:
+        save_image("land_cloud_mask_on_rgb.tif", rgb_masked)
+
+    red_masked = rgb_masked[:, :, 0]
+
+    # here just determining the min and max values for the adaptive threshold
+    histogram = get_histogram(red_masked)
+    ow_cut_min, ow_cut_max = get_wcuts_from_hist(histogram, WCUT_BINS)
+
+    if window is None:
+        ice_mask = get_ice_mask(
+            red_c, red_masked, ow_cut_min, ow_cut_max, threshold_method
+        )
+    else:
+        ice_mask = get_ice_mask(
+            red, red_masked, ow_cut_min, ow_cut_max, threshold_method, window
+        )
+    if save_image:
+        save_image("ice_mask_bw.tif", ice_mask)
+
+    land_cloud_mask = land_mask + cloud_mask
+    ice_area = int(np.count_nonzero(ice_mask))
+    unmasked = int(np.count_nonzero(~land_cloud_mask))
+    mask_stats = {
+        "ice_area": ice_area,
+        "unmasked": unmasked,
+        "sic": ice_area / unmasked,
+        "ow_cut_min": ow_cut_min,
+        "ow_cut_max": ow_cut_max,
+        "histogram": histogram,
+    }
+
+    land_cloud_mask_dilated = get_land_cloud_mask_dilated(
+        land_cloud_mask, land_mask, land_mask_dilated
+    )
+
+    prepared = {
+        "red_c": red_c,
+        "rgb_masked": rgb_masked,
+        "ice_mask": ice_mask,
+        "land_cloud_mask_dilated": land_cloud_mask_dilated,
+    }
+    return prepared, mask_stats
+
+
+def segment_masks(
+    red_c,
+    rgb_masked,
+    ice_mask,
+    land_cloud_mask_dilated,
+    itmax,
+    itmin,
+    step,
+    erosion_kernel_type,
+    erosion_kernel_size,
+    save_image=None,
+    threads=1,
+):
+    """
+    Run the erosion rounds of `segment_arrays` on the outputs of `mask_scene`.
+
+    The input arrays are not modified. `save_image` is called with the
+    watershed of each round, if given. With several `threads`, every round
+    splits the ice into windows that are segmented in parallel.
+
+    Returns:
+        NDArray: The floe labels after the opening.
+    """
+    # setting up different kernel for erosion-expansion algo
+    erosion_kernel = get_erosion_kernel(erosion_kernel_type, erosion_kernel_size)
+
+    # TODO: clarify this block
+    # the masks and the sum of the floes of each round are updated inplace;
+    # floe labels and their sums fit in int32
+    inp = ice_mask.copy()
+    input_no = ice_mask.copy()
+    output = np.zeros(np.shape(ice_mask), dtype=np.int32)
+    stack = ExitStack()
+    executor = None
+    if threads > 1:
+        executor = stack.enter_context(ThreadPoolExecutor(threads))
+    for r, it in enumerate(range(itmax, itmin - 1, step)):
+        with stage(f"round_{r}"):
+            # later rounds only look at the windows around the remaining ice
+            windows = None
+            if r or executor is not None:
+                halo = get_round_halo(erosion_kernel, it)
+                windows = get_round_windows(inp, halo, executor is not None)
+            watershed = erosion_round(
+                inp,
+                input_no,
+                rgb_masked,
+                land_cloud_mask_dilated,
+                erosion_kernel,
+                it,
+                windows,
+                executor,
+            )
+
+        if save_image:
+            save_image(f"identification_round_{r}.tif", watershed)
+
+        np.logical_or(ice_mask, inp, out=input_no)
+        inp &= watershed == 1
+        inp &= ice_mask
+        watershed[watershed < 2] = 0
+        output += watershed
+        del watershed
+    stack.close()
+
+    with stage("opening"):
+        return opening(output)
+
+
+def segment_arrays(
+    rgb,
+    cloud_mask,
+    land_mask,
+    itmax=8,
+    itmin=3,
+    step=-1,
+    erosion_kernel_type="diamond",
+    erosion_kernel_size=1,
+    threshold_method="gaussian",
+    save_image=None,
+    min_usable_fraction=0.0,
+    crop=True,
+    threads=1,
+    land_mask_dilated=None,
+):
+    """
+    Segment the floes of a scene held in memory.
+
+    Only the window around the pixels outside the land and cloud masks is
+    segmented, with the margin needed for the same result as the whole
+    scene. A scene with no unmasked pixels, or fewer than
+    `min_usable_fraction` of them, is skipped: its labels are empty and its
+    mask statistics have no ice area and a NaN sea ice concentration.
+
+    Args:
+        rgb (NDArray): The (height, width, 3) true color image, e.g.
+            `np.dstack(tci.read())`; not modified.
+        cloud_mask (NDArray[np.bool_]): The cloud mask.
+        land_mask (NDArray[np.bool_]): The land mask.
+        itmax (int, optional): The erosion iterations of the first round.
+            Defaults to 8.
+        itmin (int, optional): The (inclusive) erosion iterations of the last
+            round. Defaults to 3.
+        step (int, optional): The change of iterations between rounds.
+            Defaults to -1.
+        erosion_kernel_type (str, optional): "diamond" or "ellipse". Defaults to
+            "diamond".
+        erosion_kernel_size (int, optional): The erosion kernel size. Defaults
+            to 1.
+        threshold_method (str, optional): The adaptive threshold method.
+            Defaults to "gaussian".
+        save_image (Callable, optional): Called with the file name and image of
+            each intermediate figure, e.g. to save it. Defaults to None.
+        min_usable_fraction (float, optional): Skip the scene if a smaller
+            fraction of its pixels is unmasked. Defaults to 0.0.
+        crop (bool, optional): Segment only the window around the unmasked
+            pixels. The intermediate figures are always of the whole scene.
+            Defaults to True.
+        threads (int, optional): Segment independent clusters of ice on this
+            many threads. Defaults to 1.
+        land_mask_dilated (NDArray[np.bool_], optional): The land mask dilated
+            by `get_land_mask_dilated`, for runs over many scenes. Defaults to
+            None.
+
+    Returns:
+        Segmentation: The labels, ice mask, mask statistics and region
+        properties.
+    """
+    validate_threshold_method(threshold_method)
+    shape = np.shape(land_mask)
+    erosion_kernel = get_erosion_kernel(erosion_kernel_type, erosion_kernel_size)
+    unmasked, window = get_footprint(
+        land_mask | cloud_mask, get_crop_halo(itmax, itmin, erosion_kernel)
+    )
+    skip_reason = get_skip_reason(unmasked, np.prod(shape), min_usable_fraction)
+    if skip_reason is not None:
+        set_skip_reason(SKIP_FOOTPRINT, skip_reason)
+        labels = np.zeros(shape, dtype=np.int32)
+        return Segmentation(
+            labels,
+            np.zeros(shape, dtype=bool),
+            get_skipped_mask_stats(unmasked),
+            get_props_table(labels, rgb[:, :, 0]),
+            skip_reason,
+        )
+    if not crop or save_image is not None:
+        window = None
+
+    prepared, mask_stats = mask_scene(
+        rgb,
+        cloud_mask,
+        land_mask,
+        threshold_method,
+        save_image,
+        window,
+        land_mask_dilated,
+    )
+    labels = segment_masks(
+        **prepared,
+        itmax=itmax,
+        itmin=itmin,
+        step=step,
+        erosion_kernel_type=erosion_kernel_type,
+        erosion_kernel_size=erosion_kernel_size,
+        save_image=save_image,
+        threads=threads,
+    )
+    ice_mask, red_c = prepared["ice_mask"], prepared["red_c"]
+    if window is not None:
+        labels = uncrop(labels, shape, window)
+        ice_mask = uncrop(ice_mask, shape, window)
+        red_c = np.ascontiguousarray(rgb[:, :, 0])
+    props = get_props_table(labels, red_c)
+    return Segmentation(labels, ice_mask, mask_stats, props)
+
+
+logger = getLogger(__name__)
+
+
+def _submit(writer, fn, *args, **kwargs):
+    # run a write in the background writer if there is one, else now
+    if writer is None:
+        fn(*args, **kwargs)
+    else:
+        writer.submit(fn, *args, **kwargs)
+
+
+def get_image_saver(tci, save_direc, doy, res, writer=None, label_compress="deflate"):
+    """
+    Return a `save_image` callback writing the figures of a scene as TIFFs.
+
+    Color images are written as is, masks as one uint8 band and labels with
+    `imsave_labels`, prefixed with the date. With a `BackgroundWriter`, images
+    are copied and written in the background, as the pipeline modifies them
+    afterwards.
+    """
+
+    def save_image(fname, image):
+        if image.ndim == 3:
+            image = image if writer is None else np.array(image)
+            _submit(writer, imsave, tci, image, save_direc, doy, fname)
+        elif image.dtype != bool:
+            image = image if writer is None else np.array(image)
+            _submit(
+                writer,
+                imsave_labels,
+                tci,
+                image,
+                save_direc,
+                fname,
+                label_compress,
+                res=res,
+            )
+        else:
+            image = image if writer is None else image.astype(np.uint8)
+            _submit(
+                writer,
+                imsave,
                 tci,
-                watershed,
+                image,
                 save_direc,
                 doy,
                 fname,
@@ -198,30 +832,560 @@ def _preprocess(
                 res=res,
             )
 
-        input_no = ice_mask + inp
-        inp = (watershed == 1) & (inp == 1) & ice_mask
-        watershed[watershed < 2] = 0
-        output += watershed
+    return save_image
+
+
+def write_mask_outputs(
+    mask_stats,
+    save_figs,
+    save_direc,
+    year,
+    doy,
+    sat,
+    output_format="csv",
+    mask_values_file=MASK_VALUES_FILE,
+):
+    """Write the mask values of a scene, and its histogram figure if asked."""
+    if save_figs and mask_stats["histogram"] is not None:
+        save_ice_mask_hist_counts(
+            mask_stats["histogram"],
+            WCUT_BINS,
+            mask_stats["ow_cut_min"],
+            mask_stats["ow_cut_max"],
+            doy,
+            save_direc,
+        )
+
+    # a simple text file with columns: 'doy','ice_area','unmasked','sic'
+    if output_format == "parquet":
+        # save_direc is the directory of the day
+        write_mask_values_table(
+            mask_stats["ice_area"],
+            mask_stats["unmasked"],
+            save_direc.parent,
+            year,
+            doy,
+            sat,
+            mask_stats["sic"],
+        )
+    else:
+        write_mask_sums(
+            mask_stats["ice_area"],
+            mask_stats["unmasked"],
+            doy,
+            save_direc,
+            mask_stats["sic"],
+            mask_values_file,
+        )
 
-    # saving the props table
-    output = opening(output)
-    extract_features(output, red_c, save_direc, res, sat, doy)
+
+def write_label_outputs(
+    tci,
+    labels,
+    props,
+    save_direc,
+    res,
+    sat,
+    doy,
+    output_format,
+    label_compress="deflate",
+):
+    """Write the props table and the label floes tif of a scene."""
+    write_features(props, save_direc, res, sat, doy, output_format)
 
     # saving the label floes tif
     fname = f"{sat}_final.tif"
-    imsave(
+    imsave_labels(tci, labels, save_direc, fname, label_compress, res=res)
+
+
+def _open_scene(ftci, fcloud, save_direc):
+    tci = rasterio.open(ftci)
+    doy, year, sat = getmeta(fcloud)
+    res = getres(doy, year)
+    save_direc = save_direc / doy
+    save_direc.mkdir(exist_ok=True, parents=True)
+    return tci, doy, year, sat, res, save_direc
+
+
+def _read_scene(tci, fcloud):
+    cloud_mask = create_cloud_mask(fcloud)
+    with stage("read"):
+        rgb = np.dstack(tci.read())
+    return rgb, cloud_mask
+
+
+def prepare_scene(
+    ftci,
+    fcloud,
+    land_mask,
+    save_figs,
+    save_direc,
+    threshold_method="gaussian",
+    output_format="csv",
+    land_mask_dilated=None,
+):
+    """
+    Run `mask_scene` on the files of a scene.
+
+    Writes the masks and mask values of the scene to `save_direc / doy`.
+
+    Returns:
+        dict[str, NDArray]: The inputs of `segment_scene`: the red channel, the
+        masked image, the ice mask and the dilated land/cloud mask.
+    """
+    tci, doy, year, sat, res, save_direc = _open_scene(ftci, fcloud, save_direc)
+    rgb, cloud_mask = _read_scene(tci, fcloud)
+    save_image = get_image_saver(tci, save_direc, doy, res) if save_figs else None
+    prepared, mask_stats = mask_scene(
+        rgb,
+        cloud_mask,
+        land_mask,
+        threshold_method,
+        save_image,
+        land_mask_dilated=land_mask_dilated,
+    )
+    write_mask_outputs(mask_stats, save_figs, save_direc, year, doy, sat, output_format)
+    return prepared
+
+
+def segment_scene(
+    ftci,
+    fcloud,
+    red_c,
+    rgb_masked,
+    ice_mask,
+    land_cloud_mask_dilated,
+    itmax,
+    itmin,
+    step,
+    erosion_kernel_type,
+    erosion_kernel_size,
+    save_figs,
+    save_direc,
+    output_format="csv",
+    label_compress="deflate",
+):
+    """
+    Run `segment_masks` on the outputs of `prepare_scene`.
+
+    Writes the identification rounds, the final labels and the props table to
+    `save_direc / doy`. The input arrays are not modified.
+    """
+    tci, doy, year, sat, res, save_direc = _open_scene(ftci, fcloud, save_direc)
+    save_image = None
+    if save_figs:
+        save_image = get_image_saver(
+            tci, save_direc, doy, res, label_compress=label_compress
+        )
+    labels = segment_masks(
+        red_c,
+        rgb_masked,
+        ice_mask,
+        land_cloud_mask_dilated,
+        itmax,
+        itmin,
+        step,
+        erosion_kernel_type,
+        erosion_kernel_size,
+        save_image,
+    )
+    props = get_props_table(labels, red_c)
+    write_label_outputs(
+        tci, labels, props, save_direc, res, sat, doy, output_format, label_compress
+    )
+
+
+def _preprocess(
+    ftci,
+    fcloud,
+    land_mask,
+    itmax,
+    itmin,
+    step,
+    erosion_kernel_type,
+    erosion_kernel_size,
+    save_figs,
+    save_direc,
+    threshold_method="gaussian",
+    output_format="csv",
+    writer=None,
+    min_usable_fraction=0.0,
+    threads=1,
+    label_compress="deflate",
+    land_mask_dilated=None,
+    mask_values_file=MASK_VALUES_FILE,
+):
+    # read the scene, segment it in memory, and write the outputs, in the
+    # background if given a BackgroundWriter
+    tci, doy, year, sat, res, save_direc = _open_scene(ftci, fcloud, save_direc)
+    rgb, cloud_mask = _read_scene(tci, fcloud)
+    save_image = None
+    if save_figs:
+        save_image = get_image_saver(tci, save_direc, doy, res, writer, label_compress)
+    result = segment_arrays(
+        rgb,
+        cloud_mask,
+        land_mask,
+        itmax,
+        itmin,
+        step,
+        erosion_kernel_type,
+        erosion_kernel_size,
+        threshold_method,
+        save_image,
+        min_usable_fraction,
+        threads=threads,
+        land_mask_dilated=land_mask_dilated,
+    )
+    _submit(
+        writer,
+        write_mask_outputs,
+        result.mask_stats,
+        save_figs,
+        save_direc,
+        year,
+        doy,
+        sat,
+        output_format,
+        mask_values_file,
+    )
+    _submit(
+        writer,
+        write_label_outputs,
         tci,
-        output,
+        result.labels,
+        result.props,
         save_direc,
+        res,
+        sat,
         doy,
-        fname,
-        count=1,
-        rollaxis=False,
-        as_uint8=True,
-        res=res,
+        output_format,
+        label_compress,
     )
 
 
+def _iter_windows(height, width, tile_size, scratch):
+    # tiles in raster order, dropping the scratch pages touched by each tile
+    for band in iter_bands(height, width, tile_size):
+        for tile in iter_tiles(band, tile_size):
+            yield tile
+            scratch.release()
+
+
+def _preprocess_tiled(
+    ftci,
+    fcloud,
+    land_mask,
+    itmax,
+    itmin,
+    step,
+    erosion_kernel_type,
+    erosion_kernel_size,
+    save_figs,
+    save_direc,
+    tile_size,
+    threshold_method="gaussian",
+    output_format="csv",
+    min_usable_fraction=0.0,
+    label_compress="deflate",
+    land_mask_dilated=None,
+    mask_values_file=MASK_VALUES_FILE,
+):
+    """
+    Tiled version of `_preprocess` writing the same outputs.
+
+    Every stage reads and computes windows of at most `tile_size` pixels plus
+    the halo it needs, so memory is set by the tile size rather than the scene
+    size. Scene-sized intermediates live in scratch files next to the outputs.
+    Hole filling, floe labelling and the per-floe filters are stitched across
+    tiles to match the whole-image run.
+    """
+    if tile_size <= 0 or tile_size % 2:
+        raise ValueError("tile_size must be a positive even number")
+
+    tci = rasterio.open(ftci)
+    cloud = rasterio.open(fcloud)
+    doy, year, sat = getmeta(fcloud)
+    res = getres(doy, year)
+    save_direc = save_direc / doy
+    save_direc.mkdir(exist_ok=True, parents=True)
+    height, width = shape = tci.height, tci.width
+
+    with TemporaryDirectory(dir=save_direc) as tmp, ExitStack() as stack:
+        scratch = ScratchArrays(tmp)
+        red_c = scratch.create("red_c", np.uint8, shape)
+        rgb_masked = scratch.create("rgb_masked", np.uint8, shape + (3,))
+        land_cloud_mask = scratch.create("land_cloud_mask", bool, shape)
+        if threshold_method == "downsample":
+            block_sums = np.zeros(get_grid_shape(shape), dtype=np.int64)
+            block_counts = np.zeros_like(block_sums)
+
+        def open_band_writer(fname, **kwargs):
+            if not save_figs:
+                return None
+            return stack.enter_context(imopen_write(tci, save_direc, fname, **kwargs))
+
+        def open_label_band_writer(fname, max_label):
+            # label images are assembled in the scratch directory
+            return stack.enter_context(
+                open_label_writer(
+                    tci, save_direc, fname, max_label, label_compress, res, tmp
+                )
+            )
+
+        # mask the scene band by band, counting the histogram and unmasked pixels
+        cloud_dst = open_band_writer("cloud_mask_on_rgb.tif")
+        land_dst = open_band_writer("land_cloud_mask_on_rgb.tif")
+        hist = np.zeros(len(WCUT_BINS) - 1, dtype=np.int64)
+        land_cloud_mask_sum = np.int64(0)
+        for band in iter_bands(height, width, tile_size):
+            rows = band.toslices()[0]
+            with stage("read"):
+                band_rgb = np.dstack(tci.read(window=band))
+            red_c[rows] = band_rgb[:, :, 0]
+            if threshold_method == "downsample":
+                accumulate_block_sums(
+                    block_sums, block_counts, band_rgb[:, :, 0], band.row_off
+                )
+            cloud_mask = read_mask_window(cloud, band, 255)
+
+            maskrgb(band_rgb, cloud_mask)
+            if save_figs:
+                with stage("write"):
+                    cloud_dst.write(np.rollaxis(band_rgb, axis=2), window=band)
+            maskrgb(band_rgb, land_mask[rows])
+            if save_figs:
+                with stage("write"):
+                    land_dst.write(np.rollaxis(band_rgb, axis=2), window=band)
+            rgb_masked[rows] = band_rgb
+            land_cloud_mask[rows] = land_mask[rows] | cloud_mask
+
+            hist += get_histogram(band_rgb[:, :, 0])
+            land_cloud_mask_sum += np.count_nonzero(~land_cloud_mask[rows])
+            scratch.release()
+
+        skip_reason = get_skip_reason(
+            int(land_cloud_mask_sum), height * width, min_usable_fraction
+        )
+        if skip_reason is not None:
+            set_skip_reason(SKIP_FOOTPRINT, skip_reason)
+            write_mask_outputs(
+                get_skipped_mask_stats(int(land_cloud_mask_sum)),
+                save_figs,
+                save_direc,
+                year,
+                doy,
+                sat,
+                output_format,
+                mask_values_file,
+            )
+            final_dst = open_label_band_writer(f"{sat}_final.tif", 0)
+            for band in iter_bands(height, width, tile_size):
+                with stage("write"):
+                    final_dst.write(
+                        np.zeros((band.height, width), dtype=np.uint8), 1, window=band
+                    )
+            empty = np.zeros((1, 1), dtype=np.int64)
+            write_features(
+                get_props_table(empty, empty), save_direc, res, sat, doy, output_format
+            )
+            return
+
+        # here just determining the min and max values for the adaptive threshold
+        ow_cut_min, ow_cut_max = get_wcuts_from_hist(hist, WCUT_BINS)
+
+        if save_figs:
+            save_ice_mask_hist_counts(
+                hist, WCUT_BINS, ow_cut_min, ow_cut_max, doy, save_direc
+            )
+
+        # ice mask and dilated land/cloud mask, with the threshold kernel as halo
+        ice_mask = scratch.create("ice_mask", bool, shape)
+        land_cloud_mask_dilated = scratch.create("land_cloud_dilated", bool, shape)
+        ice_dst = open_band_writer("ice_mask_bw.tif", count=1, res=res)
+        threshold_halo = get_threshold_halo(THRESHOLD_BLOCK_SIZE, threshold_method)
+        if threshold_method == "downsample":
+            coarse_threshold = threshold_coarse(
+                block_sums, block_counts, THRESHOLD_BLOCK_SIZE, DOWNSAMPLE_FACTOR
+            )
+        ice_mask_sum = np.int64(0)
+        for band in iter_bands(height, width, tile_size):
+            band_ice_mask = np.zeros((band.height, width), dtype=np.uint8)
+            for tile in iter_tiles(band, tile_size):
+                padded, inner = pad_window(tile, threshold_halo, height, width)
+                window, core = padded.toslices(), tile.toslices()
+                if threshold_method == "downsample":
+                    tile_ice_mask = threshold_ice_mask(
+                        upsample(coarse_threshold, DOWNSAMPLE_FACTOR, *core, shape),
+                        rgb_masked[core][:, :, 0],
+                        ow_cut_min,
+                        ow_cut_max,
+                    )
+                else:
+                    tile_ice_mask = get_ice_mask(
+                        red_c[window],
+                        rgb_masked[window][:, :, 0],
+                        ow_cut_min,
+                        ow_cut_max,
+                        threshold_method,
+                    )[inner]
+                ice_mask[core] = tile_ice_mask
+                land_cloud_mask_dilated[core] = get_land_cloud_mask_dilated(
+                    land_cloud_mask[window],
+                    land_mask[window],
+                    None if land_mask_dilated is None else land_mask_dilated[window],
+                )[inner]
+                band_ice_mask[:, core[1]] = tile_ice_mask
+                scratch.release()
+
+            ice_mask_sum += np.count_nonzero(band_ice_mask)
+            if save_figs:
+                with stage("write"):
+                    ice_dst.write(band_ice_mask, 1, window=band)
+
+        # a simple text file with columns: 'doy','ice_area','unmasked','sic'
+        if output_format == "parquet":
+            write_mask_values_table(
+                ice_mask_sum, land_cloud_mask_sum, save_direc.parent, year, doy, sat
+            )
+        else:
+            write_mask_sums(
+                ice_mask_sum,
+                land_cloud_mask_sum,
+                doy,
+                save_direc,
+                fname=mask_values_file,
+            )
+
+        # setting up different kernel for erosion-expansion algo
+        erosion_kernel = get_erosion_kernel(erosion_kernel_type, erosion_kernel_size)
+        radius = get_kernel_radius(erosion_kernel)
+
+        inp = scratch.create("inp", bool, shape)
+        input_no = scratch.create("input_no", bool, shape)
+        eroded_ice_mask = scratch.create("eroded_ice_mask", np.uint8, shape)
+        # labels in int32, as in `segment_masks` and for cv2.watershed;
+        # label_tiled raises if a scene has more
+        labels = scratch.create("labels", np.int32, shape)
+        watershed = scratch.create("watershed", np.int32, shape)
+        output = scratch.create("output", np.int32, shape)
+        for tile in _iter_windows(height, width, tile_size, scratch):
+            core = tile.toslices()
+            inp[core] = ice_mask[core]
+            input_no[core] = ice_mask[core]
+
+        for r, it in enumerate(range(itmax, itmin - 1, step)):
+            with stage(f"round_{r}"):
+                for tile in _iter_windows(height, width, tile_size, scratch):
+                    padded, inner = pad_window(tile, radius * it, height, width)
+                    eroded_ice_mask[tile.toslices()] = erode_ice_mask(
+                        inp[padded.toslices()], erosion_kernel, it
+                    )[inner]
+
+                # fill holes: background not connected to the scene border
+                with stage("fill_holes"):
+                    _, border = label_tiled(
+                        eroded_ice_mask,
+                        labels,
+                        tile_size,
+                        connectivity=4,
+                        invert=True,
+                        release=scratch.release,
+                    )
+                    border[0] = True
+                    for tile in _iter_windows(height, width, tile_size, scratch):
+                        core = tile.toslices()
+                        eroded_ice_mask[core] |= ~border[labels[core]]
+
+                # label floes remaining after erosion
+                nlabels, _ = label_tiled(
+                    eroded_ice_mask, labels, tile_size, release=scratch.release
+                )
+
+                # rewatershed, and find floes that intersect the dilated land mask
+                marker_halo = radius * (2 * it + 1) + 1
+                land_floes = np.zeros(nlabels + 1 + LUT_OFFSET, dtype=bool)
+                for tile in _iter_windows(height, width, tile_size, scratch):
+                    padded, inner = pad_window(tile, marker_halo, height, width)
+                    window, core = padded.toslices(), tile.toslices()
+                    markers = get_markers(
+                        inp[window],
+                        eroded_ice_mask[window],
+                        np.array(labels[window]),
+                        erosion_kernel,
+                        it,
+                    )
+                    with stage("watershed"):
+                        tile_watershed = cv2.watershed(
+                            np.ascontiguousarray(rgb_masked[window]), markers
+                        )[inner]
+                    watershed[core] = tile_watershed
+                    on_land = land_cloud_mask_dilated[core] & (tile_watershed > 1)
+                    land_floes |= get_labels_in_mask(tile_watershed, on_land, nlabels)
+
+                # get rid of floes on land, then measure the remaining ones
+                areas = np.zeros(nlabels + 1 + LUT_OFFSET, dtype=np.int64)
+                with stage("filter"):
+                    for tile in _iter_windows(height, width, tile_size, scratch):
+                        core = tile.toslices()
+                        tile_watershed = filter_labels(
+                            np.array(watershed[core]), land_floes
+                        )
+                        mask_image(tile_watershed, ~input_no[core], 1)
+                        areas += get_label_areas(tile_watershed, nlabels)
+                        watershed[core] = tile_watershed
+
+                    # get rid of ones that are too small
+                    area_lim = (it) ** 4
+                    small_floes = get_small_labels(areas, area_lim)
+                    add_round_counts(nlabels, land_floes, areas, small_floes, area_lim)
+
+                round_dst = None
+                if save_figs:
+                    round_dst = open_label_band_writer(
+                        f"identification_round_{r}.tif",
+                        get_max_label(areas, small_floes),
+                    )
+                for band in iter_bands(height, width, tile_size):
+                    band_watershed = np.zeros((band.height, width), dtype=np.int32)
+                    for tile in iter_tiles(band, tile_size):
+                        core = tile.toslices()
+                        tile_watershed = filter_labels(
+                            np.array(watershed[core]), small_floes
+                        )
+                        band_watershed[:, core[1]] = tile_watershed
+
+                        input_no[core] = ice_mask[core] + inp[core]
+                        inp[core] = (tile_watershed == 1) & inp[core] & ice_mask[core]
+                        tile_watershed[tile_watershed < 2] = 0
+                        output[core] += tile_watershed
+                        scratch.release()
+
+                    if save_figs:
+                        with stage("write"):
+                            round_dst.write(band_watershed, 1, window=band)
+
+        # opening, tile by tile, then writing the labels band by band once the
+        # largest one is known
+        final = scratch.create("final", np.int32, shape)
+        max_label = 0
+        for tile in _iter_windows(height, width, tile_size, scratch):
+            padded, inner = pad_window(tile, 2, height, width)
+            with stage("opening"):
+                tile_final = opening(output[padded.toslices()])[inner]
+            final[tile.toslices()] = tile_final
+            max_label = max(max_label, int(tile_final.max()))
+        final_dst = open_label_band_writer(f"{sat}_final.tif", max_label)
+        for band in iter_bands(height, width, tile_size):
+            with stage("write"):
+                final_dst.write(final[band.toslices()], 1, window=band)
+            scratch.release()
+
+        # saving the props table
+        props = get_props_table(final, red_c, scratch.release)
+        write_features(props, save_direc, res, sat, doy, output_format)
+
+
 def preprocess(
     ftci,
     fcloud,
@@ -233,20 +1397,68 @@ def preprocess(
     erosion_kernel_size,
     save_figs,
     save_direc,
+    tile_size=None,
+    threshold_method="gaussian",
+    output_format="csv",
+    background_writes=False,
+    min_usable_fraction=0.0,
+    threads=1,
+    label_compress="deflate",
+    mask_values_file=MASK_VALUES_FILE,
+    land_mask_dilated=None,
 ):
     try:
-        _preprocess(
-            ftci,
-            fcloud,
-            land_mask,
-            itmax,
-            itmin,
-            step,
-            erosion_kernel_type,
-            erosion_kernel_size,
-            save_figs,
-            save_direc,
-        )
+        validate_threshold_method(threshold_method)
+        validate_output_format(output_format)
+        validate_label_compress(label_compress)
+        if tile_size:
+            _preprocess_tiled(
+                ftci,
+                fcloud,
+                land_mask,
+                itmax,
+                itmin,
+                step,
+                erosion_kernel_type,
+                erosion_kernel_size,
+                save_figs,
+                save_direc,
+                tile_size,
+                threshold_method,
+                output_format,
+                min_usable_fraction,
+                label_compress,
+                land_mask_dilated,
+                mask_values_file,
+            )
+        else:
+            with ExitStack() as stack:
+                writer = None
+                if background_writes:
+                    writer = stack.enter_context(BackgroundWriter())
+                _preprocess(
+                    ftci,
+                    fcloud,
+                    land_mask,
+                    itmax,
+                    itmin,
+                    step,
+                    erosion_kernel_type,
+                    erosion_kernel_size,
+                    save_figs,
+                    save_direc,
+                    threshold_method,
+                    output_format,
+                    writer,
+                    min_usable_fraction,
+                    threads,
+                    label_compress,
+                    land_mask_dilated,
+                    mask_values_file,
+                )
+                if writer is not None:
+                    with stage("write_wait"):
+                        writer.close()
     except Exception as e:
         logger.exception(f"Error processing {fcloud} and {ftci}: {e}")
         raise
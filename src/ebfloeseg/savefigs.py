@@ -1,25 +1,63 @@
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Union
+from typing import Iterator, Optional, Union
+from uuid import uuid4
 
 import numpy as np
 import rasterio
+import rasterio.shutil
 from rasterio import DatasetReader
+from rasterio.io import DatasetWriter
 from numpy.typing import NDArray
-from matplotlib import pyplot as plt
 
+from ebfloeseg.metrics import stage, timed
+from ebfloeseg.outputs import validate_label_compress
 
-def imsave(
+# the tile size of the label images and their overviews
+LABEL_BLOCK_SIZE = 512
+
+
+def get_label_dtype(max_label: int) -> str:
+    """
+    The smallest unsigned type holding the labels up to `max_label`.
+
+    The largest value of the type is kept for the watershed lines (-1), which
+    wrap to it when cast.
+
+    Args:
+        max_label (int): The largest label of the image.
+
+    Returns:
+        str: "uint16" or "uint32".
+    """
+    for dtype in ("uint16", "uint32"):
+        if max_label < np.iinfo(dtype).max:
+            return dtype
+    raise ValueError(f"Labels up to {max_label} do not fit in uint32")
+
+
+def imopen_write(
     tci: DatasetReader,
-    img: NDArray,
     save_direc: Path,
-    doy: str,
     fname: Union[str, Path],
     count: int = 3,
     compress: str = "lzw",
-    rollaxis: bool = True,
-    as_uint8: bool = False,
     res=None,
-) -> None:
+) -> DatasetWriter:
+    """
+    Open the raster `imsave` would write, for callers writing it window by window.
+
+    Args:
+        tci (DatasetReader): The dataset whose profile is reused for the output.
+        save_direc (Path): The output directory.
+        fname (str | Path): The output file name, prefixed with `res` if given.
+        count (int, optional): The number of bands. Defaults to 3.
+        compress (str, optional): The compression codec. Defaults to "lzw".
+        res (str, optional): The date prefix of the file name. Defaults to None.
+
+    Returns:
+        DatasetWriter: The opened output raster.
+    """
     profile = tci.profile
     profile.update(
         dtype=rasterio.uint8,  # sample images are uint8; might not be needed? CP
@@ -27,12 +65,136 @@ def imsave(
         compress=compress,
     )
 
-    if res:
-        fname = save_direc / f"{res}_{fname}"
-    else:
-        fname = save_direc / fname
+    return rasterio.open(_get_fname(save_direc, fname, res), "w", **profile)
+
+
+def _get_fname(save_direc, fname, res=None):
+    return save_direc / f"{res}_{fname}" if res else save_direc / fname
+
+
+@contextmanager
+def open_label_writer(
+    tci: DatasetReader,
+    save_direc: Path,
+    fname: Union[str, Path],
+    max_label: int,
+    compress: str = "deflate",
+    res=None,
+    temp_direc: Optional[Path] = None,
+) -> Iterator[DatasetWriter]:
+    """
+    Open a one-band label image, for callers writing it window by window.
+
+    The labels are written with the type from `get_label_dtype` to a tiled
+    temporary image, which is copied on closing to a Cloud Optimized GeoTIFF:
+    compressed tiles of `LABEL_BLOCK_SIZE` pixels and nearest neighbour
+    overviews, so windows and zoomed out views of it are read quickly. GDAL
+    compresses the tiles on all cores.
+
+    Args:
+        tci (DatasetReader): The dataset whose georeferencing is reused.
+        save_direc (Path): The output directory.
+        fname (str | Path): The output file name, prefixed with `res` if given.
+        max_label (int): The largest label written.
+        compress (str, optional): One of `outputs.LABEL_CODECS`. Defaults to "deflate".
+        res (str, optional): The date prefix of the file name. Defaults to None.
+        temp_direc (Path, optional): The directory of the temporary image, for
+            images too large for memory. Defaults to None, in memory.
+
+    Yields:
+        DatasetWriter: The temporary image; arrays written to it are cast to its
+        type.
+    """
+    validate_label_compress(compress)
+    temp = f"/vsimem/{uuid4().hex}.tif"
+    if temp_direc is not None:
+        temp = str(Path(temp_direc) / f"{uuid4().hex}.tif")
+    profile = dict(
+        driver="GTiff",
+        width=tci.width,
+        height=tci.height,
+        count=1,
+        dtype=get_label_dtype(max_label),
+        crs=tci.crs,
+        transform=tci.transform,
+        tiled=True,
+        blockxsize=LABEL_BLOCK_SIZE,
+        blockysize=LABEL_BLOCK_SIZE,
+        bigtiff="IF_SAFER",
+    )
+    try:
+        with rasterio.open(temp, "w", **profile) as dst:
+            yield _CastingWriter(dst)
+        with stage("cog"):
+            rasterio.shutil.copy(
+                temp,
+                _get_fname(save_direc, fname, res),
+                driver="COG",
+                compress=compress.upper(),
+                predictor="YES",
+                blocksize=LABEL_BLOCK_SIZE,
+                overview_resampling="NEAREST",
+                num_threads="ALL_CPUS",
+                bigtiff="IF_SAFER",
+            )
+    finally:
+        if rasterio.shutil.exists(temp):
+            rasterio.shutil.delete(temp)
+
+
+class _CastingWriter:
+    # a DatasetWriter casting the arrays written to the type of the image, as
+    # rasterio refuses int32 labels in a uint16 image
+
+    def __init__(self, dst: DatasetWriter):
+        self._dst = dst
 
-    with rasterio.open(fname, "w", **profile) as dst:
+    def write(self, arr: NDArray, indexes=1, **kwargs) -> None:
+        self._dst.write(arr.astype(self._dst.dtypes[0], copy=False), indexes, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._dst, name)
+
+
+@timed("write")
+def imsave_labels(
+    tci: DatasetReader,
+    labels: NDArray,
+    save_direc: Path,
+    fname: Union[str, Path],
+    compress: str = "deflate",
+    res=None,
+) -> None:
+    """
+    Save a label image with `open_label_writer`.
+
+    Args:
+        tci (DatasetReader): The dataset whose georeferencing is reused.
+        labels (NDArray): The integer labels; -1 marks watershed lines.
+        save_direc (Path): The output directory.
+        fname (str | Path): The output file name, prefixed with `res` if given.
+        compress (str, optional): One of `outputs.LABEL_CODECS`. Defaults to "deflate".
+        res (str, optional): The date prefix of the file name. Defaults to None.
+    """
+    max_label = int(labels.max(initial=0))
+    with open_label_writer(tci, save_direc, fname, max_label, compress, res) as dst:
+        dst.write(labels, 1)
+
+
+@timed("write")
+def imsave(
+    tci: DatasetReader,
+    img: NDArray,
+    save_direc: Path,
+    doy: str,
+    fname: Union[str, Path],
+    count: int = 3,
+    compress: str = "lzw",
+    rollaxis: bool = True,
+    as_uint8: bool = False,
+    res=None,
+) -> None:
+    with imopen_write(tci, save_direc, fname, count, compress, res) as dst:
         if rollaxis:
             img = np.rollaxis(img, axis=2)
             dst.write(img)
@@ -46,9 +208,31 @@ def imsave(
 def save_ice_mask_hist(
     red_masked, bins, mincut, maxcut, doy, target_dir, color="r", figsize=(6, 2)
 ):
-    fig, ax = plt.subplots(1, 1, figsize=figsize)
-    plt.hist(red_masked.flatten(), bins=bins, color=color)
-    plt.axvline(mincut)
-    plt.axvline(maxcut)
-    plt.savefig(target_dir / f"ice_mask_hist.png")
+    counts, _ = np.histogram(red_masked, bins=bins)
+    return save_ice_mask_hist_counts(
+        counts, bins, mincut, maxcut, doy, target_dir, color, figsize
+    )
+
+
+@timed("write")
+def save_ice_mask_hist_counts(
+    counts, bins, mincut, maxcut, doy, target_dir, color="r", figsize=(6, 2)
+):
+    """
+    Save the ice mask histogram from precomputed bin counts.
+
+    Same figure as `save_ice_mask_hist`, for callers that accumulate the
+    histogram without holding the whole masked red channel in memory.
+
+    The figure is made without pyplot, whose current figure is shared by the
+    threads of a process, so scenes on several threads can save theirs at once.
+    """
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=figsize)
+    ax = fig.subplots(1, 1)
+    ax.hist(bins[:-1], bins=bins, weights=counts, color=color)
+    ax.axvline(mincut)
+    ax.axvline(maxcut)
+    fig.savefig(target_dir / f"ice_mask_hist.png")
     return ax
@@ -0,0 +1,289 @@
+import multiprocessing
+import os
+import pickle
+import threading
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
+from itertools import count
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional
+
+# peak resident memory per scene pixel, measured on synthetic scenes
+SCENE_BYTES_PER_PIXEL = 80  # whole-image processing
+TILED_BYTES_PER_PIXEL = 50  # tiled processing, dominated by the props table
+WORKER_OVERHEAD_BYTES = 200 * 2**20  # interpreter and imported libraries
+
+
+def estimate_scene_memory(ftci: Path, tile_size: Optional[int] = None) -> int:
+    """
+    Estimate the peak memory of processing a scene from its raster size.
+
+    Args:
+        ftci (Path): The truecolor image of the scene.
+        tile_size (int, optional): The tile size the scene is processed with.
+
+    Returns:
+        int: The estimated peak memory in bytes.
+    """
+    import rasterio
+
+    with rasterio.open(ftci) as src:
+        pixels = src.height * src.width
+    per_pixel = TILED_BYTES_PER_PIXEL if tile_size else SCENE_BYTES_PER_PIXEL
+    return WORKER_OVERHEAD_BYTES + pixels * per_pixel
+
+
+def read_meminfo() -> dict[str, int]:
+    """Read /proc/meminfo in bytes by field, or nothing where it does not exist."""
+    try:
+        lines = Path("/proc/meminfo").read_text().splitlines()
+    except OSError:
+        return {}
+    meminfo = {}
+    for line in lines:
+        name, _, value = line.partition(":")
+        fields = value.split()
+        if fields and fields[0].isdigit():
+            unit = 1024 if fields[1:] == ["kB"] else 1
+            meminfo[name] = int(fields[0]) * unit
+    return meminfo
+
+
+def get_available_memory() -> Optional[int]:
+    """
+    Return the memory available to new processes in bytes, or None if unknown.
+
+    This is MemAvailable on Linux, which counts the page cache the kernel can
+    reclaim, e.g. of the scenes read so far. Elsewhere it is the free memory.
+    """
+    available = read_meminfo().get("MemAvailable")
+    if available is not None:
+        return available
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def get_default_workers(ftcis: Iterable[Path], tile_size: Optional[int] = None) -> int:
+    """
+    Choose a number of workers that fits the largest scene in memory.
+
+    Only the largest file is opened, to keep startup short on a large archive:
+    the scenes of an archive share a compression, so the largest file is
+    taken to hold the largest raster.
+
+    Args:
+        ftcis (Iterable[Path]): The truecolor images to process.
+        tile_size (int, optional): The tile size the scenes are processed with.
+
+    Returns:
+        int: The number of workers, at least 1 and at most the CPU count.
+    """
+    cpus = os.cpu_count() or 1
+    available = get_available_memory()
+    largest = max(ftcis, key=os.path.getsize, default=None)
+    scene_memory = 0
+    if largest is not None:
+        scene_memory = estimate_scene_memory(largest, tile_size)
+    if available is None or scene_memory == 0:
+        return cpus
+    return max(1, min(cpus, available // scene_memory))
+
+
+def submit_bounded(
+    executor: Executor,
+    fn: Callable,
+    jobs: Iterable[tuple],
+    max_in_flight: int,
+) -> Iterator[tuple[tuple, Future]]:
+    """
+    Submit jobs keeping at most `max_in_flight` of them pending.
+
+    Args:
+        executor (Executor): The executor to submit to.
+        fn (Callable): The function to call.
+        jobs (Iterable[tuple]): The arguments of each call.
+        max_in_flight (int): The number of jobs submitted but not done.
+
+    Yields:
+        tuple[tuple, Future]: Each job with its future, as they complete.
+    """
+    jobs = iter(jobs)
+    pending = {}
+    while True:
+        for job in jobs:
+            pending[executor.submit(fn, *job)] = job
+            if len(pending) >= max_in_flight:
+                break
+        if not pending:
+            return
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield pending.pop(future), future
+
+
+# the task and result queues of a `HybridPoolExecutor` worker process
+_hybrid_queues: tuple = ()
+
+
+def _init_hybrid_worker(tasks, results, initializer, initargs) -> None:
+    global _hybrid_queues
+    _hybrid_queues = (tasks, results)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _run_hybrid_task(task: bytes) -> tuple[int, bytes]:
+    task_id, fn, args, kwargs = pickle.loads(task)
+    try:
+        outcome = (True, fn(*args, **kwargs))
+    except BaseException as e:
+        outcome = (False, e)
+    try:
+        return task_id, pickle.dumps(outcome)
+    except Exception as e:
+        error = RuntimeError(f"Could not pickle the outcome of {fn}: {e!r}")
+        return task_id, pickle.dumps((False, error))
+
+
+def _run_hybrid_worker(threads: int) -> None:
+    # takes a task only when a thread is free, so idle processes get the others
+    tasks, results = _hybrid_queues
+    free = threading.Semaphore(threads)
+
+    def run(task):
+        try:
+            results.put(_run_hybrid_task(task))
+        finally:
+            free.release()
+
+    with ThreadPoolExecutor(threads) as executor:
+        while True:
+            free.acquire()
+            task = tasks.get()
+            if task is None:
+                return
+            executor.submit(run, task)
+
+
+class HybridPoolExecutor(Executor):
+    """
+    Run calls on `processes` worker processes of `threads` threads each.
+
+    Calls releasing the GIL share the memory and imports of their process
+    like threads, while the processes keep the Python parts of several calls
+    running at once. The calls, their arguments and results are pickled as
+    for a `ProcessPoolExecutor`. Cancelling a future does not stop its call.
+
+    Args:
+        processes (int): The number of worker processes.
+        threads (int): The number of threads of each process.
+        initializer (Callable, optional): Called once in each process.
+        initargs (tuple, optional): The arguments of `initializer`.
+        max_workers (int, optional): The number of calls run at once, if fewer
+            than `processes` * `threads`: the last process runs fewer threads.
+            Defaults to None.
+    """
+
+    def __init__(
+        self,
+        processes: int,
+        threads: int,
+        initializer: Optional[Callable] = None,
+        initargs: tuple = (),
+        max_workers: Optional[int] = None,
+    ):
+        process_threads = [threads] * processes
+        if max_workers is not None:
+            if not processes * threads - threads < max_workers <= processes * threads:
+                raise ValueError(
+                    f"{processes} processes of {threads} threads cannot run "
+                    f"{max_workers} calls at once"
+                )
+            process_threads[-1] -= processes * threads - max_workers
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._futures: dict[int, Future] = {}
+        self._ids = count()
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self._broken = None
+        self._processes = ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=_init_hybrid_worker,
+            initargs=(self._tasks, self._results, initializer, initargs),
+        )
+        self._workers = [
+            self._processes.submit(_run_hybrid_worker, n) for n in process_threads
+        ]
+        for worker in self._workers:
+            worker.add_done_callback(self._worker_done)
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def _collect(self) -> None:
+        while (result := self._results.get()) is not None:
+            task_id, outcome = result
+            with self._lock:
+                future = self._futures.pop(task_id, None)
+            # failed already if a worker stopped
+            if future is None or not future.set_running_or_notify_cancel():
+                continue
+            ok, value = pickle.loads(outcome)
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def _worker_done(self, worker: Future) -> None:
+        if worker.cancelled() or worker.exception() is None:
+            return
+        with self._lock:
+            self._broken = worker.exception()
+            futures, self._futures = self._futures, {}
+        for future in futures.values():
+            if future.set_running_or_notify_cancel():
+                future.set_exception(
+                    BrokenProcessPool(f"A worker process stopped: {self._broken!r}")
+                )
+
+    def submit(self, fn: Callable, /, *args, **kwargs) -> Future:
+        with self._lock:
+            if self._broken is not None:
+                raise BrokenProcessPool(f"A worker process stopped: {self._broken!r}")
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            task_id = next(self._ids)
+            task = pickle.dumps((task_id, fn, args, kwargs))
+            future = self._futures[task_id] = Future()
+            self._tasks.put(task)
+        return future
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        with self._lock:
+            self._shutdown = True
+            futures = list(self._futures.values())
+        if cancel_futures:
+            for future in futures:
+                future.cancel()
+        if wait:
+            self._stop(futures)
+        else:
+            threading.Thread(target=self._stop, args=(futures,), daemon=True).start()
+
+    def _stop(self, futures: list[Future]) -> None:
+        # the calls submitted finish before the workers are told to stop
+        wait(futures)
+        for _ in self._workers:
+            self._tasks.put(None)
+        self._processes.shutdown()
+        self._results.put(None)
+        self._collector.join()
@@ -0,0 +1,164 @@
+import json
+import os
+from pathlib import Path
+from typing import Sequence
+
+from ebfloeseg.metrics import METRICS_FILE
+from ebfloeseg.outputs import MASK_VALUES_FILE
+
+MANIFEST_DIREC = "manifests"
+
+
+def get_shard(pairs: Sequence, shard_index: int, shard_count: int) -> list:
+    """
+    Select the scenes of one shard of a run.
+
+    Scenes are dealt round-robin in sorted order, so every shard gets a
+    deterministic, nearly equal share.
+
+    Args:
+        pairs (Sequence): The (ftci, fcloud) pairs of the run.
+        shard_index (int): The index of the shard, from 0.
+        shard_count (int): The number of shards.
+
+    Returns:
+        list: The pairs of the shard.
+    """
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(
+            f"shard index {shard_index} out of range for {shard_count} shards"
+        )
+    return sorted(pairs)[shard_index::shard_count]
+
+
+def get_manifest_path(save_direc: Path, shard_index: int, shard_count: int) -> Path:
+    """Return the manifest file of a shard."""
+    fname = f"shard-{shard_index:04d}-of-{shard_count:04d}.json"
+    return Path(save_direc) / MANIFEST_DIREC / fname
+
+
+def get_shard_fname(fname: str, shard_index: int, shard_count: int) -> str:
+    """
+    Return the name of a shard's own copy of a file the scenes append to.
+
+    Appends from several hosts to a shared file are not atomic on network
+    file systems, so each shard appends to its own file, e.g.
+    "metrics.shard-0001-of-0004.jsonl", and `merge_shard_files` concatenates
+    them. A run of one shard uses `fname` itself.
+    """
+    if shard_count == 1:
+        return fname
+    stem, dot, suffix = fname.rpartition(".")
+    return f"{stem}.shard-{shard_index:04d}-of-{shard_count:04d}{dot}{suffix}"
+
+
+def merge_shard_files(save_direc: Path, shard_count: int) -> list[Path]:
+    """
+    Concatenate the metrics and mask values files of the shards of a run.
+
+    The metrics of the run and the mask values of each day are replaced by
+    the files of the shards, in shard order; the files of the shards are
+    kept, so a shard run again is merged again.
+
+    Args:
+        save_direc (Path): The output directory shared by the shards.
+        shard_count (int): The number of shards.
+
+    Returns:
+        list[Path]: The files written.
+    """
+    save_direc = Path(save_direc)
+    targets = [save_direc / METRICS_FILE]
+    targets += [
+        d / MASK_VALUES_FILE for d in sorted(save_direc.iterdir()) if d.is_dir()
+    ]
+    written = []
+    for target in targets:
+        parts = [
+            target.parent / get_shard_fname(target.name, i, shard_count)
+            for i in range(shard_count)
+        ]
+        parts = [p for p in parts if p.exists()]
+        if not parts:
+            continue
+        tmp = target.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            for part in parts:
+                f.write(part.read_bytes())
+        os.replace(tmp, target)
+        written.append(target)
+    return written
+
+
+def _scene_record(pair: Sequence[Path]) -> dict[str, str]:
+    ftci, fcloud = pair
+    return {"ftci": str(ftci), "fcloud": str(fcloud)}
+
+
+def _write_json(path: Path, obj: dict) -> None:
+    # write then rename, so readers never see a partial file
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(obj, indent=2))
+    os.replace(tmp, path)
+
+
+class ShardManifest:
+    """
+    The scenes a shard was given and the ones it completed.
+
+    The manifest is rewritten after every completed scene, so it is up to
+    date if the shard is killed.
+    """
+
+    def __init__(
+        self, save_direc: Path, shard_index: int, shard_count: int, pairs: Sequence
+    ):
+        self.path = get_manifest_path(save_direc, shard_index, shard_count)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.manifest = {
+            "shard_index": shard_index,
+            "shard_count": shard_count,
+            "scenes": [_scene_record(pair) for pair in pairs],
+            "completed": [],
+        }
+        _write_json(self.path, self.manifest)
+
+    def add(self, *pairs: Sequence[Path]) -> None:
+        """Record completed scenes, rewriting the manifest once."""
+        self.manifest["completed"] += [_scene_record(pair) for pair in pairs]
+        _write_json(self.path, self.manifest)
+
+
+def merge_manifests(save_direc: Path, shard_count: int, pairs: Sequence) -> dict:
+    """
+    Combine the manifests of all shards of a run into a run manifest.
+
+    The run manifest is written to `save_direc / "manifest.json"` and lists the
+    completed scenes and the ones missing, i.e. not completed by any shard.
+
+    Args:
+        save_direc (Path): The output directory shared by the shards.
+        shard_count (int): The number of shards.
+        pairs (Sequence): The (ftci, fcloud) pairs of the run.
+
+    Returns:
+        dict: The run manifest.
+    """
+    completed, missing_shards = [], []
+    for shard_index in range(shard_count):
+        path = get_manifest_path(save_direc, shard_index, shard_count)
+        if not path.exists():
+            missing_shards.append(shard_index)
+            continue
+        completed += json.loads(path.read_text())["completed"]
+
+    done = {(c["ftci"], c["fcloud"]) for c in completed}
+    scenes = [_scene_record(pair) for pair in sorted(pairs)]
+    manifest = {
+        "shard_count": shard_count,
+        "missing_shards": missing_shards,
+        "completed": [s for s in scenes if (s["ftci"], s["fcloud"]) in done],
+        "missing": [s for s in scenes if (s["ftci"], s["fcloud"]) not in done],
+    }
+    _write_json(Path(save_direc) / "manifest.json", manifest)
+    return manifest
@@ -0,0 +1,216 @@
+import cv2
+import numpy as np
+from numpy.typing import NDArray
+from skimage.filters import threshold_local
+
+from ebfloeseg.metrics import timed
+from ebfloeseg.outputs import validate_threshold_method
+from ebfloeseg.tiling import get_threshold_radius
+
+# grid spacing of the "downsample" method, in pixels
+DOWNSAMPLE_FACTOR = 8
+
+
+def threshold_mean(red: NDArray, block_size: int) -> NDArray[np.float64]:
+    """
+    Local mean of each pixel over a square block, with reflected borders.
+
+    Same as `threshold_local(red, block_size, method="mean")` for integer
+    images, computed with running sums.
+
+    Args:
+        red (NDArray): The image.
+        block_size (int): The (odd) side of the block.
+
+    Returns:
+        NDArray[np.float64]: The threshold of each pixel.
+    """
+    return cv2.boxFilter(
+        red,
+        cv2.CV_64F,
+        (block_size, block_size),
+        normalize=True,
+        borderType=cv2.BORDER_REFLECT,
+    )
+
+
+def accumulate_block_sums(
+    sums: NDArray[np.int64],
+    counts: NDArray[np.int64],
+    band: NDArray,
+    row_off: int,
+    factor: int = DOWNSAMPLE_FACTOR,
+) -> None:
+    """
+    Add the pixels of a band to the sums and counts of a grid of blocks inplace.
+
+    Args:
+        sums (NDArray[np.int64]): The sum of each `factor` x `factor` block.
+        counts (NDArray[np.int64]): The number of pixels of each block.
+        band (NDArray): Full-width rows of the image.
+        row_off (int): The row of the image the band starts at.
+        factor (int, optional): The block side. Defaults to DOWNSAMPLE_FACTOR.
+    """
+    height, width = band.shape
+    pad = -width % factor
+    padded = np.pad(band.astype(np.int64), ((0, 0), (0, pad)))
+    row_sums = padded.reshape(height, -1, factor).sum(axis=2)
+    col_counts = np.full(row_sums.shape[1], factor)
+    col_counts[-1] -= pad
+
+    block_rows = (row_off + np.arange(height)) // factor
+    starts = np.flatnonzero(np.diff(block_rows, prepend=-1))
+    sums[block_rows[starts]] += np.add.reduceat(row_sums, starts, axis=0)
+    counts[block_rows[starts]] += np.diff(np.append(starts, height))[:, None] * (
+        col_counts
+    )
+
+
+def get_grid_shape(shape: tuple[int, int], factor: int = DOWNSAMPLE_FACTOR):
+    """The shape of the grid of blocks covering an image."""
+    return tuple(-(-n // factor) for n in shape)
+
+
+def threshold_coarse(
+    sums: NDArray[np.int64], counts: NDArray[np.int64], block_size: int, factor: int
+) -> NDArray[np.float64]:
+    """
+    Gaussian threshold of the block means, with the block size scaled down.
+    """
+    coarse_block_size = max(3, int(block_size / factor) | 1)
+    return threshold_local(sums / counts, block_size=coarse_block_size)
+
+
+def upsample(
+    coarse: NDArray, factor: int, rows: slice, cols: slice, shape: tuple[int, int]
+) -> NDArray[np.float64]:
+    """
+    Bilinearly interpolate a grid of block values at the pixels of a window.
+
+    Block values sit at the block centers and are clamped at the image edges,
+    as with `cv2.resize`. Any window gives the same values as the whole image.
+
+    Args:
+        coarse (NDArray): The value of each block.
+        factor (int): The block side.
+        rows (slice): The rows of the window.
+        cols (slice): The columns of the window.
+        shape (tuple[int, int]): The shape of the image.
+
+    Returns:
+        NDArray[np.float64]: The values at the pixels of the window.
+    """
+
+    def weights(index, n):
+        pos = np.clip((index + 0.5) / factor - 0.5, 0, n - 1)
+        lower = np.minimum(pos.astype(int), n - 1)
+        upper = np.minimum(lower + 1, n - 1)
+        return lower, upper, pos - lower
+
+    height, width = shape
+    r0, r1, wr = weights(np.arange(height)[rows], coarse.shape[0])
+    c0, c1, wc = weights(np.arange(width)[cols], coarse.shape[1])
+    top = coarse[r0][:, c0] * (1 - wc) + coarse[r0][:, c1] * wc
+    bottom = coarse[r1][:, c0] * (1 - wc) + coarse[r1][:, c1] * wc
+    return top * (1 - wr[:, None]) + bottom * wr[:, None]
+
+
+def threshold_downsample(
+    red: NDArray, block_size: int, factor: int = DOWNSAMPLE_FACTOR
+) -> NDArray[np.float64]:
+    """
+    Approximate the gaussian threshold on a grid `factor` times coarser.
+
+    Args:
+        red (NDArray): The image.
+        block_size (int): The (odd) block size of the gaussian threshold.
+        factor (int, optional): The grid spacing. Defaults to DOWNSAMPLE_FACTOR.
+
+    Returns:
+        NDArray[np.float64]: The threshold of each pixel.
+    """
+    shape = red.shape
+    sums = np.zeros(get_grid_shape(shape, factor), dtype=np.int64)
+    counts = np.zeros_like(sums)
+    accumulate_block_sums(sums, counts, red, 0, factor)
+    coarse = threshold_coarse(sums, counts, block_size, factor)
+    return upsample(coarse, factor, slice(None), slice(None), shape)
+
+
+@timed("threshold")
+def get_local_threshold(
+    red: NDArray, block_size: int, method: str = "gaussian"
+) -> NDArray[np.float64]:
+    """
+    Compute the adaptive threshold of an image.
+
+    Args:
+        red (NDArray): The image.
+        block_size (int): The (odd) block size.
+        method (str, optional): One of outputs.THRESHOLD_METHODS. Defaults to "gaussian".
+
+    Returns:
+        NDArray[np.float64]: The threshold of each pixel.
+    """
+    if method == "gaussian":
+        return threshold_local(red, block_size=block_size)
+    if method == "mean":
+        return threshold_mean(red, block_size)
+    if method == "downsample":
+        return threshold_downsample(red, block_size)
+    validate_threshold_method(method)
+
+
+def get_window_threshold(
+    red: NDArray,
+    block_size: int,
+    window: tuple[slice, slice],
+    method: str = "gaussian",
+) -> NDArray[np.float64]:
+    """
+    Compute the adaptive threshold of a window of an image.
+
+    Same values as `get_local_threshold(red, block_size, method)[window]`: the
+    window is padded with the pixels its threshold depends on, and the
+    "downsample" grid, which is cheap, is computed for the whole image.
+
+    Args:
+        red (NDArray): The image.
+        block_size (int): The (odd) block size.
+        window (tuple[slice, slice]): The rows and columns of the window.
+        method (str, optional): One of outputs.THRESHOLD_METHODS. Defaults to "gaussian".
+
+    Returns:
+        NDArray[np.float64]: The threshold of each pixel of the window.
+    """
+    if method == "downsample":
+        sums = np.zeros(get_grid_shape(red.shape), dtype=np.int64)
+        counts = np.zeros_like(sums)
+        accumulate_block_sums(sums, counts, red, 0)
+        coarse = threshold_coarse(sums, counts, block_size, DOWNSAMPLE_FACTOR)
+        return upsample(coarse, DOWNSAMPLE_FACTOR, *window, red.shape)
+
+    halo = get_threshold_halo(block_size, method)
+    padded = tuple(
+        slice(max(s.start - halo, 0), min(s.stop + halo, n))
+        for s, n in zip(window, red.shape)
+    )
+    inner = tuple(
+        slice(s.start - p.start, s.stop - p.start) for s, p in zip(window, padded)
+    )
+    red = np.ascontiguousarray(red[padded])
+    return get_local_threshold(red, block_size, method)[inner]
+
+
+def get_threshold_halo(block_size: int, method: str = "gaussian") -> int:
+    """
+    The number of pixels on each side the threshold of a pixel depends on.
+
+    The "downsample" threshold of a tile is interpolated from a grid computed
+    for the whole image beforehand, so it needs no halo.
+    """
+    if method == "gaussian":
+        return get_threshold_radius(block_size)
+    if method == "mean":
+        return block_size // 2
+    return 0
@@ -0,0 +1,332 @@
+import mmap
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+import cv2
+import numpy as np
+from numpy.typing import ArrayLike, NDArray
+from rasterio.windows import Window
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from ebfloeseg.metrics import add_allocation, timed
+
+
+class ScratchArrays:
+    """
+    Scene-sized scratch arrays backed by files in a directory.
+
+    The pages of the arrays are dropped from the resident set by `release`, so
+    the memory of a tiled run stays bounded by the tiles it holds.
+    """
+
+    def __init__(self, direc: Path):
+        self.direc = Path(direc)
+        self._maps: list[mmap.mmap] = []
+
+    def create(self, name: str, dtype, shape: tuple[int, ...]) -> NDArray:
+        """
+        Create a zero-filled array.
+
+        Args:
+            name (str): The name of the backing file.
+            dtype: The data type of the array.
+            shape (tuple[int, ...]): The shape of the array.
+
+        Returns:
+            NDArray: The array.
+        """
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with open(self.direc / f"{name}.dat", "w+b") as f:
+            f.truncate(max(nbytes, 1))
+            buffer = mmap.mmap(f.fileno(), max(nbytes, 1))
+        self._maps.append(buffer)
+        add_allocation(nbytes)
+        return np.ndarray(shape, dtype=dtype, buffer=buffer)
+
+    def release(self) -> None:
+        """Drop the pages of all arrays from memory; their contents are kept."""
+        for buffer in self._maps:
+            buffer.madvise(mmap.MADV_DONTNEED)
+
+
+def get_threshold_radius(block_size: int) -> int:
+    """
+    Radius of the Gaussian kernel used by `threshold_local` for a block size.
+
+    Args:
+        block_size (int): The block size passed to `threshold_local`.
+
+    Returns:
+        int: The number of pixels on each side the threshold depends on.
+    """
+    sigma = (block_size - 1) / 6.0
+    return int(4.0 * sigma + 0.5)  # scipy.ndimage.gaussian_filter truncate=4.0
+
+
+def get_kernel_radius(erosion_kernel: ArrayLike) -> int:
+    """
+    Return the radius of a structuring element.
+
+    Args:
+        erosion_kernel (ArrayLike): The structuring element.
+
+    Returns:
+        int: The largest distance from the anchor covered by the kernel.
+    """
+    return max(np.shape(erosion_kernel)) // 2
+
+
+def iter_bands(height: int, width: int, tile_size: int) -> Iterator[Window]:
+    """
+    Iterate over full-width bands of at most `tile_size` rows.
+
+    Args:
+        height (int): The raster height.
+        width (int): The raster width.
+        tile_size (int): The number of rows per band.
+
+    Yields:
+        Window: The window of each band, top to bottom.
+    """
+    for row_off in range(0, height, tile_size):
+        yield Window(0, row_off, width, min(tile_size, height - row_off))
+
+
+def iter_tiles(band: Window, tile_size: int) -> Iterator[Window]:
+    """
+    Iterate over the tiles of a band, left to right.
+
+    Args:
+        band (Window): A band from `iter_bands`.
+        tile_size (int): The tile width.
+
+    Yields:
+        Window: The window of each tile.
+    """
+    for col_off in range(0, band.width, tile_size):
+        width = min(tile_size, band.width - col_off)
+        yield Window(col_off, band.row_off, width, band.height)
+
+
+def pad_window(
+    window: Window, halo: int, height: int, width: int
+) -> tuple[Window, tuple[slice, slice]]:
+    """
+    Grow a window by `halo` pixels on each side, clipped to the raster.
+
+    Args:
+        window (Window): The window to pad.
+        halo (int): The number of pixels to add on each side.
+        height (int): The raster height.
+        width (int): The raster width.
+
+    Returns:
+        tuple[Window, tuple[slice, slice]]: The padded window and the slices
+        selecting `window` from an array read with it.
+    """
+    row_off = max(window.row_off - halo, 0)
+    col_off = max(window.col_off - halo, 0)
+    row_end = min(window.row_off + window.height + halo, height)
+    col_end = min(window.col_off + window.width + halo, width)
+    padded = Window(col_off, row_off, col_end - col_off, row_end - row_off)
+    inner = (
+        slice(window.row_off - row_off, window.row_off - row_off + window.height),
+        slice(window.col_off - col_off, window.col_off - col_off + window.width),
+    )
+    return padded, inner
+
+
+@timed("windows")
+def get_region_windows(
+    mask: NDArray[np.bool_], halo: int, cell: int = 16
+) -> list[Window]:
+    """
+    Find disjoint windows holding the connected regions of a mask.
+
+    Every 8-connected region lies in a single window together with its bounding
+    box grown by `halo` pixels, so the holes it encloses and anything within
+    `halo` pixels of it can be computed on the window alone. The windows are
+    aligned to a grid of `cell` pixels, which must be even for
+    `get_anchor_keys`, and no two of them touch.
+
+    Args:
+        mask (NDArray[np.bool_]): The mask.
+        halo (int): The margin kept around the regions.
+        cell (int, optional): The grid spacing. Defaults to 16.
+
+    Returns:
+        list[Window]: The windows, empty if the mask is.
+    """
+    height, width = mask.shape
+    occupied = np.logical_or.reduceat(mask, np.arange(0, height, cell), axis=0)
+    occupied = np.logical_or.reduceat(occupied, np.arange(0, width, cell), axis=1)
+    size = 2 * -(-halo // cell) + 1
+    grid = cv2.dilate(occupied.view(np.uint8), np.ones((size, size), np.uint8))
+
+    # the cells of a region are connected, so growing the groups of cells to
+    # their bounding boxes until none overlap keeps each region in one window
+    while True:
+        _, _, stats, _ = cv2.connectedComponentsWithStats(grid, connectivity=8)
+        boxes = stats[1:, :4]
+        filled = np.zeros_like(grid)
+        for col, row, ncols, nrows in boxes:
+            filled[row : row + nrows, col : col + ncols] = 1
+        if np.array_equal(filled, grid):
+            break
+        grid = filled
+
+    return [
+        Window(
+            col * cell,
+            row * cell,
+            min(ncols * cell, width - col * cell),
+            min(nrows * cell, height - row * cell),
+        )
+        for col, row, ncols, nrows in boxes.tolist()
+    ]
+
+
+def get_anchor_keys(labels: NDArray, window: Window, width: int) -> NDArray[np.int64]:
+    """
+    Key each connected component by the first 2x2 block it occupies.
+
+    `cv2.connectedComponents` numbers components in the raster order of the
+    first 2x2 pixel block they occupy, so sorting the keys of all components
+    of a raster gives their whole-raster labels. The window offsets must be even.
+
+    Args:
+        labels (NDArray): The connected components of the window.
+        window (Window): The window in the raster.
+        width (int): The raster width.
+
+    Returns:
+        NDArray[np.int64]: The key of each label (-1 for the background).
+    """
+    height, wwidth = labels.shape
+    bheight, bwidth = (height + 1) // 2, (wwidth + 1) // 2
+    blocks = np.zeros((2 * bheight, 2 * bwidth), dtype=labels.dtype)
+    blocks[:height, :wwidth] = labels
+    blocks = blocks.reshape(bheight, 2, bwidth, 2).max(axis=(1, 3))
+    ids, first = np.unique(blocks, return_index=True)
+    brow, bcol = np.divmod(first, bwidth)
+    keys = np.full(labels.max() + 1, -1, dtype=np.int64)
+    keys[ids] = (brow + window.row_off // 2) * ((width + 1) // 2)
+    keys[ids] += bcol + window.col_off // 2
+    keys[0] = -1
+    return keys
+
+
+def _seam_pairs(a: NDArray, b: NDArray, connectivity: int) -> list[NDArray]:
+    # labels of adjacent pixels on both sides of a seam
+    pairs = [np.stack([a, b])]
+    if connectivity == 8:
+        pairs.append(np.stack([a[:-1], b[1:]]))
+        pairs.append(np.stack([a[1:], b[:-1]]))
+    return [p[:, (p[0] > 0) & (p[1] > 0)] for p in pairs]
+
+
+@timed("label")
+def label_tiled(
+    mask: ArrayLike,
+    labels: NDArray,
+    tile_size: int,
+    connectivity: int = 8,
+    invert: bool = False,
+    release: Optional[Callable[[], None]] = None,
+) -> tuple[int, NDArray[np.bool_]]:
+    """
+    Label the connected components of a large mask tile by tile.
+
+    Each tile is labelled with `cv2.connectedComponents`; components are then
+    merged across tile seams and renumbered as `cv2.connectedComponents`
+    would number them on the whole mask.
+
+    Args:
+        mask (ArrayLike): The mask, e.g. a memory map.
+        labels (NDArray): The output labels, same shape as `mask`, of an
+            integer type; a ValueError is raised if the labels overflow it.
+        tile_size (int): The (even) tile size.
+        connectivity (int, optional): 4 or 8. Defaults to 8.
+        invert (bool, optional): Label the zero pixels of `mask` instead.
+        release (Callable, optional): Called after each tile, e.g. to drop the
+            pages of memory-mapped inputs.
+
+    Returns:
+        tuple[int, NDArray[np.bool_]]: The number of labels, background included,
+        and whether each label touches the border of the raster.
+    """
+    height, width = labels.shape
+    max_label = np.iinfo(labels.dtype).max
+    keys, border = [], []
+    offset = 0
+    for band in iter_bands(height, width, tile_size):
+        for tile in iter_tiles(band, tile_size):
+            rows, cols = tile.toslices()
+            tile_mask = np.asarray(mask[rows, cols]) != 0
+            if invert:
+                tile_mask = ~tile_mask
+            n, local = cv2.connectedComponents(
+                tile_mask.astype(np.uint8), connectivity=connectivity
+            )
+            keys.append(get_anchor_keys(local, tile, width)[1:])
+
+            edge = np.zeros(n, dtype=bool)
+            if tile.row_off == 0:
+                edge[local[0]] = True
+            if tile.col_off == 0:
+                edge[local[:, 0]] = True
+            if tile.row_off + tile.height == height:
+                edge[local[-1]] = True
+            if tile.col_off + tile.width == width:
+                edge[local[:, -1]] = True
+            border.append(edge[1:])
+
+            if offset + n - 1 > max_label:
+                raise ValueError(f"The labels do not fit in {labels.dtype}")
+            provisional = local.astype(labels.dtype)
+            provisional[local > 0] += offset
+            labels[rows, cols] = provisional
+            offset += n - 1
+            if release is not None:
+                release()
+
+    # merge components across the seams between tiles
+    pairs = []
+    for row in range(tile_size, height, tile_size):
+        pairs += _seam_pairs(labels[row - 1], labels[row], connectivity)
+    for col in range(tile_size, width, tile_size):
+        pairs += _seam_pairs(labels[:, col - 1], labels[:, col], connectivity)
+        if release is not None:
+            release()
+    pairs = np.concatenate([np.empty((2, 0), dtype=np.int64)] + pairs, axis=1)
+    graph = coo_matrix(
+        (np.ones(pairs.shape[1], dtype=bool), (pairs[0], pairs[1])),
+        shape=(offset + 1, offset + 1),
+    )
+    _, component = connected_components(graph, directed=False)
+    component = component[1:]
+
+    # number the merged components by their first block
+    keys = np.concatenate(keys)
+    anchors = np.full(component.max(initial=0) + 1, np.iinfo(np.int64).max)
+    np.minimum.at(anchors, component, keys)
+    order = np.argsort(anchors, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    present = np.unique(component)
+    nlabels = len(present)
+    lut = np.zeros(offset + 1, dtype=labels.dtype)
+    lut[1:] = rank[component] + 1
+
+    touches = np.zeros(nlabels + 1, dtype=bool)
+    touches[lut[1:][np.concatenate(border + [np.empty(0, dtype=bool)])]] = True
+
+    for band in iter_bands(height, width, tile_size):
+        for tile in iter_tiles(band, tile_size):
+            rows, cols = tile.toslices()
+            labels[rows, cols] = lut[labels[rows, cols]]
+            if release is not None:
+                release()
+
+    return nlabels + 1, touches
@@ -1,15 +1,30 @@
+import threading
 from datetime import datetime
 from pathlib import Path
+from typing import Callable, Iterable, Optional
 
-import matplotlib.pyplot as plt
 import numpy as np
-import skimage
 from numpy.typing import ArrayLike
 
-from ebfloeseg.peakdet import peakdet
+from ebfloeseg.metrics import timed
+from ebfloeseg.outputs import MASK_VALUES_FILE
+from ebfloeseg.peakdet import peakdet_vectorized
+from ebfloeseg.regionprops import regionprops_table
+
+# histogram bins of the masked red channel used to find the open water cuts
+WCUT_BINS = np.arange(1, 256, 5)
+
+# pixels counted at a time by `get_histogram`, to bound its copies
+HISTOGRAM_CHUNK_PIXELS = 2**22
+
+# serializes the appends to mask_values.txt of the scenes run on threads;
+# the shards of a run append to files of their own, see `get_shard_fname`
+_mask_values_lock = threading.Lock()
 
 
 def imshow(img: ArrayLike, cmap: str = "gray", show: bool = True) -> None:
+    import matplotlib.pyplot as plt
+
     plt.imshow(img, cmap=cmap)
     plt.axis("off")
     if show:
@@ -17,6 +32,8 @@ def imshow(img: ArrayLike, cmap: str = "gray", show: bool = True) -> None:
 
 
 def imopen(path: str) -> None:
+    import matplotlib.pyplot as plt
+
     return plt.imread(path)
 
 
@@ -78,8 +95,7 @@ def getmeta(fname: str | Path) -> tuple[str, str, str]:
     Returns:
     tuple[str, str, str]: A tuple containing the day of year (doy), year, and satellite information.
     """
-    if isinstance(fname, Path):
-        fname = str(fname)
+    fname = Path(fname).name  # directories may contain underscores
 
     doy = getdoy(fname)
     year = getyear(fname)
@@ -87,6 +103,41 @@ def getmeta(fname: str | Path) -> tuple[str, str, str]:
     return doy, year, sat
 
 
+def pair_scenes(
+    ftcis: Iterable[Path], fclouds: Iterable[Path]
+) -> tuple[list[tuple[Path, Path]], list[Path]]:
+    """
+    Pair the TCI and cloud files of the same scenes by their `getmeta` keys.
+
+    Args:
+        ftcis (Iterable[Path]): The TCI files.
+        fclouds (Iterable[Path]): The cloud files.
+
+    Returns:
+        tuple[list[tuple[Path, Path]], list[Path]]: The (ftci, fcloud) pairs in
+        the order of the TCI file names, and the files without a partner or
+        whose names have no scene metadata.
+    """
+    clouds, unpaired = {}, []
+    for fcloud in sorted(fclouds):
+        try:
+            clouds[getmeta(fcloud)] = fcloud
+        except IndexError:
+            unpaired.append(fcloud)
+
+    pairs = []
+    for ftci in sorted(ftcis):
+        try:
+            fcloud = clouds.pop(getmeta(ftci), None)
+        except IndexError:
+            fcloud = None
+        if fcloud is None:
+            unpaired.append(ftci)
+        else:
+            pairs.append((ftci, fcloud))
+    return pairs, unpaired + sorted(clouds.values())
+
+
 def getres(doy: str, year: str) -> str:
     return datetime.strptime(year + "-" + doy, "%Y-%j").strftime("%Y-%m-%d")
 
@@ -114,34 +165,74 @@ def write_mask_values(
         None
     """
     land_cloud_mask_sum = sum(sum(~(lmd)))
+    ice_mask_sum = sum(sum(ice_mask))
+    write_mask_sums(ice_mask_sum, land_cloud_mask_sum, doy, save_direc)
+
+
+@timed("write")
+def write_mask_sums(
+    ice_mask_sum: int,
+    land_cloud_mask_sum: int,
+    doy: str,
+    save_direc: str,
+    sic: Optional[float] = None,
+    fname: str = MASK_VALUES_FILE,
+) -> None:
+    """
+    Write precomputed mask pixel counts to the mask values text file.
+
+    The row is appended: processing a scene again adds another row.
+
+    Args:
+        ice_mask_sum (int): Number of ice pixels.
+        land_cloud_mask_sum (int): Number of pixels outside the land and cloud masks.
+        doy (int): Day of year.
+        save_direc (str): Directory to save the text file.
+        sic (float, optional): The sea ice concentration, if not the ratio of
+            the counts, e.g. NaN for a skipped scene. Defaults to None.
+        fname (str, optional): The name of the text file. Defaults to
+            MASK_VALUES_FILE.
+
+    Returns:
+        None
+    """
     fname = (
-        save_direc / f"mask_values.txt"
+        save_direc / fname
     )  # added temporarily while testing. TODO: use doy for subdir
-    ice_mask_sum = sum(sum(ice_mask))
-    ratio = ice_mask_sum / land_cloud_mask_sum
+    ratio = ice_mask_sum / land_cloud_mask_sum if sic is None else sic
     towrite = f"{doy}\t{ice_mask_sum}\t{land_cloud_mask_sum}\t{ratio}\n"
-    with open(fname, "a") as f:
+    # the scenes of a day share the file, and may run on threads of a process
+    with _mask_values_lock, open(fname, "a") as f:
         f.write(towrite)
 
 
-def get_region_properties(img: ArrayLike, red_c: ArrayLike) -> dict[str, ArrayLike]:
+@timed("regionprops")
+def get_region_properties(
+    img: ArrayLike, red_c: ArrayLike, release: Optional[Callable[[], None]] = None
+) -> dict[str, ArrayLike]:
     """
     Calculate properties of regions in an image.
 
+    The properties are those of `skimage.measure.regionprops_table`, computed
+    for all regions at once by `ebfloeseg.regionprops`.
+
     Parameters:
     - img: ArrayLike
         The input image.
     - red_c: ArrayLike
         The red channel value used for regionprops calculation.
+    - release: Callable, optional
+        Called after each band of rows, e.g. to drop the pages of
+        memory-mapped images.
 
     Returns:
     - props: dict
         A dictionary containing the calculated properties for each region.
     """
-    props = skimage.measure.regionprops_table(
-        img.astype(int),
+    props = regionprops_table(
+        img if np.issubdtype(img.dtype, np.integer) else img.astype(int),
         red_c,
-        properties=[
+        properties=(
             "label",
             "area",
             "centroid",
@@ -150,16 +241,96 @@ def get_region_properties(img: ArrayLike, red_c: ArrayLike) -> dict[str, ArrayLi
             "orientation",
             "perimeter",
             "intensity_mean",
-        ],
+        ),
+        release=release,
     )
     return props
 
 
+def get_value_counts(img: ArrayLike) -> np.ndarray:
+    """
+    Count the pixels of each value of a uint8 image.
+
+    The image is counted a block of rows at a time, so a strided view such as
+    a band of an RGB image is not copied whole.
+
+    Args:
+        img (ArrayLike): The uint8 image.
+
+    Returns:
+        np.ndarray: The 256 counts.
+    """
+    img = np.asarray(img)
+    if img.ndim < 2 or img.flags.c_contiguous:
+        return np.bincount(img.ravel(), minlength=256)
+    counts = np.zeros(256, dtype=np.int64)
+    rows = max(1, HISTOGRAM_CHUNK_PIXELS // max(1, img[0].size))
+    for start in range(0, len(img), rows):
+        counts += np.bincount(img[start : start + rows].ravel(), minlength=256)
+    return counts
+
+
+def get_histogram_from_counts(counts: ArrayLike, bins: ArrayLike) -> np.ndarray:
+    """
+    Sum the value counts of a uint8 image over the bins of `np.histogram`.
+
+    Args:
+        counts (ArrayLike): The 256 counts of the image.
+        bins (ArrayLike): The integer bin edges, in [0, 255].
+
+    Returns:
+        np.ndarray: The histogram.
+    """
+    counts = np.asarray(counts)
+    cumulative = np.zeros(257, dtype=np.int64)
+    np.cumsum(counts, out=cumulative[1:])
+    # each bin is closed on the left, and the last one on the right too
+    hist = cumulative[bins[1:]] - cumulative[bins[:-1]]
+    hist[-1] += counts[bins[-1]]
+    return hist
+
+
+def get_histogram(img: ArrayLike, bins: ArrayLike = WCUT_BINS) -> np.ndarray:
+    """
+    Compute the histogram of an image over integer bins.
+
+    The same as `np.histogram(img, bins)[0]`, but a uint8 image is counted
+    with `np.bincount`, without copying it whole.
+
+    Args:
+        img (ArrayLike): The image.
+        bins (ArrayLike, optional): The integer bin edges. Defaults to
+            WCUT_BINS.
+
+    Returns:
+        np.ndarray: The histogram counts.
+    """
+    img = np.asarray(img)
+    if img.dtype != np.uint8:
+        return np.histogram(img, bins=bins)[0]
+    return get_histogram_from_counts(get_value_counts(img), bins)
+
+
+@timed("wcuts")
 def get_wcuts(red_masked):
-    bins = np.arange(1, 256, 5)
-    rn, rbins = np.histogram(red_masked.flatten(), bins=bins)
+    bins = WCUT_BINS
+    ow_cut_min, ow_cut_max = get_wcuts_from_hist(get_histogram(red_masked, bins), bins)
+    return ow_cut_min, ow_cut_max, bins
+
+
+def get_wcuts_from_hist(rn: ArrayLike, rbins: ArrayLike) -> tuple[int, int]:
+    """
+    Determine the open water cuts from a histogram of the masked red channel.
+
+    Args:
+        rn (ArrayLike): The histogram counts over `WCUT_BINS`.
+        rbins (ArrayLike): The histogram bin edges.
+
+    Returns:
+        tuple[int, int]: The minimum and maximum open water cuts.
+    """
     dx = 0.01 * np.mean(rn)
-    rmaxtab, rmintab = peakdet(rn, dx)
+    rmaxtab, rmintab = peakdet_vectorized(rn, dx)
     rmax_n = rbins[rmaxtab[-1, 0]]
     rhm_high = rmaxtab[-1, 1] / 2
 
@@ -175,4 +346,4 @@ def get_wcuts(red_masked):
     else:
         ow_cut_max = rmax_n - 10
 
-    return ow_cut_min, ow_cut_max, bins
+    return ow_cut_min, ow_cut_max
@@ -0,0 +1,118 @@
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from ebfloeseg.index import KINDS, IndexedFile, SceneIndex
+
+
+@dataclass(frozen=True)
+class Arrival:
+    """A scene delivered to a watched directory."""
+
+    ftci: Path
+    fcloud: Path
+    arrived: float  # when its last file was complete, in seconds since the epoch
+
+
+class SceneWatcher:
+    """
+    Find the scenes delivered to the `tci` and `cloud` directories of a data
+    directory by polling them.
+
+    The directories are listed with a `SceneIndex`, so a poll only lists those
+    modified since the last one, and only the files of scenes selected by
+    `filters`, as given to `SceneIndex.select`, are watched. Files are paired
+    by their keys, so a file without its partner waits for it rather than
+    shifting other scenes. A file is complete once it has not been modified
+    for `settle_seconds`, so scenes are not read while they are being copied;
+    only the files of scenes not returned yet are stat'ed again for this.
+    Files starting with a dot are ignored, as written by `rsync` before
+    renaming them. Each version of a scene is returned once: a scene delivered
+    again as new files, e.g. renamed over the old ones, is returned again,
+    but files rewritten in place are not noticed.
+    """
+
+    def __init__(
+        self,
+        data_direc: Path,
+        settle_seconds: float = 5.0,
+        start: Optional[float] = None,
+        filters: Optional[dict] = None,
+        index_path: Optional[Path] = None,
+    ):
+        # the index is loaded from index_path, if any, and then kept in memory
+        self.index = SceneIndex(data_direc, index_path)
+        self.filters = {} if filters is None else filters
+        self.settle_seconds = settle_seconds
+        # scenes delivered before the watch started arrive when it starts
+        self.start = time.time() if start is None else start
+        self._files: Optional[list[IndexedFile]] = None
+        self._seen: set[IndexedFile] = set()
+        self._latest: dict[tuple[str, str, str], dict[str, Path]] = {}
+        self._waiting: set[tuple[str, str, str]] = set()
+        self._returned: dict[tuple[str, str, str], tuple] = {}
+
+    def _update(self) -> None:
+        # note the files added since the last poll, and wait for their scenes
+        files = self.index.scan(save=False).files
+        if files is self._files:
+            return
+        self._files = files
+        selected = set(self.index.select(**self.filters))
+        for f in selected - self._seen:
+            self._latest.setdefault(f.key, {})[f.kind] = f.path
+            self._waiting.add(f.key)
+        self._seen = selected
+
+    def poll(
+        self, limit: Optional[int] = None, now: Optional[float] = None
+    ) -> list[Arrival]:
+        """
+        Return the scenes completed since the last poll.
+
+        Args:
+            limit (int, optional): Return at most this many scenes; the others
+                are returned by later polls. Defaults to None, all of them.
+            now (float, optional): The current time, in seconds since the
+                epoch. Defaults to None, `time.time()`.
+
+        Returns:
+            list[Arrival]: The scenes, in the order they arrived.
+        """
+        now = time.time() if now is None else now
+        self._update()
+
+        arrivals, unchanged = {}, []
+        for key in self._waiting:
+            paths = self._latest[key]
+            if len(paths) < len(KINDS):
+                continue
+            try:
+                stats = [os.stat(paths[kind]) for kind in KINDS]
+            except FileNotFoundError:
+                continue
+            if any(now - stat.st_mtime < self.settle_seconds for stat in stats):
+                continue
+            version = tuple(
+                (str(paths[kind]), stat.st_size, stat.st_mtime_ns)
+                for kind, stat in zip(KINDS, stats)
+            )
+            if self._returned.get(key) == version:
+                unchanged.append(key)  # e.g. copied again with its mtime
+                continue
+            arrived = max(*(stat.st_mtime for stat in stats), self.start)
+            arrival = Arrival(paths["tci"], paths["cloud"], arrived)
+            arrivals[key] = (arrival, version)
+        self._waiting.difference_update(unchanged)
+
+        ordered = sorted(
+            arrivals.items(), key=lambda item: (item[1][0].arrived, item[0])
+        )
+        result = []
+        for key, (arrival, version) in ordered[:limit]:
+            self._returned[key] = version
+            self._waiting.discard(key)
+            result.append(arrival)
+        return result
@@ -0,0 +1,37 @@
+import pytest
+
+from synthetic import write_land, write_scene
+
+
+@pytest.fixture
+def scene(tmp_path):
+    """A synthetic scene: TCI and cloud files, and a land file in `tmp_path / "input"`."""
+    direc = tmp_path / "input"
+    ftci, fcloud = write_scene(direc, "214", "2012-08-01", (560, 620))
+    fland = write_land(direc, ftci, (560, 620))
+    return ftci, fcloud, fland
+
+
+@pytest.fixture
+def archive(tmp_path):
+    """Several small synthetic scenes and a config file processing them."""
+    direc = tmp_path / "input"
+    size = (210, 230)
+    for i, doy in enumerate(range(214, 219)):
+        ftci, _ = write_scene(direc, str(doy), f"2012-08-{doy - 213:02d}", size, i)
+    fland = write_land(direc, ftci, size)
+
+    config_file = tmp_path / "config.toml"
+    config_file.write_text(f"""
+        data_direc = "{direc}"
+        save_figs = false
+        save_direc = "{tmp_path / 'output'}"
+        land = "{fland}"
+        [erosion]
+        itmax = 8
+        itmin = 3
+        step = -1
+        kernel_type = "diamond"
+        kernel_size = 1
+        """)
+    return config_file
@@ -0,0 +1,62 @@
+"""
+Synthetic scenes for the tests and benchmarks.
+"""
+
+import cv2
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+
+def write_scene(direc, doy, date, size, seed=0):
+    """Write a synthetic TCI/cloud pair with bright elliptical floes on dark water."""
+    rng = np.random.default_rng(seed)
+    height, width = size
+    profile = dict(
+        driver="GTiff",
+        dtype="uint8",
+        width=width,
+        height=height,
+        count=3,
+        crs="EPSG:3413",
+        transform=from_origin(-2334051, 757892, 256, 256),
+    )
+
+    red = np.full((height, width), 40, dtype=np.uint8)
+    for _ in range(height * width // 4000):
+        center = tuple(int(x) for x in rng.integers(0, (width, height)))
+        axes = tuple(int(x) for x in rng.integers(3, 40, 2))
+        angle = float(rng.uniform(0, 180))
+        color = int(rng.integers(150, 240))
+        cv2.ellipse(red, center, axes, angle, 0, 360, color, -1)
+    red = np.clip(red + rng.normal(0, 12, red.shape), 0, 255).astype(np.uint8)
+    tci = np.stack([red, red, red])
+
+    cloud = np.zeros((3, height, width), dtype=np.uint8)
+    for _ in range(3):
+        center = tuple(int(x) for x in rng.integers(0, (width, height)))
+        cv2.circle(cloud[0], center, int(rng.integers(20, 80)), 255, -1)
+
+    (direc / "tci").mkdir(parents=True, exist_ok=True)
+    (direc / "cloud").mkdir(parents=True, exist_ok=True)
+    ftci = direc / "tci" / f"tci_{date}_{doy}_terra.tiff"
+    fcloud = direc / "cloud" / f"cloud_{date}_{doy}_terra.tiff"
+    with rasterio.open(ftci, "w", **profile) as dst:
+        dst.write(tci)
+    with rasterio.open(fcloud, "w", **profile) as dst:
+        dst.write(cloud)
+    return ftci, fcloud
+
+
+def write_land(direc, ftci, size):
+    """Write a land file matching `ftci`, with land in the lower left corner."""
+    height, width = size
+    land = np.zeros((1, height, width), dtype=np.uint8)
+    land[0, height * 6 // 7 :, : width // 3] = 75
+    with rasterio.open(ftci) as src:
+        profile = src.profile
+    profile.update(count=1)
+    fland = direc / "land.tiff"
+    with rasterio.open(fland, "w", **profile) as dst:
+        dst.write(land)
+    return fland
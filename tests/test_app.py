@@ -1,17 +1,42 @@
 from pathlib import Path
 import subprocess
+import sys
 from collections import defaultdict
+from datetime import date
 
+import numpy as np
 import pytest
 import pandas as pd
+import rasterio
+from numpy.testing import assert_array_equal
 
-from ebfloeseg.app import parse_config_file
+from ebfloeseg.app import (
+    _static_inputs,
+    init_worker,
+    parse_config_file,
+    preprocess_scene,
+    save_static_inputs,
+)
 
 
 def are_equal(p1, p2):
     return Path(p1).read_bytes() == Path(p2).read_bytes()
 
 
+def labels_match(p1, p2):
+    """
+    Whether the label image p1 holds the labels of p2, written as uint8 by
+    earlier versions: p1 keeps the labels above 255, which wrapped in p2, and
+    marks the watershed lines with the largest value of its type, 255 in p2.
+    """
+    with rasterio.open(p1) as src:
+        labels = src.read(1)
+    with rasterio.open(p2) as src:
+        expected = src.read(1)
+    assert labels.dtype in (np.uint16, np.uint32)
+    return np.array_equal(labels.astype(np.uint8), expected)
+
+
 def check_sums(p1, p2):
     s1 = pd.read_csv(p1).to_numpy().sum()
     s2 = pd.read_csv(p2).to_numpy().sum()
@@ -25,10 +50,10 @@ def _test_output(tmpdir):
     # -----------------------------------------------------------------
     f214 = tmpdir / "214" / "2012-08-01_terra_final.tif"
     f214expected = expdir / "214/2012-08-01_214_terra_final.tif"
-    assert are_equal(f214, f214expected)
+    assert labels_match(f214, f214expected)
     f215expected = expdir / "215/2012-08-02_215_terra_final.tif"
     f215 = tmpdir / "215/2012-08-02_terra_final.tif"
-    assert are_equal(f215, f215expected)
+    assert labels_match(f215, f215expected)
 
     # Check mask values
     # -----------------------------------------------------------------
@@ -57,7 +82,7 @@ def _test_output(tmpdir):
         expected_rounds = sorted((expdir / doy).glob("*round*.tif"))
 
         for id_round, expected_round in zip(id_rounds, expected_rounds):
-            assert are_equal(id_round, expected_round)
+            assert labels_match(id_round, expected_round)
 
 
 def getmaskvalues(path):
@@ -80,13 +105,32 @@ def group_files_by_extension(folder_path):
     return dict(grouped_files)
 
 
+def test_import_app_is_light(tmpdir):
+    # fsdproc --help and config parsing must not load the processing libraries
+    config_file = tmpdir.join("config.toml")
+    config_file.write("""
+        threshold_method = "mean"
+        [erosion]
+        itmax = 8
+        """)
+    code = (
+        "import sys, ebfloeseg.app; "
+        f"ebfloeseg.app.parse_config_file(ebfloeseg.app.Path({str(config_file)!r})); "
+        "print(*[m for m in ('cv2', 'matplotlib', 'pandas', 'pyarrow', "
+        "'rasterio', 'scipy', 'skimage') if m in sys.modules])"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    )
+    assert result.stdout.split() == []
+
+
 @pytest.mark.smoke
 @pytest.mark.slow
 def test_fsdproc(tmpdir):
     expdir = Path("tests/expected")
     config_file = tmpdir.join("config.toml")
-    config_file.write(
-        f"""
+    config_file.write(f"""
         data_direc = "tests/input"
         save_figs = true
         save_direc = "{tmpdir}"
@@ -97,12 +141,12 @@ def test_fsdproc(tmpdir):
         step = -1
         kernel_type = "diamond"
         kernel_size = 1
-        """
-    )
+        """)
 
     result = subprocess.run(
         [
             "fsdproc",
+            "process-images",
             "--config-file",
             str(config_file),
             "--max-workers",
@@ -120,8 +164,7 @@ def test_fsdproc(tmpdir):
 
 def test_parse_config_file(tmpdir):
     config_file = tmpdir.join("config.toml")
-    config_file.write(
-        """
+    config_file.write("""
         data_direc = "/path/to/data"
         save_figs = true
         save_direc = "/path/to/save"
@@ -132,8 +175,7 @@ def test_parse_config_file(tmpdir):
         step = 2
         kernel_type = "ellipse"
         kernel_size = 3
-        """
-    )
+        """)
 
     params = parse_config_file(config_file)
 
@@ -146,3 +188,81 @@ def test_parse_config_file(tmpdir):
     assert params.step == 2
     assert params.kernel_type == "ellipse"
     assert params.kernel_size == 3
+    assert params.start_date is None and params.doy_range is None
+
+
+def test_parse_config_file_filters(tmp_path):
+    config_file = tmp_path / "config.toml"
+    config_file.write_text("""
+        data_direc = "/path/to/data"
+        save_direc = "/path/to/save"
+        land = "/path/to/landfile"
+        start_date = 2012-08-01
+        end_date = "2013-07-31"
+        satellites = "terra"
+        doy_range = [150, 250]
+        [erosion]
+        """)
+    params = parse_config_file(config_file)
+    assert (params.start_date, params.end_date) == (date(2012, 8, 1), date(2013, 7, 31))
+    assert params.satellites == ["terra"]
+    assert params.doy_range == (150, 250)
+
+    config_file.write_text(config_file.read_text().replace("[150, 250]", "[250, 150]"))
+    with pytest.raises(ValueError, match="doy_range"):
+        parse_config_file(config_file)
+
+
+def test_init_worker(tmp_path):
+    land_mask = np.zeros((4, 5), dtype=bool)
+    land_mask[1:3, 2:] = True
+    static_files = save_static_inputs(tmp_path, land_mask=land_mask)
+
+    init_worker(static_files)
+
+    attached = _static_inputs["land_mask"]
+    assert isinstance(attached, np.memmap)
+    assert not attached.flags.writeable
+    assert_array_equal(attached, land_mask)
+
+
+def test_preprocess_scene_error(tmp_path):
+    # the profiles directory cannot be created, so scene_metrics fails to start
+    (tmp_path / "profiles").write_text("")
+    ftci, fcloud = tmp_path / "tci.tiff", tmp_path / "cloud.tiff"
+
+    record = preprocess_scene(ftci, fcloud, tmp_path / "profiles" / "tci", False)
+
+    assert record["scene"] == "tci.tiff"
+    assert record["status"] == "error"
+    assert record["error"].startswith("FileExistsError")
+    assert record["failed_stage"] is None
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("executor", ["thread", "hybrid"])
+def test_process_images_executor(archive, executor):
+    def run(name, *args):
+        config_file = archive.with_name(f"{name}.toml")
+        config_file.write_text(archive.read_text().replace("/output", f"/{name}"))
+        command = ["fsdproc", "process-images", "-c", config_file, *args]
+        subprocess.run(command, check=True, capture_output=True)
+        return archive.parent / name
+
+    expected = run("process", "--max-workers", "2")
+    output = run(executor, "--max-workers", "2", "--executor", executor)
+    # the outputs of the scenes, not the bookkeeping of the run
+    paths = [path for path in expected.glob("[0-9]*/**/*") if path.is_file()]
+    assert paths
+    for path in paths:
+        actual = output / path.relative_to(expected)
+        assert sorted(actual.read_bytes().splitlines()) == sorted(
+            path.read_bytes().splitlines()
+        ), path.name
+
+
+def test_process_images_max_workers_min(archive):
+    command = ["fsdproc", "process-images", "-c", archive, "--max-workers", "0"]
+    result = subprocess.run(command, capture_output=True, text=True)
+    assert result.returncode != 0
+    assert "--max-workers" in result.stderr
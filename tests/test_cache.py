@@ -0,0 +1,102 @@
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from ebfloeseg.cache import SceneCache, get_input_digests, get_scene_outputs
+
+SETTINGS = {"itmax": 8, "itmin": 3}
+
+
+@pytest.fixture
+def processed(tmp_path):
+    # inputs and outputs of a scene, without running the pipeline
+    ftci = tmp_path / "tci_2012-08-01_214_terra.tiff"
+    fcloud = tmp_path / "cloud_2012-08-01_214_terra.tiff"
+    fland = tmp_path / "land.tiff"
+    for path in (ftci, fcloud, fland):
+        path.write_bytes(path.name.encode())
+
+    save_direc = tmp_path / "output"
+    outputs = get_scene_outputs(save_direc, fcloud)
+    for path in outputs["owned"] + outputs["shared"]:
+        path.parent.mkdir(exist_ok=True, parents=True)
+        path.write_text("output")
+
+    SceneCache(save_direc, fland, SETTINGS).add(ftci, fcloud)
+    return ftci, fcloud, fland, save_direc
+
+
+def test_scene_cache(processed):
+    ftci, fcloud, fland, save_direc = processed
+    assert SceneCache(save_direc, fland, SETTINGS).is_valid(ftci, fcloud)
+    assert not SceneCache(save_direc, fland, {"itmax": 7, "itmin": 3}).is_valid(
+        ftci, fcloud
+    )
+
+
+def test_scene_cache_add_digests(processed, monkeypatch):
+    # digests computed by the worker are not computed again
+    ftci, fcloud, fland, save_direc = processed
+    ftci.write_bytes(b"another scene")
+    cache = SceneCache(save_direc, fland, SETTINGS)
+    assert not cache.has_digests(ftci, fcloud)
+    digests = get_input_digests(ftci, fcloud)
+    monkeypatch.setattr("ebfloeseg.cache.hash_file", None)
+    cache.add(ftci, fcloud, digests)
+    assert cache.has_digests(ftci, fcloud)
+    assert cache.is_valid(ftci, fcloud)
+
+
+def test_scene_cache_loads_record_once(processed, monkeypatch):
+    ftci, fcloud, fland, save_direc = processed
+    cache = SceneCache(save_direc, fland, SETTINGS)
+    loads = []
+    load = cache._load
+    monkeypatch.setattr(cache, "_load", lambda f: loads.append(f) or load(f))
+    assert cache.is_valid(ftci, fcloud)
+    cache.add(ftci, fcloud)
+    assert loads == [fcloud, fcloud]
+
+
+def test_scene_cache_inputs_changed(processed):
+    ftci, fcloud, fland, save_direc = processed
+    ftci.write_bytes(b"another scene")
+    assert not SceneCache(save_direc, fland, SETTINGS).is_valid(ftci, fcloud)
+
+
+def test_scene_cache_outputs_changed(processed):
+    ftci, fcloud, fland, save_direc = processed
+    final, props = get_scene_outputs(save_direc, fcloud)["owned"]
+    props.write_text("truncated")
+    assert not SceneCache(save_direc, fland, SETTINGS).is_valid(ftci, fcloud)
+    final.unlink()
+    assert not SceneCache(save_direc, fland, SETTINGS).is_valid(ftci, fcloud)
+
+
+def run_fsdproc(config_file, *args):
+    result = subprocess.run(
+        ["fsdproc", "process-images", "-c", str(config_file), *args],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+@pytest.mark.slow
+def test_process_images_resumes(archive):
+    run_fsdproc(archive)
+    assert run_fsdproc(archive).count("skipped") == 5
+
+    ftci = sorted(Path(archive.parent / "input" / "tci").iterdir())[2]
+    ftci.write_bytes(ftci.read_bytes())  # same contents, new mtime
+    assert run_fsdproc(archive).count("skipped") == 5
+
+    final = get_scene_outputs(archive.parent / "output", ftci)["owned"][0]
+    final.unlink()
+    stdout = run_fsdproc(archive)
+    assert stdout.count("skipped") == 4
+    assert f"processed {ftci.name}" in stdout
+
+    assert "skipped" not in run_fsdproc(archive, "--force")
@@ -0,0 +1,128 @@
+import os
+from datetime import date
+from pathlib import Path
+
+import pytest
+
+from ebfloeseg import index as index_module
+from ebfloeseg.index import SceneIndex
+
+
+def touch(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"scene")
+    return path
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    direc = tmp_path / "input"
+    for doy, day, sat in [(214, 1, "terra"), (215, 2, "terra"), (216, 3, "aqua")]:
+        touch(direc / "tci" / f"tci_2012-08-{day:02d}_{doy}_{sat}.tiff")
+        touch(direc / "cloud" / f"cloud_2012-08-{day:02d}_{doy}_{sat}.tiff")
+    # a later year in a subdirectory
+    touch(direc / "tci" / "2013" / "tci_2013-08-01_213_terra.tiff")
+    touch(direc / "cloud" / "2013" / "cloud_2013-08-01_213_terra.tiff")
+    touch(direc / "tci" / "notes.txt")
+    return direc
+
+
+def test_scene_index(inputs):
+    index = SceneIndex(inputs).scan()
+    assert len(index.files) == 8
+    assert index.ignored == [inputs / "tci" / "notes.txt"]
+    [f] = [f for f in index.files if f.doy == "216" and f.kind == "cloud"]
+    assert f.path == inputs / "cloud" / "cloud_2012-08-03_216_aqua.tiff"
+    assert (f.sat, f.date, f.size) == ("aqua", "2012-08-03", 5)
+    assert f.mtime_ns == os.stat(f.path).st_mtime_ns
+
+    # a missing cloud file does not shift the later scenes
+    (inputs / "cloud" / "cloud_2012-08-02_215_terra.tiff").unlink()
+    pairs, unpaired = SceneIndex(inputs).scan().pairs()
+    assert [(ftci.name, fcloud.name) for ftci, fcloud in pairs] == [
+        ("tci_2013-08-01_213_terra.tiff", "cloud_2013-08-01_213_terra.tiff"),
+        ("tci_2012-08-01_214_terra.tiff", "cloud_2012-08-01_214_terra.tiff"),
+        ("tci_2012-08-03_216_aqua.tiff", "cloud_2012-08-03_216_aqua.tiff"),
+    ]
+    assert unpaired == [inputs / "tci" / "tci_2012-08-02_215_terra.tiff"]
+
+
+def test_scene_index_select(inputs):
+    index = SceneIndex(inputs).scan()
+
+    def doys(**filters):
+        return [ftci.name.split("_")[2] for ftci, _ in index.pairs(**filters)[0]]
+
+    assert doys(start=date(2012, 8, 2)) == ["213", "215", "216"]
+    assert doys(start=date(2012, 8, 2), end=date(2012, 8, 3)) == ["215", "216"]
+    assert doys(satellites=["terra"]) == ["213", "214", "215"]
+    assert doys(doys=range(214, 216)) == ["214", "215"]
+
+
+def test_scene_index_rescan(inputs, tmp_path, monkeypatch):
+    monkeypatch.setattr(index_module, "MTIME_SLACK_NS", 0)
+    calls = {"scandir": 0, "stat": 0}
+
+    def counted(name, fn):
+        def wrapper(*args):
+            calls[name] += 1
+            return fn(*args)
+
+        return wrapper
+
+    monkeypatch.setattr(index_module.os, "scandir", counted("scandir", os.scandir))
+    monkeypatch.setattr(
+        index_module, "_index_file", counted("stat", index_module._index_file)
+    )
+
+    path = tmp_path / "output" / "scene_index.json"
+    files = SceneIndex(inputs, path).scan().files
+    assert calls == {"scandir": 4, "stat": 9}
+
+    # nothing changed: no directory is listed
+    calls.update(scandir=0, stat=0)
+    assert SceneIndex(inputs, path).scan().files == files
+    assert calls == {"scandir": 0, "stat": 0}
+
+    # a new file: only its directory is listed and only it is stat'ed
+    calls.update(scandir=0, stat=0)
+    touch(inputs / "tci" / "2013" / "tci_2013-08-02_214_terra.tiff")
+    index = SceneIndex(inputs, path).scan()
+    assert calls == {"scandir": 1, "stat": 1}
+    assert len(index.files) == len(files) + 1
+
+    # a removed file
+    (inputs / "cloud" / "cloud_2012-08-01_214_terra.tiff").unlink()
+    assert len(SceneIndex(inputs, path).scan().files) == len(files)
+
+    # a full scan, and an index of other inputs
+    calls.update(scandir=0, stat=0)
+    SceneIndex(inputs, path).scan(full=True)
+    assert calls == {"scandir": 4, "stat": 9}
+    calls.update(scandir=0, stat=0)
+    os.rename(inputs, tmp_path / "moved")
+    SceneIndex(tmp_path / "moved", path).scan()
+    assert calls == {"scandir": 4, "stat": 9}
+
+
+def test_scene_index_rescan_in_memory(inputs, monkeypatch):
+    monkeypatch.setattr(index_module, "MTIME_SLACK_NS", 0)
+    listed = []
+    original = os.scandir
+
+    def scandir(path):
+        listed.append(Path(path))
+        return original(path)
+
+    monkeypatch.setattr(index_module.os, "scandir", scandir)
+
+    # without a saved index, a scan reuses the index of the previous one
+    index = SceneIndex(inputs).scan()
+    files = index.files
+    listed.clear()
+    assert index.scan().files is files
+    assert listed == []
+
+    touch(inputs / "cloud" / "cloud_2012-08-04_217_aqua.tiff")
+    assert len(index.scan().files) == len(files) + 1
+    assert listed == [inputs / "cloud"]
@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import pytest
+import skimage
+from numpy.testing import assert_array_equal
+from ebfloeseg.labelfilter import (
+    LUT_OFFSET,
+    filter_labels,
+    get_label_areas,
+    get_labels_in_mask,
+    get_max_label,
+    get_small_labels,
+)
+from ebfloeseg.preprocess import get_remove_small_mask
+
+
+def random_watershed(seed=0):
+    rng = np.random.default_rng(seed)
+    watershed = rng.integers(1, 40, size=(60, 70)).astype(np.int32)
+    watershed[::7] = -1  # watershed boundaries
+    return watershed
+
+
+def test_get_label_areas():
+    labels = np.array([[-1, 1, 1], [3, 3, 3]])
+    areas = get_label_areas(labels, 4)
+    assert_array_equal(areas, [1, 0, 2, 0, 3, 0])
+    assert areas[3 + LUT_OFFSET] == 3
+
+
+def test_filter_labels_land():
+    watershed = random_watershed()
+    land = np.zeros(watershed.shape, dtype=bool)
+    land[:10, :10] = True
+
+    expected = watershed.copy()
+    expected[np.isin(expected, np.unique(expected[land & (expected > 1)]))] = 1
+
+    lut = get_labels_in_mask(watershed, land & (watershed > 1), watershed.max())
+    assert_array_equal(filter_labels(watershed, lut), expected)
+
+
+def test_filter_labels_small():
+    watershed = random_watershed(1)
+    area_lim = 100
+
+    props = skimage.measure.regionprops_table(watershed, properties=["label", "area"])
+    df = pd.DataFrame.from_dict(props)
+    expected = watershed.copy()
+    expected[np.isin(expected, df[df.area < area_lim].label.values)] = 1
+
+    small = get_small_labels(get_label_areas(watershed, watershed.max()), area_lim)
+    assert not small[-1 + LUT_OFFSET]
+    assert_array_equal(filter_labels(watershed, small), expected)
+
+
+@pytest.mark.parametrize("area_lim", [0, 100, 120, 1000])
+def test_get_max_label(area_lim):
+    watershed = random_watershed(3)
+    watershed[watershed == 39] = 1  # the largest label is small
+    watershed[:2, :3] = 39
+    areas = get_label_areas(watershed, watershed.max())
+    small = get_small_labels(areas, area_lim)
+    assert get_max_label(areas, small) == filter_labels(watershed, small).max()
+
+
+def test_get_remove_small_mask():
+    watershed = random_watershed(2)
+    it = 3
+    props = skimage.measure.regionprops_table(watershed, properties=["label", "area"])
+    df = pd.DataFrame.from_dict(props)
+    expected = np.isin(watershed, df[df.area < it**4].label.values)
+    assert_array_equal(get_remove_small_mask(watershed, it), expected)
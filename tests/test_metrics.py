@@ -0,0 +1,109 @@
+import json
+import subprocess
+
+import numpy as np
+import pytest
+
+from ebfloeseg.metrics import (
+    add_count,
+    append_metrics,
+    profile,
+    record_stages,
+    scene_metrics,
+    stage,
+    timed,
+)
+
+
+@timed("inner")
+def inner():
+    return np.zeros(10, dtype=np.int64)
+
+
+def test_record_stages():
+    with record_stages() as recorder:
+        with stage("outer"):
+            inner()
+            inner()
+            add_count("floes", 3)
+            add_count("floes", 2)
+        inner()
+
+    records = recorder.as_records()
+    assert [r["stage"] for r in records] == ["outer/inner", "outer", "inner"]
+    assert [r["calls"] for r in records] == [2, 1, 1]
+    assert [r["bytes"] for r in records] == [160, 0, 80]
+    assert records[1]["seconds"] >= records[0]["seconds"] >= 0
+    assert recorder.counts == {"outer/floes": 5}
+
+
+def test_stage_without_recorder():
+    with stage("outer"):
+        assert len(inner()) == 10
+        add_count("floes", 3)
+
+    with record_stages() as recorder:
+        pass
+    assert recorder.as_records() == []
+
+
+def test_scene_metrics_error(tmp_path):
+    with pytest.raises(ValueError):
+        with scene_metrics(tmp_path / "tci.tiff", tmp_path / "cloud.tiff") as record:
+            with stage("outer"), stage("inner"):
+                raise ValueError("bad scene")
+
+    assert record["status"] == "error"
+    assert record["error"] == "ValueError('bad scene')"
+    assert record["failed_stage"] == "outer/inner"
+    assert record["peak_rss_mb"] > 0
+
+    append_metrics(tmp_path / "metrics.jsonl", record)
+    append_metrics(tmp_path / "metrics.jsonl", {"scene": "other"})
+    lines = (tmp_path / "metrics.jsonl").read_text().splitlines()
+    assert [json.loads(line)["scene"] for line in lines] == ["tci.tiff", "other"]
+
+
+def test_scene_metrics_shared_process(tmp_path):
+    with scene_metrics(
+        tmp_path / "tci.tiff", tmp_path / "cloud.tiff", shared_process=True
+    ) as record:
+        inner()
+
+    assert record["status"] == "ok"
+    assert "peak_rss_mb" not in record
+    assert record["process_peak_rss_mb"] > 0
+
+
+def test_profile(tmp_path):
+    with profile(tmp_path / "profiles" / "scene"):
+        inner()
+    assert (tmp_path / "profiles" / "scene.prof").stat().st_size > 0
+    report = (tmp_path / "profiles" / "scene.tracemalloc.txt").read_text()
+    assert report.startswith("peak traced memory")
+
+
+@pytest.mark.slow
+def test_process_images_metrics(archive):
+    ftcis = sorted((archive.parent / "input" / "tci").iterdir())
+    command = ["fsdproc", "process-images", "-c", archive, "--max-workers", "2"]
+    subprocess.run(
+        command + ["--profile-scene", ftcis[1].name], check=True, capture_output=True
+    )
+    subprocess.run(command, check=True, capture_output=True)
+
+    save_direc = archive.parent / "output"
+    lines = (save_direc / "metrics.jsonl").read_text().splitlines()
+    records = [json.loads(line) for line in lines]
+    assert sorted(r["scene"] for r in records[:5]) == [f.name for f in ftcis]
+    assert all(r["status"] == "ok" for r in records[:5])
+    assert all(r["status"] == "skipped" for r in records[5:])
+    assert all(r["skip_reason"] == "cached" for r in records[5:])
+    assert len(records) == 10
+
+    stages = {s["stage"] for s in records[0]["stages"]}
+    assert {"ice_mask/threshold", "round_0/watershed", "regionprops"} <= stages
+    assert records[0]["counts"]["round_0/filter/labels"] > 0
+
+    profiles = sorted(p.name for p in (save_direc / "profiles").iterdir())
+    assert profiles == [f"{ftcis[1].stem}.prof", f"{ftcis[1].stem}.tracemalloc.txt"]
@@ -0,0 +1,100 @@
+import importlib.util
+import subprocess
+
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+from ebfloeseg.outputs import (
+    collect_dataset,
+    get_partition_path,
+    validate_output_format,
+    write_mask_values_table,
+    write_scene_table,
+)
+
+# skip without the parquet extra, but fail if it is installed and broken,
+# e.g. built against another numpy
+if importlib.util.find_spec("pyarrow") is None:
+    pytest.skip("needs the parquet extra", allow_module_level=True)
+import pyarrow  # noqa: E402, F401
+
+
+def test_validate_output_format():
+    assert validate_output_format("parquet") == "parquet"
+    with pytest.raises(ValueError):
+        validate_output_format("feather")
+
+
+def test_write_scene_table_replaces(tmp_path):
+    df = pd.DataFrame({"label": [2, 3], "area": [10.0, 20.0]})
+    path = write_scene_table(df, tmp_path, "props", "2012", "214", "terra")
+    assert path == get_partition_path(tmp_path, "props", "2012", "214", "terra")
+    # processing a scene again replaces its rows instead of adding to them
+    write_scene_table(df, tmp_path, "props", "2012", "214", "terra")
+    assert sorted(p.name for p in path.parent.iterdir()) == ["part-0.parquet"]
+    assert_frame_equal(pd.read_parquet(path), df)
+
+
+def test_collect_dataset(tmp_path):
+    scenes = [
+        ("2012", "215", "terra"),
+        ("2012", "214", "aqua"),
+        ("2011", "214", "terra"),
+    ]
+    for n, scene in enumerate(scenes):
+        df = pd.DataFrame({"label": np.arange(2, 2 + n + 1)})
+        write_scene_table(df, tmp_path, "props", *scene)
+        write_mask_values_table(n, 10, tmp_path, *scene)
+
+    collected = collect_dataset(tmp_path)
+    assert collected == {
+        "mask_values": tmp_path / "mask_values.parquet",
+        "props": tmp_path / "props.parquet",
+    }
+
+    props = pd.read_parquet(collected["props"])
+    assert props[["year", "doy"]].values.tolist() == [[2011, 214]] * 3 + [
+        [2012, 214]
+    ] * 2 + [[2012, 215]]
+    assert props["sat"].tolist() == ["terra"] * 3 + ["aqua"] * 2 + ["terra"]
+    assert props["label"].tolist() == [2, 3, 4, 2, 3, 2]
+
+    mask_values = pd.read_parquet(collected["mask_values"])
+    assert mask_values["ice_area"].tolist() == [2, 1, 0]
+    assert mask_values["sic"].tolist() == [0.2, 0.1, 0.0]
+
+
+@pytest.mark.slow
+def test_process_images_parquet(archive):
+    subprocess.run(["fsdproc", "process-images", "-c", archive], check=True)
+    config = archive.read_text()
+    archive.write_text(
+        config.replace('output"', 'parquet"').replace(
+            "save_figs = false", 'save_figs = false\noutput_format = "parquet"'
+        )
+    )
+    for _ in range(2):  # running again must not duplicate rows
+        subprocess.run(
+            ["fsdproc", "process-images", "-c", archive, "--force"], check=True
+        )
+
+    props = pd.read_parquet(archive.parent / "parquet" / "props.parquet")
+    mask_values = pd.read_parquet(archive.parent / "parquet" / "mask_values.parquet")
+    assert mask_values["doy"].tolist() == list(range(214, 219))
+
+    for doy in range(214, 219):
+        csv_direc = archive.parent / "output" / str(doy)
+        expected = pd.read_csv(next(csv_direc.glob("*_props.csv")), index_col=0)
+        scene = props[props["doy"] == doy].drop(columns=["year", "doy", "sat"])
+        assert_frame_equal(
+            scene.reset_index(drop=True),
+            expected,
+            check_dtype=False,
+            check_index_type=False,
+        )
+
+        ice_area, unmasked = (csv_direc / "mask_values.txt").read_text().split()[1:3]
+        row = mask_values[mask_values["doy"] == doy].iloc[0]
+        assert (row["ice_area"], row["unmasked"]) == (int(ice_area), int(unmasked))
@@ -1,4 +1,5 @@
-from ebfloeseg.peakdet import peakdet
+from ebfloeseg.peakdet import peakdet, peakdet_vectorized
+import numpy as np
 import pytest
 
 
@@ -26,3 +27,16 @@ def test_peakdet():
     delta = -1
     with pytest.raises(ValueError):
         peakdet(v, delta)
+
+
+def test_peakdet_vectorized():
+    rng = np.random.default_rng(0)
+    for n in range(200):
+        v = rng.integers(0, 10, rng.integers(0, 50)) if n % 2 else rng.normal(size=40)
+        delta = rng.uniform(0.1, 3)
+        for expected, result in zip(peakdet(v, delta), peakdet_vectorized(v, delta)):
+            assert result.dtype == expected.dtype
+            assert np.array_equal(result, expected)
+
+    with pytest.raises(ValueError):
+        peakdet_vectorized([0, 1], -1)
@@ -0,0 +1,89 @@
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+from ebfloeseg.metrics import record_stages, stage, timed
+from ebfloeseg.pipeline import BackgroundWriter, prefetch, warm_files
+
+
+class RecordingExecutor:
+    """Runs nothing, records the files each submitted call would read."""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, fn, paths):
+        self.submitted.append(paths)
+        future = Future()
+        future.set_result(0)
+        return future
+
+
+def test_warm_files(tmp_path):
+    paths = [tmp_path / "a", tmp_path / "b"]
+    paths[0].write_bytes(b"x" * 10)
+    paths[1].write_bytes(b"y" * 5)
+    assert warm_files(paths) == 15
+
+
+def test_prefetch():
+    jobs = [(f"tci{n}", f"cloud{n}", n) for n in range(5)]
+    executor = RecordingExecutor()
+    taken = []
+    for job in prefetch(executor, jobs, skip=2):
+        taken.append(job)
+        # each job after the first two is read as it is taken
+        warmed = [paths[0] for paths in executor.submitted]
+        assert warmed == [f"tci{n}" for n in range(2, len(taken))]
+    assert taken == jobs
+    assert executor.submitted[0] == ("tci2", "cloud2")
+
+
+def test_background_writer():
+    written = []
+    with BackgroundWriter() as writer:
+        for n in range(10):
+            writer.submit(written.append, n)
+    assert written == list(range(10))
+
+
+def test_background_writer_error():
+    def fail():
+        raise OSError("disk full")
+
+    written = []
+    with pytest.raises(OSError, match="disk full"):
+        with BackgroundWriter() as writer:
+            writer.submit(fail)
+            writer.submit(written.append, 1)
+    assert written == []  # writes after an error are dropped
+
+
+def test_background_writer_stages():
+    def fail():
+        with stage("inner"):
+            raise OSError("disk full")
+
+    with record_stages() as recorder:
+        with pytest.raises(OSError):
+            with stage("outer"), BackgroundWriter() as writer:
+                writer.submit(timed("write")(print))
+                writer.submit(fail)
+    stages = [r["stage"] for r in recorder.as_records()]
+    assert stages == ["outer/write", "outer/inner", "outer"]
+    assert recorder.failed_stage == "outer/inner"
+
+
+def test_background_writer_bounded():
+    release = threading.Event()
+    writer = BackgroundWriter(max_pending=1)
+    writer.submit(release.wait)  # taken by the thread, which then blocks
+    writer.submit(print)  # fills the queue
+    submitted = threading.Event()
+    thread = threading.Thread(target=lambda: (writer.submit(print), submitted.set()))
+    thread.start()
+    assert not submitted.wait(0.2)
+    release.set()
+    assert submitted.wait(5)
+    writer.close()
@@ -1,6 +1,30 @@
 import pytest
+import cv2
+import numpy as np
+import pandas as pd
+import rasterio
+import skimage
+import tracemalloc
+from numpy.testing import assert_array_equal
+from pandas.testing import assert_frame_equal
 from pathlib import Path
-from ebfloeseg.preprocess import preprocess
+from scipy import ndimage
+from ebfloeseg.masking import create_cloud_mask, create_land_mask
+from ebfloeseg.metrics import record_stages
+from ebfloeseg.preprocess import (
+    preprocess,
+    _preprocess,
+    _preprocess_tiled,
+    fill_holes,
+    get_erosion_kernel,
+    get_footprint,
+    get_land_cloud_mask_dilated,
+    get_land_mask_dilated,
+    get_markers,
+    mask_scene,
+    segment_arrays,
+    segment_masks,
+)
 
 
 def test_process_exception(tmpdir):
@@ -32,3 +56,274 @@ def test_process_exception(tmpdir):
             erosion_kernel_type,
             erosion_kernel_size,
         )
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("threshold_method", ["gaussian", "mean", "downsample"])
+def test_preprocess_tiled(scene, tmp_path, threshold_method):
+    ftci, fcloud, fland = scene
+    land_mask = create_land_mask(fland)
+    args = (land_mask, 8, 3, -1, "diamond", 1, True)
+
+    _preprocess(
+        ftci, fcloud, *args, tmp_path / "whole", threshold_method=threshold_method
+    )
+    _preprocess_tiled(
+        ftci,
+        fcloud,
+        *args,
+        tmp_path / "tiled",
+        tile_size=128,
+        threshold_method=threshold_method,
+    )
+
+    whole = sorted((tmp_path / "whole" / "214").iterdir())
+    tiled = sorted((tmp_path / "tiled" / "214").iterdir())
+    assert [f.name for f in whole] == [f.name for f in tiled]
+    for f, g in zip(whole, tiled):
+        if f.suffix == ".csv":
+            assert_frame_equal(pd.read_csv(f), pd.read_csv(g))
+        elif f.suffix != ".png":
+            assert f.read_bytes() == g.read_bytes(), f.name
+
+
+def test_segment_arrays(scene, tmp_path):
+    ftci, fcloud, fland = scene
+    land_mask = create_land_mask(fland)
+    _preprocess(ftci, fcloud, land_mask, 8, 3, -1, "diamond", 1, False, tmp_path)
+
+    with rasterio.open(ftci) as src:
+        rgb = np.dstack(src.read())
+    original = rgb.copy()
+    result = segment_arrays(rgb, create_cloud_mask(fcloud), land_mask)
+    assert_array_equal(rgb, original)
+
+    # same outputs as the file pipeline
+    with rasterio.open(tmp_path / "214" / "2012-08-01_terra_final.tif") as src:
+        assert_array_equal(result.labels, src.read(1))
+    expected = pd.read_csv(tmp_path / "214" / "2012-08-01_terra_props.csv")
+    assert_frame_equal(result.props, expected.drop(columns="Unnamed: 0"))
+    mask_values = (tmp_path / "214" / "mask_values.txt").read_text()
+    doy, ice_area, unmasked, sic = mask_values.split()
+    assert (result.mask_stats["ice_area"], result.mask_stats["unmasked"]) == (
+        int(ice_area),
+        int(unmasked),
+    )
+    assert result.mask_stats["sic"] == float(sic)
+    assert result.ice_mask.sum() == int(ice_area)
+
+
+# traced bytes per pixel of the scene allocated at once by segment_arrays,
+# mostly by the float64 adaptive threshold
+PEAK_BYTES_PER_PIXEL = 36
+
+
+def test_segment_arrays_peak_memory(scene):
+    ftci, fcloud, fland = scene
+    land_mask = create_land_mask(fland)
+    cloud_mask = create_cloud_mask(fcloud)
+    with rasterio.open(ftci) as src:
+        rgb = np.dstack(src.read())
+
+    tracemalloc.start()
+    try:
+        segment_arrays(rgb, cloud_mask, land_mask)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak / (rgb.shape[0] * rgb.shape[1]) < PEAK_BYTES_PER_PIXEL
+
+
+def test_fill_holes():
+    rng = np.random.default_rng(0)
+    mask = (rng.random((200, 190)) < 0.6).astype(np.uint8)
+    assert_array_equal(fill_holes(mask), ndimage.binary_fill_holes(mask))
+
+
+def test_get_footprint():
+    mask = np.ones((50, 60), dtype=bool)
+    assert get_footprint(mask, 5) == (0, None)
+    mask[10:20, 30:35] = False
+    mask[15, 58] = False
+    assert get_footprint(mask) == (51, (slice(10, 20), slice(30, 59)))
+    assert get_footprint(mask, 5) == (51, (slice(5, 25), slice(25, 60)))
+
+
+@pytest.mark.parametrize("cloud_fraction", [0.0, 0.001, 0.3])
+def test_get_land_cloud_mask_dilated(cloud_fraction):
+    rng = np.random.default_rng(0)
+    land_mask = np.zeros((200, 190), dtype=bool)
+    land_mask[150:, :60] = True
+    land_mask[:3, 100:120] = True
+    cloud_mask = rng.random(land_mask.shape) < cloud_fraction
+    land_cloud_mask = land_mask | cloud_mask
+
+    shared = get_land_cloud_mask_dilated(
+        land_cloud_mask, land_mask, get_land_mask_dilated(land_mask)
+    )
+    assert_array_equal(shared, get_land_cloud_mask_dilated(land_cloud_mask))
+
+
+@pytest.mark.parametrize("threshold_method", ["gaussian", "downsample"])
+def test_segment_arrays_crop(scene, threshold_method):
+    ftci, fcloud, fland = scene
+    land_mask = create_land_mask(fland)
+    with rasterio.open(ftci) as src:
+        rgb = np.dstack(src.read())
+    # clouds everywhere but a window, with a cloud inside it
+    cloud_mask = np.ones(land_mask.shape, dtype=bool)
+    cloud_mask[150:420, 0:330] = False
+    cloud_mask[250:300, 100:160] = True
+
+    args = (rgb, cloud_mask, land_mask, 8, 3, -1, "diamond", 1, threshold_method)
+    cropped = segment_arrays(*args)
+    whole = segment_arrays(*args, crop=False)
+    shared = segment_arrays(*args, land_mask_dilated=get_land_mask_dilated(land_mask))
+    assert cropped.labels.max() > 0
+    assert_array_equal(cropped.labels, whole.labels)
+    assert_array_equal(shared.labels, whole.labels)
+    assert_array_equal(cropped.ice_mask, whole.ice_mask)
+    assert_frame_equal(cropped.props, whole.props)
+    assert cropped.mask_stats["sic"] == whole.mask_stats["sic"]
+
+
+@pytest.mark.parametrize("tile_size", [None, 128])
+def test_preprocess_skips_unusable_scene(scene, tmp_path, tile_size):
+    ftci, fcloud, fland = scene
+    land_mask = create_land_mask(fland)
+    with record_stages() as recorder:
+        preprocess(
+            ftci,
+            fcloud,
+            land_mask,
+            8,
+            3,
+            -1,
+            "diamond",
+            1,
+            False,
+            tmp_path,
+            tile_size,
+            min_usable_fraction=0.99,
+        )
+    assert recorder.skip_reason == "footprint"
+    assert recorder.skip_detail.startswith("unmasked fraction")
+
+    # empty outputs, and the mask values with an unknown concentration
+    with rasterio.open(tmp_path / "214" / "2012-08-01_terra_final.tif") as src:
+        assert not src.read(1).any()
+    props = pd.read_csv(tmp_path / "214" / "2012-08-01_terra_props.csv")
+    assert len(props) == 0 and "area" in props.columns
+    mask_values = (tmp_path / "214" / "mask_values.txt").read_text()
+    doy, ice_area, unmasked, sic = mask_values.split()
+    assert (ice_area, sic) == ("0", "nan")
+    assert int(unmasked) == np.count_nonzero(~(land_mask | create_cloud_mask(fcloud)))
+
+
+def test_segment_arrays_all_masked(scene):
+    ftci, fcloud, fland = scene
+    with rasterio.open(ftci) as src:
+        rgb = np.dstack(src.read())
+    mask = np.ones(rgb.shape[:2], dtype=bool)
+    result = segment_arrays(rgb, mask, mask)
+    assert result.skip_reason == "no unmasked pixels"
+    assert not result.labels.any() and len(result.props) == 0
+    assert result.mask_stats["unmasked"] == 0
+
+
+@pytest.mark.parametrize("kernel_type, kernel_size", [("diamond", 1), ("ellipse", 3)])
+def test_segment_masks_windows(scene, monkeypatch, kernel_type, kernel_size):
+    ftci, fcloud, fland = scene
+    with rasterio.open(ftci) as src:
+        rgb = np.dstack(src.read())
+    # clear sky over two patches side by side, so later rounds run on windows
+    # whose floes are numbered in turns
+    cloud_mask = np.ones(rgb.shape[:2], dtype=bool)
+    cloud_mask[20:400, 20:260] = False
+    cloud_mask[100:540, 380:600] = False
+    arrays, _ = mask_scene(rgb, cloud_mask, create_land_mask(fland))
+
+    def run(max_fraction, threads=1):
+        monkeypatch.setattr(
+            "ebfloeseg.preprocess.MAX_ROUND_WINDOW_FRACTION", max_fraction
+        )
+        rounds = []
+        with record_stages() as recorder:
+            labels = segment_masks(
+                arrays["red_c"],
+                arrays["rgb_masked"],
+                arrays["ice_mask"],
+                arrays["land_cloud_mask_dilated"],
+                8,
+                3,
+                -1,
+                kernel_type,
+                kernel_size,
+                save_image=lambda fname, image: rounds.append(image.copy()),
+                threads=threads,
+            )
+        return labels, rounds, recorder
+
+    whole, whole_rounds, whole_recorder = run(-1.0)
+    assert whole.max() > 0
+    for max_fraction, threads in [(1.0, 1), (-1.0, 3)]:
+        windowed, windowed_rounds, recorder = run(max_fraction, threads)
+        assert any(r["stage"].endswith("relabel") for r in recorder.as_records())
+        assert_array_equal(windowed, whole)
+        for a, b in zip(windowed_rounds, whole_rounds):
+            assert_array_equal(a, b)
+        assert recorder.counts == whole_recorder.counts
+
+
+def test_preprocess_background_writes(scene, tmp_path):
+    ftci, fcloud, fland = scene
+    args = (create_land_mask(fland), 8, 3, -1, "diamond", 1, True)
+
+    _preprocess(ftci, fcloud, *args, tmp_path / "sync")
+    preprocess(ftci, fcloud, *args, tmp_path / "background", background_writes=True)
+
+    sync = sorted((tmp_path / "sync" / "214").iterdir())
+    background = sorted((tmp_path / "background" / "214").iterdir())
+    assert [f.name for f in sync] == [f.name for f in background]
+    for f, g in zip(sync, background):
+        if f.suffix != ".png":
+            assert f.read_bytes() == g.read_bytes(), f.name
+
+
+def test_preprocess_background_writes_stages(scene, tmp_path):
+    # the writes and the windows run on other threads
+    ftci, fcloud, fland = scene
+    args = (create_land_mask(fland), 8, 3, -1, "diamond", 1, True, tmp_path)
+
+    with record_stages() as recorder:
+        preprocess(ftci, fcloud, *args, background_writes=True, threads=2)
+
+    stages = {r["stage"] for r in recorder.as_records()}
+    assert {"write", "write/cog", "write_wait", "round_0/watershed"} <= stages
+
+
+@pytest.mark.parametrize(
+    "fcloud",
+    sorted(Path("tests/input/cloud").glob("*.tiff")),
+    ids=lambda p: p.stem,
+)
+@pytest.mark.parametrize(
+    "kernel_type, kernel_size", [("diamond", 1), ("ellipse", 3), ("ellipse", 4)]
+)
+def test_dilate_markers(fcloud, kernel_type, kernel_size):
+    cloud_mask = create_cloud_mask(fcloud)
+    erosion_kernel = get_erosion_kernel(kernel_type, kernel_size)
+    it = 3
+    eroded = cv2.erode(cloud_mask.astype(np.uint8), erosion_kernel, iterations=it)
+    _, labels = cv2.connectedComponents(eroded)
+    markers = get_markers(cloud_mask, eroded, labels, erosion_kernel, it)
+
+    # the repeated dilation get_markers used to do
+    expected = labels + 1
+    dilated = cv2.dilate(cloud_mask.astype(np.uint8), erosion_kernel, iterations=it)
+    expected[cv2.subtract(dilated, eroded) == 255] = 0
+    for _ in range(it + 1):
+        expected = skimage.morphology.dilation(expected, erosion_kernel)
+
+    assert markers.dtype == expected.dtype
+    assert_array_equal(markers, expected)
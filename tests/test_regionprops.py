@@ -0,0 +1,60 @@
+import cv2
+import numpy as np
+import pytest
+import skimage
+from numpy.testing import assert_allclose, assert_array_equal
+
+from ebfloeseg.regionprops import PROPERTIES, regionprops_table
+
+
+def get_labels(seed):
+    # floes of many shapes, touching each other, with holes and 1-pixel ones
+    rng = np.random.default_rng(seed)
+    mask = (rng.random((150, 140)) < 0.6).astype(np.uint8)
+    _, labels = cv2.connectedComponents(mask, connectivity=4)
+    labels[20:30, 40:50] = labels.max() + 1  # a square
+    labels[60, 10:40] = labels.max() + 1  # a line
+    return labels, rng.integers(0, 256, mask.shape, dtype=np.uint8)
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_regionprops_table(seed):
+    labels, intensity = get_labels(seed)
+    expected = skimage.measure.regionprops_table(
+        labels, intensity, properties=list(PROPERTIES)
+    )
+    props = regionprops_table(labels, intensity)
+    assert list(props) == list(expected)
+    assert_array_equal(props["label"], expected["label"])
+    for name, column in expected.items():
+        assert props[name].dtype == column.dtype
+        if name == "orientation":
+            # -pi/2 and pi/2 are the same axis, which skimage picks from the
+            # rounding errors of its moments
+            column = np.where(
+                np.isclose(np.abs(column), np.pi / 2), props[name], column
+            )
+        assert_allclose(props[name], column, rtol=1e-9, atol=1e-9, err_msg=name)
+
+
+def test_regionprops_table_bands(monkeypatch):
+    labels, intensity = get_labels(2)
+    released = []
+    whole = regionprops_table(labels, intensity)
+    monkeypatch.setattr("ebfloeseg.regionprops.BAND_ROWS", 7)
+    banded = regionprops_table(labels, intensity, release=lambda: released.append(True))
+    assert len(released) == 2 * 22
+    for name, column in whole.items():
+        assert_allclose(banded[name], column, rtol=1e-12, err_msg=name)
+
+
+def test_regionprops_table_empty():
+    props = regionprops_table(np.zeros((5, 4), dtype=np.int32), np.ones((5, 4)))
+    assert list(props) == list(
+        skimage.measure.regionprops_table(
+            np.zeros((5, 4), dtype=np.int32),
+            np.ones((5, 4)),
+            properties=list(PROPERTIES),
+        )
+    )
+    assert all(len(column) == 0 for column in props.values())
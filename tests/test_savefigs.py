@@ -1,8 +1,14 @@
 import rasterio
 import numpy as np
 import pytest
+from numpy.testing import assert_array_equal
 
-from ebfloeseg.savefigs import imsave
+from ebfloeseg.savefigs import (
+    LABEL_BLOCK_SIZE,
+    get_label_dtype,
+    imsave,
+    imsave_labels,
+)
 
 
 @pytest.mark.slow
@@ -31,3 +37,32 @@ def test_imsave(tmp_path):
             rollaxis=False,
         )
         assert tmp_path.joinpath("fnameuint8").exists()
+
+
+@pytest.mark.parametrize("compress", ["deflate", "zstd"])
+def test_imsave_labels(scene, tmp_path, compress):
+    ftci, _, _ = scene
+    with rasterio.open(ftci) as tci:
+        labels = np.arange(tci.height * tci.width, dtype=np.int32).reshape(
+            tci.height, tci.width
+        )
+        labels %= 1000
+        labels[::9] = -1  # watershed lines
+        imsave_labels(tci, labels, tmp_path, "labels.tif", compress, res="res")
+
+        with rasterio.open(tmp_path / "res_labels.tif") as src:
+            assert src.dtypes == ("uint16",)
+            assert src.compression.value == compress.upper()
+            assert src.block_shapes == [(LABEL_BLOCK_SIZE, LABEL_BLOCK_SIZE)]
+            assert src.overviews(1) == [2]
+            assert (src.crs, src.transform) == (tci.crs, tci.transform)
+            assert_array_equal(src.read(1), labels.astype(np.uint16))
+            assert src.read(1)[0, 0] == np.iinfo(np.uint16).max
+
+
+def test_get_label_dtype():
+    assert get_label_dtype(255) == "uint16"
+    assert get_label_dtype(65534) == "uint16"
+    assert get_label_dtype(65535) == "uint32"
+    with pytest.raises(ValueError):
+        get_label_dtype(2**32)
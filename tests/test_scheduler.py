@@ -0,0 +1,130 @@
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import os
+import threading
+import time
+
+import pytest
+
+from ebfloeseg import scheduler
+from ebfloeseg.scheduler import (
+    HybridPoolExecutor,
+    estimate_scene_memory,
+    get_available_memory,
+    get_default_workers,
+    submit_bounded,
+)
+
+
+def test_submit_bounded():
+    lock = threading.Lock()
+    running = [0]
+    peak = [0]
+
+    def work(x):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        with lock:
+            running[0] -= 1
+        return x * 2
+
+    jobs = [(i,) for i in range(20)]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = {
+            job: future.result()
+            for job, future in submit_bounded(executor, work, jobs, max_in_flight=3)
+        }
+
+    assert results == {(i,): 2 * i for i in range(20)}
+    assert peak[0] <= 3
+
+
+def test_submit_bounded_reports_as_completed():
+    release = threading.Event()
+
+    def work(x):
+        if x == 0:
+            release.wait(5)
+        return x
+
+    order = []
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        for job, future in submit_bounded(executor, work, [(0,), (1,)], 2):
+            order.append(future.result())
+            release.set()
+
+    assert order == [1, 0]
+
+
+@pytest.mark.parametrize("available, expected", [(None, 8), (10**15, 8), (0, 1)])
+def test_get_default_workers(monkeypatch, tmp_path, available, expected):
+    ftcis = [tmp_path / f"tci{n}.tiff" for n in range(3)]
+    for n, ftci in enumerate(ftcis):
+        ftci.write_bytes(b"x" * [10, 30, 20][n])
+    opened = []
+
+    def estimate_scene_memory(ftci, tile_size):
+        opened.append(ftci)
+        return 10**9
+
+    monkeypatch.setattr(scheduler.os, "cpu_count", lambda: 8)
+    monkeypatch.setattr(scheduler, "get_available_memory", lambda: available)
+    monkeypatch.setattr(scheduler, "estimate_scene_memory", estimate_scene_memory)
+    assert get_default_workers(ftcis) == expected
+    assert opened == [ftcis[1]]  # only the largest file
+    assert get_default_workers([]) == 8
+
+
+def test_get_available_memory(monkeypatch):
+    # the page cache counts as available
+    meminfo = {"MemFree": 2 * 2**30, "MemAvailable": 12 * 2**30}
+    monkeypatch.setattr(scheduler, "read_meminfo", lambda: meminfo)
+    assert get_available_memory() == 12 * 2**30
+
+    monkeypatch.setattr(scheduler, "read_meminfo", lambda: {})
+    monkeypatch.setattr(scheduler.os, "sysconf", lambda name: 4096)
+    assert get_available_memory() == 4096 * 4096
+
+
+def test_estimate_scene_memory(scene):
+    ftci, _, _ = scene
+    assert estimate_scene_memory(ftci, 128) < estimate_scene_memory(ftci)
+
+
+def get_pid(x):
+    time.sleep(0.2)
+    if x < 0:
+        raise ValueError(x)
+    return x, os.getpid(), threading.get_ident()
+
+
+def test_hybrid_pool_executor():
+    with HybridPoolExecutor(2, 2) as executor:
+        futures = [executor.submit(get_pid, x) for x in range(8)]
+        failed = executor.submit(get_pid, -1)
+        results = [future.result() for future in futures]
+
+    assert [x for x, _, _ in results] == list(range(8))
+    assert len({pid for _, pid, _ in results} - {os.getpid()}) == 2
+    assert len({(pid, thread) for _, pid, thread in results}) == 4
+    with pytest.raises(ValueError):
+        failed.result()
+    with pytest.raises(RuntimeError):
+        executor.submit(get_pid, 0)
+
+
+def test_hybrid_pool_executor_max_workers():
+    # the second process runs one thread
+    with HybridPoolExecutor(2, 2, max_workers=3) as executor:
+        results = list(executor.map(get_pid, range(9)))
+    assert len({(pid, thread) for _, pid, thread in results}) == 3
+
+    with pytest.raises(ValueError):
+        HybridPoolExecutor(2, 2, max_workers=2)
+
+
+def test_hybrid_pool_executor_broken():
+    with HybridPoolExecutor(1, 2) as executor:
+        future = executor.submit(os._exit, 1)
+        assert isinstance(future.exception(timeout=60), BrokenProcessPool)
@@ -0,0 +1,111 @@
+import json
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from ebfloeseg.sharding import (
+    ShardManifest,
+    get_manifest_path,
+    get_shard,
+    get_shard_fname,
+    merge_manifests,
+    merge_shard_files,
+)
+
+
+def make_pairs(n):
+    return [(Path(f"tci/t{i}.tiff"), Path(f"cloud/c{i}.tiff")) for i in range(n)]
+
+
+def test_get_shard():
+    pairs = make_pairs(7)
+    shards = [get_shard(pairs[::-1], i, 3) for i in range(3)]
+    assert shards[0] == [pairs[0], pairs[3], pairs[6]]
+    assert sorted(sum(shards, [])) == pairs
+
+    with pytest.raises(ValueError):
+        get_shard(pairs, 3, 3)
+
+
+def test_merge_manifests(tmp_path):
+    pairs = make_pairs(5)
+    for i in range(2):
+        manifest = ShardManifest(tmp_path, i, 2, get_shard(pairs, i, 2))
+        done = get_shard(pairs, i, 2)[: 2 + i]
+        if i == 0:
+            for pair in done:
+                manifest.add(pair)
+        else:
+            manifest.add(*done)  # e.g. the cached scenes
+
+    recorded = json.loads(get_manifest_path(tmp_path, 1, 2).read_text())
+    assert recorded["scenes"] == recorded["completed"]
+
+    merged = merge_manifests(tmp_path, 2, pairs)
+    assert merged["missing"] == [{"ftci": "tci/t4.tiff", "fcloud": "cloud/c4.tiff"}]
+    assert len(merged["completed"]) == 4
+    assert json.loads((tmp_path / "manifest.json").read_text()) == merged
+
+    merged = merge_manifests(tmp_path, 3, pairs)
+    assert merged["missing_shards"] == [0, 1, 2]
+
+
+def test_merge_shard_files(tmp_path):
+    assert get_shard_fname("metrics.jsonl", 1, 4) == "metrics.shard-0001-of-0004.jsonl"
+    assert get_shard_fname("mask_values.txt", 0, 1) == "mask_values.txt"
+
+    (tmp_path / "214").mkdir()
+    for i in (1, 0):
+        fname = get_shard_fname("mask_values.txt", i, 2)
+        (tmp_path / "214" / fname).write_text(f"214\t{i}\n")
+    # the metrics of an earlier run are replaced
+    (tmp_path / "metrics.jsonl").write_text("old\n")
+    (tmp_path / get_shard_fname("metrics.jsonl", 1, 2)).write_text("new\n")
+
+    written = merge_shard_files(tmp_path, 2)
+    assert written == [tmp_path / "metrics.jsonl", tmp_path / "214/mask_values.txt"]
+    assert (tmp_path / "214/mask_values.txt").read_text() == "214\t0\n214\t1\n"
+    assert (tmp_path / "metrics.jsonl").read_text() == "new\n"
+
+
+@pytest.mark.slow
+def test_process_images_shards(archive):
+    # launch the shards side by side, as an array job would
+    shards = [
+        subprocess.Popen(
+            [
+                "fsdproc",
+                "process-images",
+                "-c",
+                str(archive),
+                "--max-workers",
+                "1",
+                "--shard-index",
+                str(i),
+                "--shard-count",
+                "2",
+            ],
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        for i in range(2)
+    ]
+    for shard in shards:
+        _, stderr = shard.communicate()
+        assert shard.returncode == 0, stderr
+
+    result = subprocess.run(
+        ["fsdproc", "merge-shards", "-c", str(archive), "--shard-count", "2"],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    assert "5 of 5 scenes completed" in result.stdout
+
+    output = archive.parent / "output"
+    for doy in range(214, 219):
+        assert len(list((output / str(doy)).glob("*_final.tif"))) == 1
+        mask_values = (output / str(doy) / "mask_values.txt").read_text()
+        assert len(mask_values.splitlines()) == 1
+    assert len((output / "metrics.jsonl").read_text().splitlines()) == 5
@@ -0,0 +1,82 @@
+import subprocess
+
+import pytest
+
+from ebfloeseg.app import (
+    get_sweep_direc,
+    parse_config_file,
+    parse_sweep,
+    validate_sweep_config,
+)
+from ebfloeseg.masking import create_land_mask
+from ebfloeseg.preprocess import _preprocess
+
+
+def add_grid(config_file):
+    with open(config_file, "a") as f:
+        f.write("[sweep]\nitmax = [6, 8]\nkernel_type = ['diamond', 'ellipse']\n")
+
+
+def test_parse_sweep(archive):
+    add_grid(archive)
+    args = parse_config_file(archive)
+    grid = parse_sweep(archive, args)
+    assert len(grid) == 4
+    assert {(g["itmax"], g["kernel_type"]) for g in grid} == {
+        (6, "diamond"),
+        (6, "ellipse"),
+        (8, "diamond"),
+        (8, "ellipse"),
+    }
+    assert all(g["itmin"] == 3 and g["kernel_size"] == 1 for g in grid)
+    assert len({get_sweep_direc(args.save_direc, g) for g in grid}) == 4
+
+
+@pytest.mark.parametrize("setting", ["tile_size = 512", "min_usable_fraction = 0.5"])
+def test_validate_sweep_config(archive, setting):
+    text = archive.read_text()
+    archive.write_text(text.replace("[erosion]", f"{setting}\n[erosion]"))
+    with pytest.raises(ValueError, match=setting.split()[0]):
+        validate_sweep_config(parse_config_file(archive))
+
+
+@pytest.mark.slow
+def test_sweep(archive, tmp_path):
+    add_grid(archive)
+    result = subprocess.run(
+        ["fsdproc", "sweep", "-c", str(archive), "--max-workers", "2"],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.count("processed") == 5 * 4
+
+    # each combination matches a run of the whole pipeline with its settings
+    args = parse_config_file(archive)
+    ftci = sorted((args.data_direc / "tci").iterdir())[1]
+    fcloud = sorted((args.data_direc / "cloud").iterdir())[1]
+    _preprocess(
+        ftci,
+        fcloud,
+        create_land_mask(args.land),
+        6,
+        3,
+        -1,
+        "ellipse",
+        1,
+        False,
+        tmp_path / "expected",
+    )
+    settings = {
+        "itmax": 6,
+        "itmin": 3,
+        "step": -1,
+        "kernel_type": "ellipse",
+        "kernel_size": 1,
+    }
+    for expected in sorted((tmp_path / "expected" / "215").iterdir()):
+        if expected.name == "mask_values.txt":
+            actual = args.save_direc / "215" / expected.name
+        else:
+            actual = get_sweep_direc(args.save_direc, settings) / "215" / expected.name
+        assert actual.read_bytes() == expected.read_bytes(), expected.name
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+import rasterio
+from numpy.testing import assert_allclose, assert_array_equal
+from skimage.filters import threshold_local
+
+from ebfloeseg.threshold import (
+    accumulate_block_sums,
+    get_grid_shape,
+    get_local_threshold,
+    get_threshold_halo,
+    get_window_threshold,
+    threshold_coarse,
+    threshold_mean,
+    upsample,
+)
+
+
+@pytest.fixture
+def red(scene):
+    ftci, _, _ = scene
+    with rasterio.open(ftci) as src:
+        return src.read(1)
+
+
+def test_threshold_mean(red):
+    expected = threshold_local(red, block_size=99, method="mean")
+    assert_allclose(threshold_mean(red, 99), expected, rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize(
+    "method, max_disagreement", [("mean", 0.02), ("downsample", 0.005)]
+)
+def test_threshold_accuracy(red, method, max_disagreement):
+    # fraction of pixels classified differently than with the exact threshold
+    exact = red > threshold_local(red, block_size=399)
+    approx = red > get_local_threshold(red, 399, method)
+    assert np.mean(exact != approx) < max_disagreement
+
+
+def test_upsample_windows(red):
+    shape = red.shape
+    sums = np.zeros(get_grid_shape(shape), dtype=np.int64)
+    counts = np.zeros_like(sums)
+    for row_off in range(0, shape[0], 100):
+        accumulate_block_sums(sums, counts, red[row_off : row_off + 100], row_off)
+    assert counts.sum() == red.size
+    assert sums.sum() == red.sum(dtype=np.int64)
+
+    coarse = threshold_coarse(sums, counts, 399, 8)
+    whole = get_local_threshold(red, 399, "downsample")
+    window = (slice(100, 300), slice(250, 620))
+    assert_array_equal(upsample(coarse, 8, *window, shape), whole[window])
+
+
+@pytest.mark.parametrize("method", ["gaussian", "mean", "downsample"])
+def test_get_window_threshold(red, method):
+    whole = get_local_threshold(red, 399, method)
+    for window in [
+        (slice(100, 300), slice(250, 620)),  # touching the right edge
+        (slice(0, 560), slice(40, 41)),
+        (slice(200, 210), slice(300, 330)),
+    ]:
+        assert_array_equal(
+            get_window_threshold(red, 399, window, method), whole[window]
+        )
+
+
+def test_get_threshold_halo():
+    assert get_threshold_halo(399) == 265
+    assert get_threshold_halo(399, "mean") == 199
+    assert get_threshold_halo(399, "downsample") == 0
+
+
+def test_get_local_threshold_unknown(red):
+    with pytest.raises(ValueError):
+        get_local_threshold(red, 399, "median")
@@ -0,0 +1,83 @@
+import cv2
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal
+from rasterio.windows import Window
+from scipy import ndimage
+
+from ebfloeseg.tiling import (
+    get_region_windows,
+    get_threshold_radius,
+    iter_bands,
+    iter_tiles,
+    label_tiled,
+    pad_window,
+)
+
+
+def test_get_threshold_radius():
+    assert get_threshold_radius(399) == 265
+
+
+def test_iter_tiles():
+    tiles = [tile for band in iter_bands(5, 7, 4) for tile in iter_tiles(band, 4)]
+    assert tiles == [
+        Window(0, 0, 4, 4),
+        Window(4, 0, 3, 4),
+        Window(0, 4, 4, 1),
+        Window(4, 4, 3, 1),
+    ]
+
+
+def test_pad_window():
+    padded, inner = pad_window(Window(4, 0, 3, 4), 2, 5, 7)
+    assert padded == Window(2, 0, 5, 5)
+    assert inner == (slice(0, 4), slice(2, 5))
+
+
+def test_get_region_windows():
+    mask = np.zeros((100, 90), dtype=bool)
+    mask[10:12, 10:40] = True  # a bar ...
+    mask[30:33, 20:23] = True  # ... and a region whose padding overlaps it
+    mask[80:95, 70:85] = True
+    mask[98, 2] = True
+
+    windows = get_region_windows(mask, 4, cell=8)
+    assert get_region_windows(np.zeros_like(mask), 4) == []
+    assert sorted(windows, key=lambda w: (w.row_off, w.col_off)) == [
+        Window(0, 0, 48, 48),
+        Window(56, 72, 34, 28),
+        Window(0, 88, 16, 12),
+    ]
+
+    # every region with its padded bounding box lies in a single window
+    _, _, stats, _ = cv2.connectedComponentsWithStats(mask.view(np.uint8))
+    for col, row, ncols, nrows, _ in stats[1:]:
+        box = np.zeros_like(mask)
+        box[max(row - 4, 0) : row + nrows + 4, max(col - 4, 0) : col + ncols + 4] = 1
+        inside = [w for w in windows if box[w.toslices()].sum() == box.sum()]
+        assert len(inside) == 1
+
+
+def test_label_tiled():
+    rng = np.random.default_rng(0)
+    mask = (rng.random((301, 263)) < 0.45).astype(np.uint8)
+
+    labels = np.zeros(mask.shape, dtype=np.int32)
+    n, _ = label_tiled(mask, labels, tile_size=64)
+    expected_n, expected = cv2.connectedComponents(mask)
+    assert n == expected_n
+    assert_array_equal(labels, expected)
+
+    with pytest.raises(ValueError, match="int8"):
+        label_tiled(mask, np.zeros(mask.shape, dtype=np.int8), tile_size=64)
+
+
+def test_label_tiled_fill_holes():
+    rng = np.random.default_rng(1)
+    mask = (rng.random((200, 190)) < 0.6).astype(np.uint8)
+
+    labels = np.zeros(mask.shape, dtype=np.int64)
+    _, border = label_tiled(mask, labels, 32, connectivity=4, invert=True)
+    border[0] = True
+    assert_array_equal(mask | ~border[labels], ndimage.binary_fill_holes(mask))
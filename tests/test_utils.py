@@ -1,7 +1,11 @@
+from pathlib import Path
+
 import numpy as np
 
 from ebfloeseg.utils import (
+    WCUT_BINS,
     write_mask_values,
+    get_histogram,
     get_region_properties,
     imshow,
     getdoy,
@@ -9,6 +13,7 @@ from ebfloeseg.utils import (
     getsat,
     getmeta,
     getres,
+    pair_scenes,
 )
 
 f1 = "cloud_2012-08-01_214_terra.tiff"
@@ -72,3 +77,31 @@ def test_imshow():
     img = np.random.choice([False, True], size=(1, 1))
     imshow(img, show=False)
     assert True
+
+
+def test_get_histogram():
+    rng = np.random.default_rng(0)
+    rgb = rng.integers(0, 256, (300, 200, 3), dtype=np.uint8)
+    red = rgb[:, :, 0]  # strided
+    expected = np.histogram(red, bins=WCUT_BINS)[0]
+    assert np.array_equal(get_histogram(red), expected)
+    assert np.array_equal(get_histogram(red.copy()), expected)
+    assert np.array_equal(get_histogram(red.astype(float)), expected)
+
+
+def test_pair_scenes():
+    ftcis = [
+        Path("tci/tci_2012-08-01_214_terra.tiff"),
+        Path("tci/tci_2012-08-02_215_terra.tiff"),
+        Path("tci/tci_2012-08-03_216_terra.tiff"),
+        Path("tci/notes.txt"),
+    ]
+    fclouds = [
+        Path("cloud/cloud_2012-08-01_214_terra.tiff"),
+        Path("cloud/cloud_2012-08-03_216_terra.tiff"),
+        Path("cloud/cloud_2012-08-04_217_terra.tiff"),
+    ]
+    pairs, unpaired = pair_scenes(ftcis, fclouds)
+    # the missing cloud file of 215 does not shift the later scenes
+    assert pairs == [(ftcis[0], fclouds[0]), (ftcis[2], fclouds[1])]
+    assert unpaired == [ftcis[3], ftcis[1], fclouds[2]]
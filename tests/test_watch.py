@@ -0,0 +1,108 @@
+import json
+import os
+import subprocess
+import time
+
+import pytest
+
+from ebfloeseg.watch import SceneWatcher
+
+
+def deliver(direc, name, mtime):
+    path = direc / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"scene")
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_scene_watcher(tmp_path):
+    watcher = SceneWatcher(tmp_path, settle_seconds=5, start=100)
+    assert watcher.poll(now=100) == []
+
+    ftci = deliver(tmp_path, "tci/tci_2012-08-01_214_terra.tiff", 50)
+    deliver(tmp_path, "tci/notes.txt", 50)
+    deliver(tmp_path, "cloud/.cloud_2012-08-01_214_terra.tiff.partial", 50)
+    assert watcher.poll(now=200) == []
+
+    # the scene arrives with its last file, once that file has settled
+    fcloud = deliver(tmp_path, "cloud/cloud_2012-08-01_214_terra.tiff", 300)
+    assert watcher.poll(now=303) == []
+    [arrival] = watcher.poll(now=305)
+    assert (arrival.ftci, arrival.fcloud, arrival.arrived) == (ftci, fcloud, 300)
+    assert watcher.poll(now=400) == []
+
+    # rewritten in place, which is not noticed
+    os.utime(ftci, (400, 400))
+    assert watcher.poll(now=500) == []
+
+    # delivered again, as a new file renamed over the old one
+    deliver(tmp_path, "tci/.tci_2012-08-01_214_terra.tiff", 500).rename(ftci)
+    [arrival] = watcher.poll(now=600)
+    assert arrival.arrived == 500
+
+
+def test_scene_watcher_filters(tmp_path):
+    watcher = SceneWatcher(
+        tmp_path, settle_seconds=0, start=0, filters={"satellites": ["aqua"]}
+    )
+    for sat in ["terra", "aqua"]:
+        deliver(tmp_path, f"tci/tci_2012-08-01_214_{sat}.tiff", 10)
+        deliver(tmp_path, f"cloud/cloud_2012-08-01_214_{sat}.tiff", 10)
+
+    [arrival] = watcher.poll(now=20)
+    assert arrival.ftci.name == "tci_2012-08-01_214_aqua.tiff"
+
+
+def test_scene_watcher_limit(tmp_path):
+    watcher = SceneWatcher(tmp_path, settle_seconds=0, start=0)
+    for doy, mtime in [(214, 30), (215, 10), (216, 20)]:
+        deliver(tmp_path, f"tci/tci_2012-08-01_{doy}_terra.tiff", mtime)
+        deliver(tmp_path, f"cloud/cloud_2012-08-01_{doy}_terra.tiff", mtime)
+
+    # in the order of arrival; the others wait for later polls
+    assert [a.arrived for a in watcher.poll(limit=2, now=40)] == [10, 20]
+    assert [a.arrived for a in watcher.poll(limit=0, now=40)] == []
+    assert [a.arrived for a in watcher.poll(limit=2, now=40)] == [30]
+
+
+@pytest.mark.slow
+def test_watch(archive):
+    # one scene is delivered once the others are processed
+    direc = archive.parent / "input"
+    late = direc / "cloud" / "cloud_2012-08-03_216_terra.tiff"
+    late.rename(direc / "late.tiff")
+    watch = subprocess.Popen(
+        [
+            "fsdproc",
+            "watch",
+            "-c",
+            str(archive),
+            "--max-workers",
+            "1",
+            "--poll-interval",
+            "0.1",
+            "--settle-seconds",
+            "0",
+            "--max-scenes",
+            "5",
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    metrics = archive.parent / "output" / "metrics.jsonl"
+    deadline = time.monotonic() + 120
+    while not metrics.exists() or len(metrics.read_text().splitlines()) < 4:
+        assert watch.poll() is None and time.monotonic() < deadline
+        time.sleep(0.1)
+    (direc / "late.tiff").rename(late)
+
+    stdout, stderr = watch.communicate(timeout=120)
+    assert watch.returncode == 0, stderr
+    assert stdout.count("processed") == 5
+
+    records = [json.loads(line) for line in metrics.read_text().splitlines()]
+    assert [r["status"] for r in records] == ["ok"] * 5
+    assert records[-1]["scene"] == "tci_2012-08-03_216_terra.tiff"
+    assert all(r["latency_seconds"] >= r["seconds"] for r in records)